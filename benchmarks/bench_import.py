@@ -0,0 +1,92 @@
+"""
+Import time of the mri_preprocessing modules.
+
+Each module is imported in a fresh interpreter where importing matlab raises an ImportError, so a module importing
+matlab at import time fails the benchmark even on a machine with matlab installed. The benchmark also fails if an
+import takes more than --max_seconds.
+
+    python benchmarks/bench_import.py [--repeat 5] [--max_seconds 2]
+"""
+import argparse
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+# Modules that must be importable without matlab
+core_modules = [
+    'mri_preprocessing.modules.data_access',
+    'mri_preprocessing.modules.utils',
+    'mri_preprocessing.modules.toolbox_config',
+    'mri_preprocessing.modules.step_cache',
+    'mri_preprocessing.modules.stage_manifest',
+    'mri_preprocessing.modules.scheduler',
+    'mri_preprocessing.modules.orientation',
+    'mri_preprocessing.modules.engine_pool',
+    'mri_preprocessing.modules.matlab_wrappers',
+    'mri_preprocessing.modules.preproc',
+    'mri_preprocessing.modules.extra_utils',
+    'mri_preprocessing.modules.rigid_affine_only',
+]
+
+_child_code = '''
+import sys, time, json, importlib.abc
+
+
+class _NoMatlab(importlib.abc.MetaPathFinder):
+    def find_spec(self, name, path=None, target=None):
+        if name == 'matlab' or name.startswith('matlab.'):
+            raise ImportError('matlab imported at import time')
+        return None
+
+
+sys.meta_path.insert(0, _NoMatlab())
+start = time.perf_counter()
+try:
+    __import__({module!r})
+    error = None
+except ImportError as e:
+    error = str(e)
+print(json.dumps({{'seconds': time.perf_counter() - start, 'error': error}}))
+'''
+
+
+def time_import(module):
+    output = subprocess.run([sys.executable, '-c', _child_code.format(module=module)], capture_output=True,
+                            text=True, cwd=str(Path(__file__).absolute().parent.parent))
+    if output.returncode != 0:
+        return {'seconds': None, 'error': output.stderr.strip().splitlines()[-1]}
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import time of the mri_preprocessing modules (without matlab)')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='number of imports of each module (default 5)')
+    parser.add_argument('-m', '--max_seconds', type=float, default=2,
+                        help='fail if the median import time of a module is above this value (default 2)')
+    parser.add_argument('-o', '--output', type=str, help='json file where the results are saved')
+    args = parser.parse_args()
+    results = {}
+    failed = False
+    for module in core_modules:
+        runs = [time_import(module) for _ in range(args.repeat)]
+        errors = [r['error'] for r in runs if r['error']]
+        if errors:
+            # Missing optional dependencies (e.g. bcblib) are reported but only matlab imports fail the benchmark
+            status = 'FAIL' if any('matlab' in e for e in errors) else 'SKIP'
+            results[module] = {'status': status, 'error': errors[0]}
+            print('{:50} {} ({})'.format(module, status, errors[0]))
+        else:
+            median = sorted(r['seconds'] for r in runs)[len(runs) // 2]
+            status = 'FAIL' if median > args.max_seconds else 'OK'
+            results[module] = {'status': status, 'median_seconds': median}
+            print('{:50} {} {:.3f}s'.format(module, status, median))
+        failed = failed or status == 'FAIL'
+    if args.output:
+        with open(args.output, 'w+') as f:
+            json.dump(results, f, indent=4)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
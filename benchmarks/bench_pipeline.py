@@ -0,0 +1,175 @@
+"""
+End to end benchmark of the preprocessing on a synthetic cohort, without matlab: the fake engine of
+benchmarks/fake_matlab is used instead (see its docstring).
+
+    python benchmarks/bench_pipeline.py [--subjects 8] [--repeats 2] [--shape 64 64 32] [--gz] [--latency 0.05]
+                                        [--jobs 1] [--reslice_backend matlab] [--warp_backend matlab]
+                                        [--orchestration sync]
+                                        [--check] [--save_baseline]
+
+Each benchmark is compared with the stored baseline (benchmarks/baseline.json, same parameters only) and reported as
+a regression if it is more than --tolerance (relative) and --min_delta (seconds) slower.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+bench_dir = Path(__file__).absolute().parent
+fake_matlab_dir = Path(bench_dir, 'fake_matlab')
+default_baseline = Path(bench_dir, 'baseline.json')
+
+
+def _setup_environment(work_dir, latency):
+    # The worker processes (spawn) import the fake matlab package through PYTHONPATH
+    sys.path.insert(0, str(fake_matlab_dir))
+    sys.path.insert(1, str(bench_dir.parent))
+    os.environ['PYTHONPATH'] = os.pathsep.join(
+        [str(fake_matlab_dir), str(bench_dir.parent)] + [p for p in [os.environ.get('PYTHONPATH')] if p])
+    os.environ['MRI_PREPROC_FAKE_ENGINE_LATENCY'] = str(latency)
+    # Toolbox paths pointing to empty folders so the user's config is neither used nor modified
+    os.environ['MRI_PREPROC_CONFIG'] = str(Path(work_dir, 'toolbox_paths.json'))
+    for variable in ['MRI_PREPROC_SPM_PATH', 'MRI_PREPROC_SUPERRES_PATH', 'MRI_PREPROC_PATIENT_PREPROC_PATH']:
+        path = Path(work_dir, 'toolboxes', variable)
+        os.makedirs(path, exist_ok=True)
+        os.environ[variable] = str(path)
+
+
+def _timed(fn, verbose=False):
+    out = None if verbose else io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(out) if out is not None else contextlib.nullcontext():
+        result = fn()
+    return time.perf_counter() - start, result
+
+
+def run_benchmarks(args, work_dir):
+    import synthetic
+    from mri_preprocessing.modules import preproc, data_access, utils, dataset_scanner, engine_pool, resample
+
+    results = {}
+    t, json_path = _timed(lambda: synthetic.make_cohort(
+        Path(work_dir, 'input'), args.subjects, args.repeats, shape=tuple(args.shape), compressed=args.gz))
+    results['make_cohort'] = t
+    split_dict = data_access.get_split_dict_from_json(json_path)
+    first = split_dict[sorted(split_dict)[0]]
+    b0_images = [p for p in first if first[p] == 0]
+    gmean_times = []
+    for _ in range(args.gmean_repeats):
+        t, _ = _timed(lambda: preproc.nii_gmean(b0_images, Path(work_dir, 'gmean.nii')))
+        gmean_times.append(t)
+    results['nii_gmean'] = sorted(gmean_times)[len(gmean_times) // 2]
+    t, _ = _timed(lambda: resample.reslice_bb(b0_images[0], work_dir, 2, order=1, nb_threads=4))
+    results['reslice_bb'] = t
+
+    output_root = Path(work_dir, 'output')
+    os.makedirs(output_root)
+    t, _ = _timed(lambda: preproc.preproc_from_dataset_dict(
+        json_path, output_root, nb_cores=args.jobs, engines_per_subject=args.engines_per_subject,
+        reslice_backend=args.reslice_backend, warp_backend=args.warp_backend, orchestration=args.orchestration),
+        args.verbose)
+    results['preproc_from_dataset_dict'] = t
+    nb_done = len([d for d in output_root.iterdir() if Path(d, '__preproc_dict.json').is_file()])
+    if nb_done != args.subjects:
+        raise ValueError('{} subjects out of {} were preprocessed, see {}'.format(
+            nb_done, args.subjects, Path(output_root, 'errors')))
+    t, _ = _timed(lambda: preproc.preproc_from_dataset_dict(json_path, output_root, nb_cores=args.jobs,
+                                                            reslice_backend=args.reslice_backend,
+                                                            warp_backend=args.warp_backend,
+                                                            orchestration=args.orchestration), args.verbose)
+    results['preproc_from_dataset_dict_resume'] = t
+    t, _ = _timed(lambda: utils.generate_final_preproc_dict(output_root))
+    results['generate_final_preproc_dict'] = t
+    t, _ = _timed(lambda: utils.generate_final_preproc_dict(output_root))
+    results['generate_final_preproc_dict_unchanged'] = t
+    summary_folder = Path(work_dir, 'summary')
+    os.makedirs(summary_folder)
+    t, _ = _timed(lambda: data_access.generate_output_summary(output_root, summary_folder, nb_threads=4))
+    results['generate_output_summary'] = t
+    dataset_scanner._dir_cache.clear()
+    t, _ = _timed(lambda: dataset_scanner.walk(output_root))
+    results['dataset_scanner_walk'] = t
+    t, _ = _timed(lambda: dataset_scanner.walk(output_root))
+    results['dataset_scanner_walk_cached'] = t
+    engine_pool.get_engine_pool().close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the preprocessing on a synthetic cohort with a fake '
+                                                 'matlab engine')
+    parser.add_argument('-s', '--subjects', type=int, default=8)
+    parser.add_argument('-r', '--repeats', type=int, default=2, help='images per b-value (default 2)')
+    parser.add_argument('--shape', type=int, nargs=3, default=[64, 64, 32])
+    parser.add_argument('--gz', action='store_true', help='write .nii.gz images')
+    parser.add_argument('-l', '--latency', type=float, default=0.05,
+                        help='latency of each fake engine call in seconds (default 0.05)')
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+    parser.add_argument('-eps', '--engines_per_subject', type=int, default=1)
+    parser.add_argument('-rb', '--reslice_backend', type=str, default='matlab', choices=['matlab', 'native'])
+    parser.add_argument('-wb', '--warp_backend', type=str, default='matlab', choices=['matlab', 'native'])
+    parser.add_argument('-or', '--orchestration', type=str, default='sync', choices=['sync', 'asyncio'])
+    parser.add_argument('--gmean_repeats', type=int, default=5)
+    parser.add_argument('-o', '--output', type=str, help='json file where the results are saved')
+    parser.add_argument('-b', '--baseline', type=str, default=str(default_baseline))
+    parser.add_argument('--save_baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.25,
+                        help='relative slowdown reported as a regression (default 0.25)')
+    parser.add_argument('--min_delta', type=float, default=0.02,
+                        help='slowdowns smaller than this (in seconds) are never regressions (default 0.02)')
+    parser.add_argument('--check', action='store_true', help='exit with an error if there is a regression')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary folder')
+    parser.add_argument('-v', '--verbose', action='store_true', help='show the output of the pipeline')
+    args = parser.parse_args()
+    params = {k: getattr(args, k) for k in ['subjects', 'repeats', 'shape', 'gz', 'latency', 'jobs',
+                                            'engines_per_subject', 'reslice_backend',
+                                            'warp_backend', 'orchestration']}
+    work_dir = tempfile.mkdtemp(prefix='mri_preproc_bench_')
+    try:
+        _setup_environment(work_dir, args.latency)
+        results = run_benchmarks(args, work_dir)
+    finally:
+        if args.keep:
+            print('Benchmark files kept in {}'.format(work_dir))
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    baseline = {}
+    if Path(args.baseline).is_file():
+        with open(args.baseline, 'r') as f:
+            stored = json.load(f)
+        if stored.get('params') == params:
+            baseline = stored['results']
+        else:
+            print('The baseline in {} was measured with other parameters, it is ignored'.format(args.baseline))
+    regressions = []
+    print('{:40} {:>10} {:>10} {:>8}'.format('benchmark', 'time(s)', 'baseline', 'ratio'))
+    for name, t in results.items():
+        if name in baseline:
+            ratio = t / baseline[name] if baseline[name] > 0 else float('inf')
+            flag = ' REGRESSION' if ratio > 1 + args.tolerance and t - baseline[name] > args.min_delta else ''
+            if flag:
+                regressions.append(name)
+            print('{:40} {:>10.3f} {:>10.3f} {:>8.2f}{}'.format(name, t, baseline[name], ratio, flag))
+        else:
+            print('{:40} {:>10.3f} {:>10} {:>8}'.format(name, t, '-', '-'))
+    output = {'params': params, 'python': sys.version.split()[0], 'results': results}
+    if args.output:
+        with open(args.output, 'w+') as f:
+            json.dump(output, f, indent=4)
+    if args.save_baseline:
+        with open(args.baseline, 'w+') as f:
+            json.dump(output, f, indent=4)
+        print('Baseline saved in {}'.format(args.baseline))
+    if args.check and regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
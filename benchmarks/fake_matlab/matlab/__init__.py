@@ -0,0 +1,2 @@
+# Stand-in for the matlab python package used by the benchmarks (see benchmarks/bench_pipeline.py): put
+# benchmarks/fake_matlab in PYTHONPATH to import it instead of the real one
@@ -0,0 +1,182 @@
+"""
+Fake matlab.engine: start_matlab() returns a FakeEngine implementing the functions called by mri_preprocessing with
+real file outputs (copies of the inputs with the prefixes written by the matlab scripts, identity deformation fields
+for non_linear_reg) and a configurable latency per call (MRI_PREPROC_FAKE_ENGINE_LATENCY environment variable, in
+seconds, default 0). With MRI_PREPROC_FAKE_ENGINE_CRASH_AFTER=N, each engine dies after N computations: every later
+call raises EngineError, to exercise the engine recycling and the retries.
+"""
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import nibabel as nib
+
+
+class EngineError(Exception):
+    pass
+
+
+def _latency():
+    return float(os.environ.get('MRI_PREPROC_FAKE_ENGINE_LATENCY', 0))
+
+
+def _crash_after():
+    return int(os.environ.get('MRI_PREPROC_FAKE_ENGINE_CRASH_AFTER', 0))
+
+
+def _prefixed(path, prefix, output_folder=None):
+    path = Path(path)
+    name = path.name[:-len('.gz')] if path.name.endswith('.gz') else path.name
+    output_path = Path(output_folder if output_folder else path.parent, prefix + name)
+    if path.name.endswith('.gz'):
+        import gzip
+        with gzip.open(path, 'rb') as src, open(output_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+    else:
+        shutil.copyfile(path, output_path)
+    return str(output_path)
+
+
+def _identity_field(path, prefix, affine, shape):
+    path = Path(path)
+    name = path.name[:-len('.gz')] if path.name.endswith('.gz') else path.name
+    output_path = Path(path.parent, prefix + name)
+    ijk = np.stack(list(np.meshgrid(*[np.arange(n) for n in shape], indexing='ij')) + [np.ones(shape)], axis=-1)
+    field = ijk.dot(np.asarray(affine).T)[..., :3].astype(np.float32)
+    nib.save(nib.Nifti1Image(field[:, :, :, None, :], affine), str(output_path))
+    return str(output_path)
+
+
+class FutureResult:
+    """
+    Result of a call made with background=True (runs in a thread like the matlab engine runs the call)
+    """
+    def __init__(self, fn, args, kwargs):
+        self._result = None
+        self._error = None
+
+        def run():
+            try:
+                self._result = fn(*args, **kwargs)
+            except Exception as e:
+                self._error = e
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+
+    def done(self):
+        return not self._thread.is_alive()
+
+    def result(self, timeout=None):
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            raise TimeoutError()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def cancel(self):
+        return False
+
+    def cancelled(self):
+        return False
+
+
+class FakeEngine:
+    # functions simulating a matlab computation (latency + file outputs)
+    _computations = ['reset_orient_mat', 'my_align', 'run_coreg', 'run_bb_spm', 'run_bb_spm_batch',
+                     'non_linear_reg', 'apply_transform', 'apply_transform_batch', 'apply_inverse_transform']
+
+    def __init__(self):
+        self.calls = {}
+        self.dead = False
+        self._lock = threading.Lock()
+
+    def __getattribute__(self, name):
+        attr = object.__getattribute__(self, name)
+        if name not in FakeEngine._computations:
+            return attr
+
+        def call(*args, background=False, nargout=1, **kwargs):
+            with object.__getattribute__(self, '_lock'):
+                calls = object.__getattribute__(self, 'calls')
+                calls[name] = calls.get(name, 0) + 1
+                if _crash_after() and sum(calls.values()) > _crash_after():
+                    self.dead = True
+            if self.dead:
+                raise EngineError('MATLAB process cannot be terminated.')
+
+            def run(*a, **k):
+                time.sleep(_latency())
+                return attr(*a, **k)
+            if background:
+                return FutureResult(run, args, kwargs)
+            return run(*args, **kwargs)
+        return call
+
+    def spm(self, *args, nargout=1):
+        return 'SPM12', 'fake'
+
+    def which(self, name, nargout=1):
+        return ''
+
+    def addpath(self, *args, nargout=1):
+        return None
+
+    def cd(self, *args, nargout=1):
+        return None
+
+    def eval(self, *args, nargout=1, background=False):
+        def run():
+            if self.dead:
+                raise EngineError('MATLAB process cannot be terminated.')
+        if background:
+            return FutureResult(run, (), {})
+        return run()
+
+    def feature(self, name, nargout=1):
+        return os.getpid()
+
+    def quit(self):
+        return None
+
+    def reset_orient_mat(self, img_path, output_folder):
+        _prefixed(img_path, 'reo_', output_folder)
+
+    def my_align(self, img_path, output_folder):
+        return {'rigid': _prefixed(img_path, 'rigid_', output_folder),
+                'affine': _prefixed(img_path, 'affine_', output_folder)}
+
+    def run_coreg(self, img_paths, output_folder, prefix):
+        return {'pth': {'im': [_prefixed(p, prefix, output_folder) for p in img_paths]}}
+
+    def run_bb_spm(self, img_path, output_folder, voxel_size=2, prefix='resliced_'):
+        return {'pth': {'im': [_prefixed(img_path, prefix, output_folder)]}}
+
+    def run_bb_spm_batch(self, img_paths, output_folder, voxel_size=2, prefix='resliced_'):
+        return [_prefixed(p, prefix, output_folder) for p in img_paths]
+
+    def non_linear_reg(self, img_path):
+        img = nib.load(str(img_path))
+        # the inverse field is on the grid of the image, the field on a 3mm grid of the SPM bounding box
+        _identity_field(img_path, 'iy_', img.affine, img.shape[:3])
+        affine = np.diag([3., 3., 3., 1.])
+        affine[:3, 3] = [-90, -126, -72]
+        return _identity_field(img_path, 'y_', affine, (61, 73, 61))
+
+    def apply_transform(self, img_path, def_field, voxel_size=2, prefix='non_linear_'):
+        return _prefixed(img_path, prefix)
+
+    def apply_transform_batch(self, img_paths, def_field, voxel_size=2, prefix='non_linear_'):
+        return [_prefixed(p, prefix) for p in img_paths]
+
+    def apply_inverse_transform(self, img_path, inv_def_field, prefix='native_space_'):
+        return _prefixed(img_path, prefix)
+
+
+def start_matlab(option='-nodesktop', background=False):
+    if background:
+        return FutureResult(FakeEngine, (), {})
+    return FakeEngine()
@@ -0,0 +1,64 @@
+"""
+Synthetic DWI cohorts for the benchmarks: random images written in the split_dwi layout read by
+data_access.get_split_dict_from_json (__final_image_dict.json with one metadata json per key).
+"""
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import nibabel as nib
+
+
+def make_cohort(root, nb_subjects=10, repeats=2, bvals=(0, 1000), shape=(64, 64, 32), compressed=False, seed=0):
+    """
+    Parameters
+    ----------
+    root : pathlike
+        folder where the images and the input dictionary are written
+    nb_subjects : int
+    repeats : int
+        number of images per b-value
+    bvals : sequence of float
+    shape : 3-tuple of int
+    compressed : bool
+        write .nii.gz instead of .nii
+    seed : int
+    Returns
+    -------
+    json_path : str
+        path to root/__final_image_dict.json
+    """
+    rng = np.random.default_rng(seed)
+    root = Path(root)
+    os.makedirs(root, exist_ok=True)
+    ext = '.nii.gz' if compressed else '.nii'
+    affine = np.diag([2., 2., 2., 1.])
+    affine[:3, 3] = -np.array(shape) + 1
+    final_dict = {}
+    for s in range(nb_subjects):
+        key = 'sub{:05d}'.format(s)
+        subject_dir = Path(root, key)
+        os.makedirs(subject_dir, exist_ok=True)
+        split_dwi = {}
+        for bval in bvals:
+            for r in range(repeats):
+                img_path = Path(subject_dir, '{}_b{}_{}{}'.format(key, int(bval), r, ext))
+                data = (rng.random(shape, dtype=np.float32) * 1000 + 1).astype(np.int16)
+                nib.save(nib.Nifti1Image(data, affine), str(img_path))
+                split_dwi[str(img_path)] = float(bval)
+        metadata_path = Path(subject_dir, key + '.json')
+        with open(metadata_path, 'w+') as f:
+            # StudyInstanceUID and Modality
+            json.dump({'0020000D': {'vr': 'UI', 'Value': ['1.2.3.{}'.format(s)]},
+                       '00080060': {'vr': 'CS', 'Value': ['MR']}}, f)
+        final_dict[key] = {
+            'output_dir': str(subject_dir),
+            'metadata': str(metadata_path),
+            'non_head': 'False',
+            'split_dwi': split_dwi,
+        }
+    json_path = Path(root, '__final_image_dict.json')
+    with open(json_path, 'w+') as f:
+        json.dump(final_dict, f, indent=4)
+    return str(json_path)
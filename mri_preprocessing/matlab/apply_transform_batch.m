@@ -0,0 +1,38 @@
+function [output_imgs] = apply_transform_batch(input_paths, def_field, voxel_size, pref)
+    % apply_transform on a list of images sharing the same deformation
+    % field: all the images are written by a single normalise.write job
+    if nargin < 3
+        vox = [2 2 2];
+    else
+        vox = [cast(voxel_size, 'double') cast(voxel_size, 'double') cast(voxel_size, 'double')];
+    end
+    if nargin < 4
+        pref = 'non_linear_';
+    end
+    pref = convertStringsToChars(pref);
+    def_field = convertStringsToChars(def_field);
+    resample = cell(numel(input_paths), 1);
+    output_imgs = cell(1, numel(input_paths));
+    for i = 1:numel(input_paths)
+        input_path = convertStringsToChars(input_paths{i});
+        if ~isfile(input_path)
+            error('%s does not exist', input_path);
+        end
+        [input_dir, basename, ext] = fileparts(input_path);
+        resample{i} = [input_path ',1'];
+        output_imgs{i} = fullfile(input_dir, [pref basename ext]);
+    end
+    matlabbatch{1}.spm.spatial.normalise.write.subj.def = {def_field};
+    matlabbatch{1}.spm.spatial.normalise.write.subj.resample = resample;
+    matlabbatch{1}.spm.spatial.normalise.write.woptions.bb = [-90 -126 -72
+        90 90 108];
+    matlabbatch{1}.spm.spatial.normalise.write.woptions.vox = vox;
+    matlabbatch{1}.spm.spatial.normalise.write.woptions.interp = 4;
+    if ~strcmp(pref, '')
+        matlabbatch{1}.spm.spatial.normalise.write.woptions.prefix = pref;
+    else
+        output_imgs = cellfun(@convertStringsToChars, input_paths, 'UniformOutput', false);
+    end
+    spm_jobman('run', matlabbatch);
+    clear matlabbatch;
+end
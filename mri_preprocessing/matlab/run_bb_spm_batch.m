@@ -0,0 +1,15 @@
+function [output_imgs] = run_bb_spm_batch(img_paths, out_dir, voxel_size, pref)
+    % run_bb_spm on a list of images in a single call, output_imgs{i} is the
+    % resliced img_paths{i}
+    output_imgs = cell(1, numel(img_paths));
+    for i = 1:numel(img_paths)
+        if nargin > 3
+            out = run_bb_spm(convertStringsToChars(img_paths{i}), out_dir, voxel_size, pref);
+        elseif nargin > 2
+            out = run_bb_spm(convertStringsToChars(img_paths{i}), out_dir, voxel_size);
+        else
+            out = run_bb_spm(convertStringsToChars(img_paths{i}), out_dir);
+        end
+        output_imgs{i} = out.pth.im{1};
+    end
+end
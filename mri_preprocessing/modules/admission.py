@@ -0,0 +1,265 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+from mri_preprocessing.modules import sharding
+
+state_name = '__memory_model.json'
+# Prior of the memory used by a subject: a matlab engine (SPM unified segmentation in non_linear_reg) plus a few
+# float copies of the images in python (nii_gmean, averaging) and in matlab. Corrected with the measured peaks.
+engine_bytes = 3 * 1024 ** 3
+bytes_per_voxel = 16
+
+
+def available_memory():
+    """
+    Memory available for new processes in bytes (MemAvailable of /proc/meminfo, None if it cannot be read)
+    """
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        return None
+    return None
+
+
+def parse_budget(budget):
+    """
+    Parameters
+    ----------
+    budget : str or float
+        memory budget in GB or 'auto' for 90% of the memory currently available
+    Returns
+    -------
+    budget : int
+        in bytes
+    """
+    if str(budget) == 'auto':
+        available = available_memory()
+        if available is None:
+            raise ValueError('The available memory cannot be read on this system, give the budget in GB')
+        return int(available * 0.9)
+    try:
+        budget = float(budget)
+    except ValueError:
+        raise ValueError('{} is not a memory budget, give a number of GB or auto'.format(budget))
+    if budget <= 0:
+        raise ValueError('The memory budget must be positive (got {})'.format(budget))
+    return int(budget * 1024 ** 3)
+
+
+def subject_voxels(split_dwi_dict, nb_threads=16):
+    """
+    Voxel count of each subject (the sum of the voxel counts of its images, see sharding.subject_costs). The
+    admission does not need to agree between the nodes: a subject with an unreadable image gets 0 voxels (its
+    estimate is the prior of the engines alone) and fails on its own when it is preprocessed.
+
+    Parameters
+    ----------
+    split_dwi_dict : dict
+        {key: {img_path: bval}}
+    nb_threads : int
+        threads reading the headers
+    Returns
+    -------
+    voxels : dict
+        {key: voxel count}
+    """
+    def _image_voxels(img_path):
+        try:
+            return sharding.image_cost(img_path)
+        except ValueError as e:
+            print(e)
+            return None
+
+    img_paths = sorted({p for key in split_dwi_dict for p in split_dwi_dict[key]})
+    with ThreadPoolExecutor(nb_threads) as executor:
+        img_voxels = dict(zip(img_paths, executor.map(_image_voxels, img_paths)))
+    voxels = {}
+    for key in split_dwi_dict:
+        counts = [img_voxels[p] for p in split_dwi_dict[key]]
+        voxels[key] = 0 if None in counts else sum(counts)
+    return voxels
+
+
+class MemorySampler:
+    """
+    Peak of a memory measure sampled in a background thread between start() and stop()
+
+    Parameters
+    ----------
+    measure : callable
+        measure() returns the current memory use in bytes (or None)
+    interval : float
+        seconds between two samples
+    """
+    def __init__(self, measure, interval=1.0):
+        self.measure = measure
+        self.interval = interval
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        try:
+            value = self.measure()
+        except Exception:
+            value = None
+        if value is not None and (self.peak is None or value > self.peak):
+            self.peak = value
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._sample()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop the sampling and return the peak in bytes (None if nothing could be measured)
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._sample()
+        return self.peak
+
+
+class AdmissionController:
+    """
+    Admission of the subjects preprocessed concurrently within a memory budget. The memory of a subject is estimated
+    from its voxel count (read from the NIfTI headers, see subject_voxels) with a prior (engines * engine_bytes
+    + bytes_per_voxel * voxels) multiplied by a correction factor: the largest ratio between the measured peak and
+    the prior over the last window subjects. The estimates then follow the measured peaks, up or down, and the
+    correction is saved in state_path so the next runs start from it.
+    A subject is always admitted when nothing else is running, even if its estimate is above the budget.
+
+    Parameters
+    ----------
+    budget : int
+        in bytes
+    engines : int
+        matlab engines per subject
+    window : int
+    state_path : pathlike or None
+    """
+    def __init__(self, budget, engines=1, window=20, state_path=None):
+        self.budget = budget
+        self.base_bytes = engines * engine_bytes
+        self.window = window
+        self.state_path = Path(state_path) if state_path is not None else None
+        self.ratios = []
+        self.reserved = {}
+        self._lock = threading.Lock()
+        if self.state_path is not None and self.state_path.is_file():
+            try:
+                with open(self.state_path, 'r') as f:
+                    self.ratios = json.load(f).get('ratios', [])[-window:]
+            except (OSError, ValueError):
+                pass
+
+    def prior(self, voxels):
+        return self.base_bytes + bytes_per_voxel * voxels
+
+    def correction(self):
+        with self._lock:
+            return max(self.ratios) if self.ratios else 1.0
+
+    def estimate(self, voxels):
+        return int(self.prior(voxels) * self.correction())
+
+    def in_use(self):
+        with self._lock:
+            return sum(est for est, _ in self.reserved.values())
+
+    def try_admit(self, key, voxels):
+        """
+        Reserve the estimated memory of a subject if it fits in the budget
+
+        Returns
+        -------
+        admitted : bool
+        """
+        estimate = self.estimate(voxels)
+        with self._lock:
+            used = sum(est for est, _ in self.reserved.values())
+            if self.reserved and used + estimate > self.budget:
+                return False
+            self.reserved[key] = (estimate, voxels)
+        return True
+
+    def release(self, key, peak=None):
+        """
+        Free the memory reserved for a subject and update the correction with its measured peak (in bytes)
+        """
+        with self._lock:
+            _, voxels = self.reserved.pop(key, (0, None))
+            if not peak or voxels is None:
+                return
+            self.ratios = (self.ratios + [peak / (self.base_bytes + bytes_per_voxel * voxels)])[-self.window:]
+            ratios = list(self.ratios)
+        if self.state_path is not None:
+            # several nodes can share the file, each one writes its own temporary file
+            tmp_path = Path(self.state_path.parent, '.{}.{}.tmp'.format(self.state_path.name, os.getpid()))
+            with open(tmp_path, 'w+') as f:
+                json.dump({'ratios': ratios}, f)
+            os.replace(tmp_path, self.state_path)
+
+
+def run_admitted(keys, submit, controller, voxels, max_running, measure=None, max_bypass=4):
+    """
+    Submit the subjects as soon as their estimated memory fits in the budget of the controller. The subjects are
+    considered in order, a subject too large for the memory left waits while the next ones that fit are submitted.
+    Once max_bypass subjects have been submitted ahead of the first waiting subject, no other subject is submitted
+    until it is, so a large subject cannot be starved by a stream of smaller ones.
+
+    Parameters
+    ----------
+    keys : list of str
+    submit : callable
+        submit(key) returns the concurrent.futures.Future of the subject
+    controller : AdmissionController
+    voxels : dict
+        {key: voxel count}
+    max_running : int
+        maximum number of subjects running at the same time (e.g. the number of worker processes)
+    measure : callable or None
+        measure(key, start_time) returns the peak memory of the finished subject in bytes (or None)
+    max_bypass : int
+        number of subjects that can be submitted ahead of the first waiting subject
+    Yields
+    -------
+    (key, future) of every subject, as they finish
+    """
+    pending = list(keys)
+    running = {}
+    # subjects submitted ahead of pending[0]
+    bypassed = 0
+    while pending or running:
+        for key in list(pending):
+            if len(running) >= max_running:
+                break
+            is_head = key == pending[0]
+            if not is_head and bypassed >= max_bypass:
+                break
+            if controller.try_admit(key, voxels[key]):
+                pending.remove(key)
+                bypassed = 0 if is_head else bypassed + 1
+                print('{} admitted (estimated {:.2f}GB, {:.2f}GB of {:.2f}GB reserved)'.format(
+                    key, controller.reserved[key][0] / 1024 ** 3, controller.in_use() / 1024 ** 3,
+                    controller.budget / 1024 ** 3))
+                running[submit(key)] = (key, time.time())
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            key, start_time = running.pop(future)
+            controller.release(key, measure(key, start_time) if measure is not None else None)
+            yield key, future
@@ -1,11 +1,13 @@
 import json
 from pathlib import Path
 import shutil
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 
 import nibabel as nib
 import numpy as np
-from pydicom import datadict
-from mri_preprocessing.modules import matlab_wrappers
+
+from mri_preprocessing.modules import preproc_index, metadata_index, dataset_scanner
 
 
 output_filename_patterns = {
@@ -16,9 +18,16 @@ output_filename_patterns = {
     'def-field': 'y_co-rigid_rigid_geomean_denoise_'
 }
 
+# Prefixes of the summary images (the same as the ones written by matlab_wrappers.images_avg)
+summary_output_prefixes = {
+    'rigid': {'mean': 'rigid_mean', 'std': 'rigid_std'},
+    'affine': {'mean': 'affine_mean', 'std': 'affine_std'},
+    'nonlinear': {'mean': 'nonlinear_mean', 'std': 'non_linear_mean'},
+}
+
 
 def get_attr_from_metadata_dict(metadata_dict, attribute):
-    tag = format(datadict.tag_for_keyword(attribute), '08x').upper()
+    tag = metadata_index.metadata_tag(attribute)
     if tag in metadata_dict:
         return metadata_dict[tag]
     else:
@@ -67,11 +76,12 @@ def check_series(json_path):
     split_dwi_dict = get_split_dict_from_json(json_path)
     singleton_key_list = [s for s in split_dwi_dict if len(split_dwi_dict[s]) == 1]
     non_singleton_key_list = [s for s in split_dwi_dict if len(split_dwi_dict[s]) > 1]
-    series_dict = {get_attr_from_output_dict_key(
-        json_dict, key, 'StudyInstanceUID')['Value'][0]: key for key in non_singleton_key_list}
-    real_singletons_list = [
-        k for k in singleton_key_list if get_attr_from_output_dict_key(
-            json_dict, k, 'StudyInstanceUID')['Value'][0] not in series_dict]
+    index = metadata_index.build_metadata_index(json_dict, singleton_key_list + non_singleton_key_list,
+                                                cache_path=metadata_index.default_cache_path(json_path))
+    series_dict = {metadata_index.attribute_value(index, key, 'StudyInstanceUID'): key
+                   for key in non_singleton_key_list}
+    real_singletons_list = [k for k in singleton_key_list
+                            if metadata_index.attribute_value(index, k, 'StudyInstanceUID') not in series_dict]
     return real_singletons_list
 
 
@@ -96,7 +106,50 @@ def check_output_integrity(output_folder):
     return True
 
 
+class RunningStats:
+    """
+    Voxel-wise mean and standard deviation of a stream of images (Welford's algorithm).
+    Only the running mean and the sum of squared differences are kept in memory. The images must have the shape and
+    the affine of the first image.
+    """
+    def __init__(self, shape, affine):
+        self.shape = tuple(shape)
+        self.affine = affine
+        self.count = 0
+        self.mean = np.zeros(self.shape)
+        self.m2 = np.zeros(self.shape)
+
+    def add(self, data, affine=None):
+        if data.shape != self.shape:
+            raise ValueError('Image shape {} does not match the shape {} of the first image'.format(
+                data.shape, self.shape))
+        if affine is not None and not np.allclose(affine, self.affine, atol=1e-4):
+            raise ValueError('Image affine {} does not match the affine {} of the first image'.format(
+                affine.tolist(), self.affine.tolist()))
+        self.count += 1
+        delta = data - self.mean
+        self.mean += delta / self.count
+        delta *= data - self.mean
+        self.m2 += delta
+
+    def std(self, ddof=1):
+        if self.count <= ddof:
+            return np.zeros(self.shape)
+        return np.sqrt(self.m2 / (self.count - ddof))
+
+
 def average_image_list(images_list, output_path, average_method):
+    if average_method in ['mean', 'std']:
+        stats = None
+        for path in images_list:
+            nii = nib.load(path)
+            if stats is None:
+                stats = RunningStats(nii.shape, nii.affine)
+            stats.add(nii.get_fdata(caching='unchanged'), nii.affine)
+        # np.std is the population standard deviation
+        average_image = stats.mean if average_method == 'mean' else stats.std(ddof=0)
+        nib.save(nib.Nifti1Image(average_image, stats.affine), output_path)
+        return output_path
     nii_list = [nib.load(path) for path in images_list]
 
     average_image = getattr(np, average_method, None)(
@@ -111,15 +164,7 @@ def create_output_average(output_root, average_output_folder_path, output_type,
     output_root = Path(output_root)
     if not output_root.is_dir():
         raise ValueError('{} is not an existing directory'.format(output_root))
-    final_json = Path(output_root, '__final_preproc_dict.json')
-    if final_json.is_file():
-        with open(final_json, 'r') as jfile:
-            output_dict = json.load(jfile)
-    else:
-        output_dict = {}
-        for subfolder in output_root.iterdir():
-            if check_output_integrity(subfolder):
-                output_dict.update(json.load(Path(subfolder, '__preproc_dict.json')))
+    output_dict = preproc_index.load_final_preproc_dict(output_root)
     image_list = []
     for key in output_dict:
         if output_type in output_dict[key]:
@@ -161,18 +206,87 @@ def generate_output_summary_old(output_root, output_folder=None):
     return output_folder
 
 
-def generate_output_summary(output_root, output_folder=None):
+def _load_subject_images(subject_dict, output_types):
+    images = []
+    for output_type in output_types:
+        if output_type not in subject_dict:
+            continue
+        for bval in subject_dict[output_type]:
+            path = subject_dict[output_type][bval]
+            if Path(path).is_file():
+                nii = nib.load(path)
+                images.append((output_type, bval, path, nii.affine, nii.get_fdata(caching='unchanged')))
+    return images
+
+
+def summarise_preproc_outputs(preproc_dict, output_folder, output_types=('rigid', 'affine', 'nonlinear'),
+                              nb_threads=1):
+    """
+    Mean and standard deviation images of every output type and b-value of a preprocessed dataset, computed in a
+    single pass over the subjects (each image is read once) without matlab.
+    Parameters
+    ----------
+    preproc_dict : dict
+        {key: {output_type: {bval: path}}} e.g. the content of __final_preproc_dict.json
+    output_folder : pathlike
+    output_types : sequence of str
+    nb_threads : int
+        number of threads reading the subjects' images in advance
+    Returns
+    -------
+    out_dict : dict
+        {output_type: {'mean': {bval: path}, 'std': {bval: path}}}
+    """
+    if not Path(output_folder).is_dir():
+        raise ValueError('{} does not exist'.format(output_folder))
+    stats_dict = {}
+
+    def accumulate(images):
+        for output_type, bval, path, affine, data in images:
+            key = (output_type, bval)
+            if key not in stats_dict:
+                stats_dict[key] = RunningStats(data.shape, affine)
+            try:
+                stats_dict[key].add(data, affine)
+            except ValueError as e:
+                print('{} is ignored in the summary: {}'.format(path, e))
+
+    subject_dicts = [preproc_dict[key] for key in preproc_dict]
+    if nb_threads > 1:
+        with ThreadPoolExecutor(nb_threads) as executor:
+            # Only a few subjects are read in advance so the memory stays bounded
+            pending = deque()
+            for subject_dict in subject_dicts:
+                pending.append(executor.submit(_load_subject_images, subject_dict, output_types))
+                if len(pending) >= 2 * nb_threads:
+                    accumulate(pending.popleft().result())
+            while pending:
+                accumulate(pending.popleft().result())
+    else:
+        for subject_dict in subject_dicts:
+            accumulate(_load_subject_images(subject_dict, output_types))
+
+    out_dict = {}
+    for (output_type, bval), stats in stats_dict.items():
+        if stats.count == 1:
+            print('Only one image found with b-value {} in the dataset'.format(bval))
+        out_dict.setdefault(output_type, {'mean': {}, 'std': {}})
+        for method, image in [('mean', stats.mean), ('std', stats.std())]:
+            output_path = str(Path(output_folder, summary_output_prefixes[output_type][method] +
+                                   '_b{}.nii'.format(int(float(bval)))))
+            nib.save(nib.Nifti1Image(image.astype(np.float32), stats.affine), output_path)
+            out_dict[output_type][method][bval] = output_path
+    return out_dict
+
+
+def generate_output_summary(output_root, output_folder=None, nb_threads=1):
     output_root = Path(output_root)
     if not output_root.is_dir():
         raise ValueError('{} is not an existing directory'.format(output_root))
-    if not output_folder or not Path(output_folder).is_file():
+    if not output_folder or not Path(output_folder).is_dir():
         output_folder = output_root
-    matlab_wrappers.images_avg(output_root, 'rigid', 'mean', 'rigid_mean', output_folder)
-    matlab_wrappers.images_avg(output_root, 'rigid', 'std', 'rigid_std', output_folder)
-    matlab_wrappers.images_avg(output_root, 'affine', 'mean', 'affine_mean', output_folder)
-    matlab_wrappers.images_avg(output_root, 'affine', 'std', 'affine_std', output_folder)
-    matlab_wrappers.images_avg(output_root, 'nonlinear', 'mean', 'nonlinear_mean', output_folder)
-    matlab_wrappers.images_avg(output_root, 'nonlinear', 'std', 'non_linear_mean', output_folder)
+    final_dict = preproc_index.load_final_preproc_dict(output_root)
+    summarise_preproc_outputs(final_dict, output_folder, nb_threads=nb_threads)
     return output_folder
 
 
@@ -242,18 +356,17 @@ def create_pseudo_input_dict(root_directory, add_non_head_tag=True):
         raise ValueError('{} is not an existing directory'.format(root_directory))
     output_dict_path = Path(root_directory, '__pseudo_final_dict.json')
     final_dict = {}
-    for directory in [d for d in Path(root_directory).rglob('*') if d.is_dir()]:
-        nii_list = [nii for nii in directory.iterdir() if nii.is_file() and (
-                nii.name.endswith('nii') or nii.name.endswith('nii.gz'))]
-        if len(nii_list) > 2:
+    for record in dataset_scanner.walk(root_directory):
+        directory = Path(record.path)
+        if len(record.nifti) > 2:
             raise ValueError('{} contains more than 2 nifti images'.format(directory))
         b0 = None
         b1000 = None
-        for nii in nii_list:
+        for nii in record.nifti:
             if 'b0' in nii.name and 'b1000' not in nii.name:
-                b0 = str(nii)
+                b0 = nii.path
             if 'b1000' in nii.name and 'b0' not in nii.name:
-                b1000 = str(nii)
+                b1000 = nii.path
         if b0 is None or b1000 is None:
             raise ValueError('Cannot find out which file is a b0 and which is the b1000 in {}'.format(directory))
         # If we are here we should have a b0 and a b1000, so we can create the dictionary entry
@@ -0,0 +1,125 @@
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# Prefixes of the preprocessing outputs (legacy denoise names, written by the previous versions of the pipeline)
+stage_prefixes = {
+    'geomean_denoise_': 'denoise',
+    'resliced_co-rigid_rigid_geomean_denoise_': 'rigid',
+    'resliced_co-affine_affine_geomean_denoise_': 'affine',
+    'non_linear_co-rigid_rigid_geomean_denoise_': 'nonlinear',
+    'y_co-rigid_rigid_geomean_denoise_': 'def_field',
+    'iy_co-rigid_rigid_geomean_denoise_': 'inv_def_field',
+}
+
+# NIfTI image found by the scanner: bval is parsed from the name (e.g. ..._bval1000.nii -> 1000.0, None if the name
+# does not contain it) and stage is the output type given by its prefix (see stage_prefixes, None for other images)
+NiftiRecord = namedtuple('NiftiRecord', ['path', 'name', 'bval', 'stage'])
+# Content of a directory: names of its sub-directories and files (sorted), NiftiRecord of its images and whether it
+# contains a __preproc_dict.json
+DirRecord = namedtuple('DirRecord', ['path', 'mtime_ns', 'subdirs', 'files', 'nifti', 'has_preproc_json'])
+
+# absolute path -> DirRecord, a directory is only listed again when its modification time changes
+_dir_cache = {}
+_dir_cache_lock = threading.Lock()
+
+
+def is_nifti_name(name):
+    return name.endswith('.nii') or name.endswith('.nii.gz')
+
+
+def parse_bval(name):
+    stem = name.split('.nii')[0]
+    for marker in ['__bval', 'bval']:
+        if marker in stem:
+            try:
+                return float(stem.split(marker)[-1])
+            except ValueError:
+                return None
+    return None
+
+
+def parse_stage(name):
+    for pref, stage in stage_prefixes.items():
+        if name.startswith(pref):
+            return stage
+    return None
+
+
+def scan_directory(path):
+    """
+    List a directory (not recursive) with os.scandir. The record is cached and reused as long as the modification
+    time of the directory does not change (i.e. no entry was added, removed or renamed in it).
+
+    Parameters
+    ----------
+    path : pathlike
+    Returns
+    -------
+    record : DirRecord
+    """
+    path = os.path.abspath(str(path))
+    # stat before listing: if the directory changes during the listing, the next scan sees a new mtime
+    mtime_ns = os.stat(path).st_mtime_ns
+    with _dir_cache_lock:
+        record = _dir_cache.get(path)
+    if record is not None and record.mtime_ns == mtime_ns:
+        return record
+    subdirs = []
+    files = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.name)
+            else:
+                files.append(entry.name)
+    subdirs.sort()
+    files.sort()
+    nifti = [NiftiRecord(os.path.join(path, name), name, parse_bval(name), parse_stage(name))
+             for name in files if is_nifti_name(name)]
+    record = DirRecord(path, mtime_ns, subdirs, files, nifti, '__preproc_dict.json' in files)
+    with _dir_cache_lock:
+        _dir_cache[path] = record
+    return record
+
+
+def _walk_subtree(path):
+    records = []
+    stack = [path]
+    while stack:
+        record = scan_directory(stack.pop())
+        records.append(record)
+        stack.extend(os.path.join(record.path, d) for d in reversed(record.subdirs))
+    return records
+
+
+def walk(root, nb_threads=8, include_root=False):
+    """
+    Scan every directory under root in a single pass, the sub-trees of the top-level directories being scanned in
+    parallel threads
+
+    Parameters
+    ----------
+    root : pathlike
+    nb_threads : int
+    include_root : bool
+        also return the record of root (like rglob('*'), root is not included by default)
+    Returns
+    -------
+    records : list of DirRecord
+        each top-level directory followed by its sub-directories (depth first)
+    """
+    if not os.path.isdir(str(root)):
+        raise ValueError('{} is not an existing directory'.format(root))
+    root_record = scan_directory(root)
+    top_dirs = [os.path.join(root_record.path, d) for d in root_record.subdirs]
+    records = [root_record] if include_root else []
+    if nb_threads > 1 and len(top_dirs) > 1:
+        with ThreadPoolExecutor(nb_threads) as executor:
+            for subtree in executor.map(_walk_subtree, top_dirs):
+                records.extend(subtree)
+    else:
+        for d in top_dirs:
+            records.extend(_walk_subtree(d))
+    return records
@@ -0,0 +1,366 @@
+import os
+import threading
+from contextlib import contextmanager
+
+import importlib_resources as rsc
+
+
+class EngineTimeout(Exception):
+    """
+    An engine call did not finish in time (hung engine)
+    """
+    pass
+
+
+def _start_matlab(background=False):
+    # matlab.engine takes seconds to import and is not installed everywhere (login nodes, dashboards...), it is
+    # only imported when the first engine is started
+    import matlab.engine
+    return matlab.engine.start_matlab(background=background)
+
+
+def is_engine_failure(error):
+    """
+    Whether an exception comes from the engine itself (dead, terminated or hung engine) rather than from the matlab
+    code, i.e. whether the call can succeed on a fresh engine
+    """
+    # matlab.engine.EngineError and RejectedExecutionError, matched by name so matlab is not imported
+    return isinstance(error, EngineTimeout) or type(error).__name__ in ['EngineError', 'RejectedExecutionError']
+
+
+def process_rss(pid):
+    """
+    Resident memory of a process in bytes (None if it cannot be read, /proc is only available on linux)
+    """
+    try:
+        with open('/proc/{}/status'.format(int(pid)), 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, TypeError):
+        return None
+    return None
+
+
+class EnginePool:
+    """
+    Pool of MATLAB engines started once and shared by every function needing an engine.
+    Engines are configured with the bundled matlab scripts and the toolbox paths (spm, spm_superres and
+    Patient-Preprocessing) before being handed out, so callers do not have to redo the addpath/cd setup.
+    An engine is recycled (quit and replaced by a fresh one when needed) when it is released after max_uses
+    acquisitions (one per subject in the preprocessing) or with a resident memory above max_rss, so the workspace and
+    SPM state do not accumulate over long runs. Idle engines are checked (with a call limited to health_timeout
+    seconds) before being handed out and dead engines are discarded.
+
+    Parameters
+    ----------
+    size : int
+        maximum number of engines running at the same time
+    spm_path : str
+    superres_path : str
+    patient_preproc_path : str
+    max_uses : int or None
+    max_rss : int or None
+        in bytes
+    health_timeout : float
+    """
+    def __init__(self, size=1, spm_path='', superres_path='', patient_preproc_path='', max_uses=None, max_rss=None,
+                 health_timeout=30):
+        self.size = max(int(size), 1)
+        self.toolbox_paths = {
+            'spm': spm_path,
+            'spm_superres': superres_path,
+            'patient_preproc': patient_preproc_path,
+        }
+        self.max_uses = max_uses
+        self.max_rss = max_rss
+        self.health_timeout = health_timeout
+        self.warm_acquisitions = 0
+        self.cold_acquisitions = 0
+        self.engines_started = 0
+        self.engines_recycled = 0
+        self.engines_discarded = 0
+        self._idle = []
+        self._in_use = 0
+        # paths each engine has been configured with, number of acquisitions and matlab process id (indexed with
+        # id(engine))
+        self._configured = {}
+        self._uses = {}
+        self._pids = {}
+        self._cond = threading.Condition()
+
+    def set_toolbox_paths(self, spm_path=None, superres_path=None, patient_preproc_path=None):
+        """
+        Update the toolbox paths. Idle engines are reconfigured the next time they are acquired.
+        """
+        with self._cond:
+            if spm_path is not None:
+                self.toolbox_paths['spm'] = spm_path
+            if superres_path is not None:
+                self.toolbox_paths['spm_superres'] = superres_path
+            if patient_preproc_path is not None:
+                self.toolbox_paths['patient_preproc'] = patient_preproc_path
+
+    def resize(self, size):
+        with self._cond:
+            self.size = max(int(size), 1)
+            self._cond.notify_all()
+
+    def set_lifecycle(self, max_uses=None, max_rss=None, health_timeout=None):
+        """
+        Update the recycling thresholds (see EnginePool), None keeps the current health_timeout
+        """
+        with self._cond:
+            self.max_uses = max_uses
+            self.max_rss = max_rss
+            if health_timeout is not None:
+                self.health_timeout = health_timeout
+
+    def engine_rss(self, engine):
+        """
+        Resident memory of the matlab process of an engine in bytes (None if it cannot be measured)
+        """
+        if id(engine) not in self._pids:
+            try:
+                self._pids[id(engine)] = int(engine.feature('getpid'))
+            except Exception:
+                self._pids[id(engine)] = None
+        return process_rss(self._pids[id(engine)]) if self._pids[id(engine)] is not None else None
+
+    def memory_use(self):
+        """
+        Resident memory of the python process and of the matlab processes of the pool engines in bytes
+        """
+        with self._cond:
+            pids = {os.getpid()} | {pid for pid in list(self._pids.values()) if pid is not None}
+        return sum(process_rss(pid) or 0 for pid in pids)
+
+    def is_alive(self, engine):
+        """
+        Whether the engine answers a trivial call within health_timeout seconds
+        """
+        try:
+            engine.eval('1;', nargout=0, background=True).result(timeout=self.health_timeout)
+            return True
+        except Exception:
+            return False
+
+    def _forget(self, engine):
+        self._configured.pop(id(engine), None)
+        self._uses.pop(id(engine), None)
+        self._pids.pop(id(engine), None)
+
+    def _quit(self, engine):
+        # A hung engine can block quit(), it is done in the background
+        def _run():
+            try:
+                engine.quit()
+            except Exception as e:
+                print('Could not quit a matlab engine: {}'.format(e))
+        threading.Thread(target=_run, daemon=True).start()
+
+    def _configure(self, engine):
+        paths = dict(self.toolbox_paths)
+        if self._configured.get(id(engine)) == paths:
+            return engine
+        engine.addpath(str(rsc.files('mri_preprocessing.matlab')), nargout=0)
+        for p in paths.values():
+            if p:
+                engine.addpath(p, nargout=0)
+        if paths['patient_preproc']:
+            # RunPreproc needs the functions from its private folder
+            engine.cd(paths['patient_preproc'] + '/private', nargout=0)
+        self._configured[id(engine)] = paths
+        # the process id is read once so the memory of the engine can be measured (see memory_use)
+        self.engine_rss(engine)
+        return engine
+
+    def start(self, nb_engines=None):
+        """
+        Start engines (in parallel) until the pool contains nb_engines engines (default: the pool size)
+        """
+        if nb_engines is None:
+            nb_engines = self.size
+        with self._cond:
+            nb_to_start = min(nb_engines, self.size) - (len(self._idle) + self._in_use)
+            if nb_to_start <= 0:
+                return
+            # Reserve the slots so concurrent acquire() calls do not start extra engines
+            self._in_use += nb_to_start
+        futures = [_start_matlab(background=True) for _ in range(nb_to_start)]
+        engines = []
+        error = None
+        try:
+            for future in futures:
+                try:
+                    engines.append(future.result())
+                except Exception as e:
+                    error = error or e
+            if error is None:
+                engines = [self._configure(engine) for engine in engines]
+        except Exception as e:
+            error = e
+        finally:
+            with self._cond:
+                self._in_use -= nb_to_start
+                self._cond.notify_all()
+        if error is not None:
+            # the engines which did start are not kept in a half started pool
+            for engine in engines:
+                self._forget(engine)
+                self._quit(engine)
+            raise error
+        with self._cond:
+            self.engines_started += len(engines)
+            self._idle.extend(engines)
+            self._cond.notify_all()
+
+    def acquire(self):
+        """
+        Borrow an engine from the pool. An idle engine is reused if possible (warm acquisition), otherwise a new
+        engine is started if the pool is not full (cold acquisition). If the pool is full, wait for an engine to be
+        released.
+        """
+        while True:
+            with self._cond:
+                while not self._idle and self._in_use >= self.size:
+                    self._cond.wait()
+                if self._idle:
+                    engine = self._idle.pop()
+                    self._in_use += 1
+                    cold = False
+                else:
+                    engine = None
+                    self._in_use += 1
+                    cold = True
+            if cold or self._check_idle(engine):
+                return self._check_out(engine)
+
+    def try_acquire(self):
+        """
+        Borrow an idle engine without waiting or starting a new one, return None if no engine is idle
+        """
+        while True:
+            with self._cond:
+                if not self._idle:
+                    return None
+                engine = self._idle.pop()
+                self._in_use += 1
+            if self._check_idle(engine):
+                return self._check_out(engine)
+
+    def _check_idle(self, engine):
+        # health check of an idle engine taken by acquire or try_acquire, a dead engine is discarded
+        if self.is_alive(engine):
+            return True
+        print('A matlab engine stopped responding, it is replaced by a new one')
+        self.discard(engine)
+        return False
+
+    def _check_out(self, engine=None):
+        # accounting of acquire and try_acquire, a new engine is started if engine is None (cold acquisition)
+        try:
+            if engine is None:
+                engine = _start_matlab()
+                with self._cond:
+                    self.engines_started += 1
+                    self.cold_acquisitions += 1
+            else:
+                with self._cond:
+                    self.warm_acquisitions += 1
+            with self._cond:
+                self._uses[id(engine)] = self._uses.get(id(engine), 0) + 1
+            return self._configure(engine)
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, engine):
+        """
+        Give an engine back to the pool, it is recycled if it reached max_uses or max_rss
+        """
+        reason = None
+        if self.max_uses is not None and self._uses.get(id(engine), 0) >= self.max_uses:
+            reason = '{} uses'.format(self._uses.get(id(engine), 0))
+        elif self.max_rss is not None:
+            rss = self.engine_rss(engine)
+            if rss is not None and rss > self.max_rss:
+                reason = '{:.1f}GB of memory'.format(rss / 1e9)
+        with self._cond:
+            self._in_use -= 1
+            if reason is None:
+                self._idle.append(engine)
+            else:
+                self.engines_recycled += 1
+                self._forget(engine)
+            self._cond.notify()
+        if reason is not None:
+            print('Recycling a matlab engine after {}'.format(reason))
+            self._quit(engine)
+
+    def discard(self, engine):
+        """
+        Remove a borrowed engine which is dead or hung from the pool (a new engine is started when needed)
+        """
+        with self._cond:
+            self._in_use -= 1
+            self.engines_discarded += 1
+            self._forget(engine)
+            self._cond.notify()
+        self._quit(engine)
+
+    @contextmanager
+    def engine(self):
+        eng = self.acquire()
+        try:
+            yield eng
+        finally:
+            self.release(eng)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'size': self.size,
+                'engines_started': self.engines_started,
+                'warm_acquisitions': self.warm_acquisitions,
+                'cold_acquisitions': self.cold_acquisitions,
+                'engines_recycled': self.engines_recycled,
+                'engines_discarded': self.engines_discarded,
+            }
+
+    def close(self):
+        with self._cond:
+            engines = self._idle
+            self._idle = []
+            self._configured = {}
+            self._uses = {}
+            self._pids = {}
+        for engine in engines:
+            try:
+                engine.quit()
+            except Exception as e:
+                print('Could not quit a matlab engine: {}'.format(e))
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def get_engine_pool(size=None):
+    """
+    Return the engine pool shared by the whole process (created on first call)
+
+    Parameters
+    ----------
+    size : int or None
+        if not None, the pool is resized to contain at most size engines
+    """
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = EnginePool(size if size is not None else 1)
+        elif size is not None:
+            _default_pool.resize(size)
+    return _default_pool
@@ -3,18 +3,8 @@ from pathlib import Path
 import os
 import time
 import json
-import importlib_resources as rsc
 
-import matlab.engine
-from mri_preprocessing.modules import preproc, utils
-from bcblib.tools.nifti_utils import is_nifti
-
-pref_dict = {
-    'geomean_denoise_': 'denoise',
-    'resliced_co-rigid_rigid_geomean_denoise_': 'rigid',
-    'resliced_co-affine_affine_geomean_denoise_': 'affine',
-    'non_linear_co-rigid_rigid_geomean_denoise_': 'nonlinear',
-}
+from mri_preprocessing.modules import engine_pool, matlab_wrappers, preproc_index, dataset_scanner
 
 
 def fill_up_dict_from_folder(output_folder):
@@ -27,34 +17,34 @@ def fill_up_dict_from_folder(output_folder):
         'inv_def_field': {},
     }
     bval_set = set()
-    for f in Path(output_folder).iterdir():
-        if is_nifti(f):
-            bval = f.name.split('__bval')[-1].split('.nii')[0] + '.0'
-            bval_set.add(bval)
-            for pref in pref_dict:
-                if f.name.startswith(pref):
-                    output_dict[pref_dict[pref]][bval] = str(f)
-    for f in Path(output_folder, 'tmp').rglob('*'):
-        if f.name.startswith('y_co-rigid_rigid_geomean_denoise_'):
-            output_dict['def_field'] = {b: str(f) for b in bval_set}
-        elif f.name.startswith('iy_co-rigid_rigid_geomean_denoise_'):
-            output_dict['inv_def_field'] = {b: str(f) for b in bval_set}
+    for nii in dataset_scanner.scan_directory(output_folder).nifti:
+        bval = nii.name.split('__bval')[-1].split('.nii')[0] + '.0' if nii.bval is None else str(nii.bval)
+        bval_set.add(bval)
+        if nii.stage in output_dict and nii.stage not in ['def_field', 'inv_def_field']:
+            output_dict[nii.stage][bval] = nii.path
+    if Path(output_folder, 'tmp').is_dir():
+        for record in dataset_scanner.walk(Path(output_folder, 'tmp'), nb_threads=1, include_root=True):
+            for nii in record.nifti:
+                if nii.stage in ['def_field', 'inv_def_field']:
+                    output_dict[nii.stage] = {b: nii.path for b in bval_set}
     return output_dict
 
 
-def apply_transform_dataset(root_folder, output_vox_size=2):
-    matlab_scripts_folder = rsc.files('mri_preprocessing.matlab')
+def _subject_folders(root_folder):
+    """
+    Subject folders of an output root: its top-level directories except the bookkeeping ones (tmp, errors, __leases,
+    __shards, hidden directories...)
+    """
+    if not Path(root_folder).is_dir():
+        raise ValueError('{} is not an existing directory'.format(root_folder))
+    record = dataset_scanner.scan_directory(root_folder)
+    return [Path(record.path, d) for d in record.subdirs
+            if d not in ['tmp', 'errors'] and not d.startswith('__') and not d.startswith('.')]
 
-    engine = matlab.engine.start_matlab()
-    engine.addpath(str(matlab_scripts_folder))
-    # Just in case we add all of them
-    engine.addpath(preproc.spm_path)
-    engine.addpath(preproc.superres_path)
-    engine.addpath(preproc.patient_preproc_path)
 
-    missing_reg_folders = [d for d in Path(root_folder).rglob('*')
-                           if d.is_dir() and '__preproc_dict.json' not in [f.name for f in d.iterdir()] and
-                           d.name != 'tmp']
+def apply_transform_dataset(root_folder, output_vox_size=2):
+    missing_reg_folders = [d for d in _subject_folders(root_folder)
+                           if not dataset_scanner.scan_directory(d).has_preproc_json]
     partial_final_preproc_dict = {}
     for d in missing_reg_folders:
         key = Path(d).name
@@ -62,13 +52,19 @@ def apply_transform_dataset(root_folder, output_vox_size=2):
         # print(preproc_dict)
         # return
         if preproc_dict['rigid'] != {} and preproc_dict['def_field'] != {}:
+            # one apply_transform_batch call per deformation field (the same for all the b-values of a subject)
+            bvals_per_def_field = {}
             for bval in preproc_dict['rigid']:
-                original_rigid = preproc_dict['rigid'][bval].replace('resliced_', 'tmp/')
-                output_img = engine.apply_transform(original_rigid, preproc_dict['def_field'][bval],
-                                                    output_vox_size)
-                output_img_new_path = Path(d, Path(output_img).name)
-                shutil.copyfile(output_img, output_img_new_path)
-                preproc_dict['nonlinear'][bval] = str(output_img_new_path)
+                bvals_per_def_field.setdefault(preproc_dict['def_field'][bval], []).append(bval)
+            with engine_pool.get_engine_pool().engine() as engine:
+                for def_field, bvals in bvals_per_def_field.items():
+                    original_rigids = [preproc_dict['rigid'][bval].replace('resliced_', 'tmp/') for bval in bvals]
+                    output_imgs = matlab_wrappers.apply_transform_batch(engine, original_rigids, def_field,
+                                                                        output_vox_size)
+                    for bval, output_img in zip(bvals, output_imgs):
+                        output_img_new_path = Path(d, Path(output_img).name)
+                        shutil.copyfile(output_img, output_img_new_path)
+                        preproc_dict['nonlinear'][bval] = str(output_img_new_path)
             partial_final_preproc_dict[key] = preproc_dict
         with open(Path(d, '__preproc_dict.json'), 'w+') as j:
             json.dump({key: preproc_dict}, j, indent=4)
@@ -77,6 +73,6 @@ def apply_transform_dataset(root_folder, output_vox_size=2):
     #     partial_final_preproc_dict.update(final_preproc_dict)
     # with open(Path(root_folder, '__final_preproc_dict.json'), 'w+') as j:
     #     json.dump(partial_final_preproc_dict, j, indent=4)
-    utils.generate_final_preproc_dict(root_folder)
+    preproc_index.PreprocIndex(root_folder).update([Path(d).name for d in missing_reg_folders])
     return partial_final_preproc_dict
 
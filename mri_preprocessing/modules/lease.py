@@ -0,0 +1,193 @@
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from pathlib import Path
+
+lease_dir_name = '__leases'
+
+# output root -> LeaseManager of the process
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+class LeaseLost(Exception):
+    """
+    The lease of a subject expired and was reclaimed by another worker while it was being preprocessed
+    """
+    pass
+
+
+class LeaseManager:
+    """
+    Leases on the subjects of an output root shared by several nodes: a subject is only preprocessed by the worker
+    holding its lease (output_root/__leases/<key>.lease). The lease files are created atomically (O_CREAT | O_EXCL)
+    and their modification time is refreshed by a heartbeat thread while they are held. A lease not refreshed for
+    more than ttl seconds (crashed or killed worker) is expired and can be reclaimed by another worker.
+    The expiry uses the clock of the worker, the clocks of the nodes should not drift by more than a fraction of ttl.
+    A lease found reclaimed by another worker is marked as lost: check(key) then raises LeaseLost so the worker stops
+    writing in the subject folder.
+
+    Parameters
+    ----------
+    output_root : pathlike
+    ttl : float
+        seconds after which a lease that was not refreshed is expired
+    heartbeat_interval : float or None
+        seconds between two refreshes of the held leases, default ttl / 4
+    owner : str or None
+        identifier written in the lease files, default hostname:pid:random id
+    """
+    def __init__(self, output_root, ttl=600, heartbeat_interval=None, owner=None):
+        self.lease_dir = Path(output_root, lease_dir_name)
+        os.makedirs(self.lease_dir, exist_ok=True)
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval if heartbeat_interval is not None else ttl / 4
+        self.owner = owner or '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self._held = set()
+        self._lost = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _path(self, key):
+        return Path(self.lease_dir, '{}.lease'.format(key))
+
+    def _create(self, path):
+        try:
+            fd = os.open(str(path), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'owner': self.owner, 'acquired': time.time()}, f)
+        return True
+
+    def _read(self, path):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f).get('owner')
+        except (OSError, ValueError):
+            # being written or deleted
+            return None
+
+    def is_expired(self, key):
+        try:
+            return time.time() - os.stat(self._path(key)).st_mtime > self.ttl
+        except FileNotFoundError:
+            return True
+
+    def is_leased(self, key):
+        """
+        Whether a worker (this one included) holds a valid lease on key
+        """
+        return not self.is_expired(key)
+
+    def _reclaim(self, path):
+        # The expired lease is moved away with an atomic rename so only one worker can reclaim it
+        owner = self._read(path)
+        tombstone = Path(self.lease_dir, '.{}.{}.expired'.format(path.name, uuid.uuid4().hex[:8]))
+        try:
+            os.rename(str(path), str(tombstone))
+        except FileNotFoundError:
+            return
+        if self._read(tombstone) != owner or time.time() - os.stat(tombstone).st_mtime <= self.ttl:
+            # Another worker reclaimed the lease between the check and the rename: its new lease is put back
+            try:
+                os.link(str(tombstone), str(path))
+            except OSError:
+                pass
+        else:
+            print('Expired lease of {} ({}) reclaimed by {}'.format(path.stem, owner, self.owner))
+        os.unlink(str(tombstone))
+
+    def acquire(self, key):
+        """
+        Try to take the lease of key (without waiting)
+
+        Returns
+        -------
+        acquired : bool
+            False if another worker holds a valid lease on key
+        """
+        path = self._path(key)
+        with self._lock:
+            if key in self._held:
+                return True
+        if not self._create(path):
+            if not self.is_expired(key):
+                return False
+            self._reclaim(path)
+            if not self._create(path):
+                return False
+        with self._lock:
+            self._held.add(key)
+            self._lost.discard(key)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._heartbeat, daemon=True)
+                self._thread.start()
+        return True
+
+    def is_lost(self, key):
+        with self._lock:
+            return key in self._lost
+
+    def check(self, key):
+        """
+        Raise LeaseLost if the lease of key was reclaimed by another worker
+        """
+        if self.is_lost(key):
+            raise LeaseLost('The lease of {} was reclaimed by another worker'.format(key))
+
+    def release(self, key):
+        with self._lock:
+            self._lost.discard(key)
+            if key not in self._held:
+                return
+            self._held.discard(key)
+        path = self._path(key)
+        if self._read(path) == self.owner:
+            try:
+                os.unlink(str(path))
+            except FileNotFoundError:
+                pass
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.heartbeat_interval):
+            with self._lock:
+                held = list(self._held)
+            for key in held:
+                path = self._path(key)
+                if self._read(path) != self.owner:
+                    print('The lease of {} was lost by {} (expired and reclaimed by another worker)'.format(
+                        key, self.owner))
+                    with self._lock:
+                        self._held.discard(key)
+                        self._lost.add(key)
+                    continue
+                try:
+                    os.utime(str(path))
+                except FileNotFoundError:
+                    pass
+
+    def close(self):
+        """
+        Release every held lease and stop the heartbeat
+        """
+        with self._lock:
+            held = list(self._held)
+        for key in held:
+            self.release(key)
+        self._stop.set()
+
+
+def get_lease_manager(output_root, ttl=600):
+    """
+    Return the LeaseManager of the process for output_root (created on first call)
+    """
+    root = os.path.abspath(str(output_root))
+    with _managers_lock:
+        if root not in _managers:
+            _managers[root] = LeaseManager(root, ttl)
+        return _managers[root]
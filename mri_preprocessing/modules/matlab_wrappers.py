@@ -1,13 +1,15 @@
 from pathlib import Path
 import shutil
 import os
-import json
-import importlib_resources as rsc
+import sys
 
 import numpy as np
-import matlab.engine
 import nibabel as nib
 
+from mri_preprocessing.modules import engine_pool, toolbox_config, preproc_index
+
+_module_toolboxes = {f: t for t, f in toolbox_config.toolbox_functions.items()}
+
 
 def reset_orient_mat(engine, img_path, output):
     img_path = Path(img_path)
@@ -54,11 +56,86 @@ def run_bb_spm(engine, img_path, output_folder, voxel_size):
     return engine.run_bb_spm(str(img_path), str(output_folder), voxel_size)['pth']['im'][0]
 
 
-def matlab_check_module_path(engine, module_name):
+def run_bb_spm_batch(engine, img_paths, output_folder, voxel_size, pref='resliced_'):
+    """
+    Reslice a list of images to the SPM bounding box in a single engine call
+
+    Parameters
+    ----------
+    engine : matlab engine
+    img_paths : list of pathlike
+    output_folder : pathlike
+    voxel_size : float
+    pref : str
+        prefix of the output images
+    Returns
+    -------
+    output_paths : list of str
+        in the same order as img_paths
+    """
+    for img_path in img_paths:
+        if not Path(img_path).is_file():
+            raise ValueError('{} does not exist'.format(img_path))
+    if not Path(output_folder).is_dir():
+        raise ValueError('{} does not exist'.format(output_folder))
+    if not img_paths:
+        return []
+    return list(engine.run_bb_spm_batch([str(p) for p in img_paths], str(output_folder), voxel_size, pref))
+
+
+def apply_transform_batch(engine, img_paths, def_field, voxel_size=2, pref='non_linear_'):
+    """
+    Apply a deformation field to a list of images in a single SPM job (the outputs are written next to the inputs)
+
+    Parameters
+    ----------
+    engine : matlab engine
+    img_paths : list of pathlike
+    def_field : pathlike
+        deformation field shared by all the images
+    voxel_size : float
+    pref : str
+        prefix of the output images
+    Returns
+    -------
+    output_paths : list of str
+        in the same order as img_paths
+    """
+    for p in list(img_paths) + [def_field]:
+        if not Path(p).is_file():
+            raise ValueError('{} does not exist'.format(p))
+    if not img_paths:
+        return []
+    return list(engine.apply_transform_batch([str(p) for p in img_paths], str(def_field), voxel_size, pref))
+
+
+def toolbox_version(engine):
+    """
+    Version and revision of SPM in the engine (e.g. 'SPM12-7771'), '' if it cannot be found
+    """
+    try:
+        return '-'.join(str(v) for v in engine.spm('Ver', nargout=2))
+    except Exception as e:
+        print('Could not get the SPM version: {}'.format(e))
+        return ''
+
+
+def matlab_check_module_path(engine, module_name, interactive=None):
+    """
+    Folder of module_name in the matlab path. If it is not found and interactive is True (default: if stdin is a
+    terminal), the user is asked for the path, otherwise None is returned.
+    """
     which = engine.which(module_name)
     if which:
         return str(Path(which).parent)
     print('{} was not found in matlab path'.format(module_name))
+    if interactive is None:
+        interactive = sys.stdin is not None and sys.stdin.isatty()
+    if not interactive:
+        print('Set the {} environment variable or add the path to {}'.format(
+            toolbox_config.env_variables.get(_module_toolboxes.get(module_name), 'MRI_PREPROC_*_PATH'),
+            toolbox_config.config_path()))
+        return None
     path = input("You can either add the path to your startup.m (edit(fullfile(userpath,'startup.m')) in matlab or "
                  "you can enter the path to the module here. [n no or enter to skip/ quit or exit stop the "
                  "program]: ")
@@ -78,7 +155,7 @@ def images_avg(preproc_output_root, reg_type, method, output_pref, output_folder
         raise ValueError('{} does not exist'.format(preproc_output_root))
     if not Path(output_folder).is_dir():
         raise ValueError('{} does not exist'.format(output_folder))
-    final_dict = json.load(open(Path(preproc_output_root, '__final_preproc_dict.json')))
+    final_dict = preproc_index.load_final_preproc_dict(preproc_output_root)
     bval_dict = {}
     for key in final_dict:
         for bval in final_dict[key]['denoise']:
@@ -103,10 +180,8 @@ def images_avg(preproc_output_root, reg_type, method, output_pref, output_folder
                 nii = nib.load(img_list[0])
                 nib.save(nib.Nifti1Image(np.zeros(nii.shape), nii.affine), output_path)
         else:
-            engine = matlab.engine.start_matlab()
-            matlab_scripts_folder = rsc.files('mri_preprocessing.matlab')
-            engine.addpath(str(matlab_scripts_folder))
-            output_path = engine.images_avg(img_list, method.lower(), str(output_folder),
-                                            output_pref + '_b{}'.format(int(float(bval))))
+            with engine_pool.get_engine_pool().engine() as engine:
+                output_path = engine.images_avg(img_list, method.lower(), str(output_folder),
+                                                output_pref + '_b{}'.format(int(float(bval))))
         out_dict[bval] = output_path
     return out_dict
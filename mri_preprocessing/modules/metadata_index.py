@@ -0,0 +1,127 @@
+import json
+import os
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+
+from pydicom import datadict
+
+cache_name = '__metadata_index.json'
+
+
+@lru_cache(maxsize=None)
+def metadata_tag(attribute):
+    """
+    Tag of a DICOM keyword as written in the metadata json files (e.g. 'StudyInstanceUID' -> '0020000D')
+    """
+    tag = datadict.tag_for_keyword(attribute)
+    if tag is None:
+        raise ValueError('{} is not a DICOM keyword'.format(attribute))
+    return format(tag, '08x').upper()
+
+
+def default_cache_path(json_path):
+    """
+    Metadata index cache of an input dictionary: saved next to it (json_path folder/__metadata_index.json)
+    """
+    return Path(Path(json_path).parent, cache_name)
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _read_attributes(path, tags):
+    with open(path, 'r') as f:
+        metadata = json.load(f)
+    return {tag: metadata.get(tag) for tag in tags}
+
+
+def build_metadata_index(json_dict, keys=None, attributes=('StudyInstanceUID',), cache_path=None, nb_threads=16):
+    """
+    Read the given attributes from the metadata files of the keys of an input dictionary (e.g.
+    __final_image_dict.json). The files are read in parallel threads and only the queried attributes are kept.
+    If cache_path is given, the attributes are cached there and a metadata file is only read again if its size or
+    modification time changed.
+
+    Parameters
+    ----------
+    json_dict : dict
+        {key: {'metadata': metadata json path, ...}}
+    keys : list of str or None
+        keys to index (default: all the keys of json_dict)
+    attributes : sequence of str
+        DICOM keywords
+    cache_path : pathlike or None
+    nb_threads : int
+    Returns
+    -------
+    index : dict
+        {key: {attribute: metadata element (e.g. {'vr': 'UI', 'Value': [...]}) or None}}
+    """
+    if keys is None:
+        keys = list(json_dict)
+    tags = sorted({metadata_tag(a) for a in attributes})
+    metadata_paths = {}
+    for key in keys:
+        if key not in json_dict:
+            raise ValueError('{} not in output_dict'.format(key))
+        if 'metadata' not in json_dict[key]:
+            raise ValueError('the output subdictionary does not contain a metadata file path')
+        metadata_paths[key] = str(json_dict[key]['metadata'])
+    cache = {}
+    if cache_path is not None and Path(cache_path).is_file():
+        try:
+            with open(cache_path, 'r') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+    paths = sorted(set(metadata_paths.values()))
+    # On network storage even the stat calls are worth running in parallel
+    with ThreadPoolExecutor(max(nb_threads, 1)) as executor:
+        stats = dict(zip(paths, executor.map(_stat, paths)))
+        for path in paths:
+            if stats[path] is None:
+                raise ValueError('{} is not an existing metadata file'.format(path))
+        to_read = [p for p in paths if p not in cache or cache[p]['stat'] != stats[p] or
+                   any(t not in cache[p]['attributes'] for t in tags)]
+        for path, values in zip(to_read, executor.map(lambda p: _read_attributes(p, tags), to_read)):
+            attributes_cache = cache[path]['attributes'] if path in cache and cache[path]['stat'] == stats[path] \
+                else {}
+            attributes_cache.update(values)
+            cache[path] = {'stat': stats[path], 'attributes': attributes_cache}
+    if cache_path is not None and to_read:
+        # the shards of a run (on several nodes) can build the index at the same time, each one writes its own
+        # temporary file
+        tmp_path = Path(Path(cache_path).parent, '.{}.{}.tmp'.format(Path(cache_path).name, uuid.uuid4().hex))
+        try:
+            with open(tmp_path, 'w+') as f:
+                json.dump(cache, f)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print('Could not save the metadata index in {}: {}'.format(cache_path, e))
+    return {key: {a: cache[path]['attributes'][metadata_tag(a)] for a in attributes}
+            for key, path in metadata_paths.items()}
+
+
+def attribute_value(index, key, attribute):
+    """
+    First value of the attribute of key in a metadata index (e.g. the StudyInstanceUID)
+    """
+    return index[key][attribute]['Value'][0]
+
+
+def group_by(index, keys, attribute):
+    """
+    {attribute value: [keys]} (keys in the order given)
+    """
+    groups = defaultdict(list)
+    for key in keys:
+        groups[attribute_value(index, key, attribute)].append(key)
+    return dict(groups)
@@ -0,0 +1,193 @@
+# Python version of matlab/reset_orient_mat.m (nm_reorient + do_reset_origin from Patient-Preprocessing) which
+# does not need a matlab engine
+import gzip
+import shutil
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import nibabel as nib
+from nibabel.volumeutils import array_to_file
+from scipy import ndimage
+
+
+def _matlab_round(x):
+    return np.sign(x) * np.floor(np.abs(x) + 0.5)
+
+
+def _translation(t):
+    m = np.eye(4)
+    m[:3, 3] = t
+    return m
+
+
+def reoriented_grid(affine, shape):
+    """
+    Output grid of nm_reorient (voxel size of the input, axes along the world axes)
+    Parameters
+    ----------
+    affine : 4x4 array
+        nibabel (0-based) affine of the image
+    shape : tuple
+    Returns
+    -------
+    mat : 4x4 array
+        spm (1-based) voxel to world matrix of the reoriented image
+    dim : 3-tuple of int
+    """
+    m = affine.dot(_translation(-1))
+    d = np.array(shape[:3])
+    corners = np.array([[x, y, z, 1] for x in (1, d[0]) for y in (1, d[1]) for z in (1, d[2])]).T
+    tc = m[:3].dot(corners)
+    mx = _matlab_round(tc.max(axis=1))
+    mn = _matlab_round(tc.min(axis=1))
+    vx = np.sqrt(np.sum(m[:3, :3] ** 2, axis=0))
+    mat = _translation(mn).dot(np.diag(list(vx) + [1])).dot(_translation(-1))
+    # like nm_reorient: ceil(mat\[mx 1]'-0.1)
+    dim = np.ceil(np.linalg.inv(mat).dot(list(mx) + [1])[:3] - 0.1).astype(int)
+    return mat, tuple(dim)
+
+
+def reset_origin_affine(vox_size, dim):
+    """
+    nibabel (0-based) affine set by do_reset_origin: origin in the centre of the image
+    """
+    vox_size = np.abs(np.array(vox_size, dtype=float))
+    m = np.diag(list(vox_size) + [1])
+    # spm places the origin at (dim + 1) / 2 in 1-based voxel coordinates
+    m[:3, 3] = -vox_size * (np.array(dim) + 1) / 2
+    return m.dot(_translation(1))
+
+
+def _signed_permutation(r, tol=1e-4):
+    """
+    If r (3x3) is a signed permutation matrix, return (perm, flips) such that output axis k is input axis perm[k]
+    (flipped if flips[k]), None otherwise
+    """
+    r_round = np.round(r)
+    if not np.allclose(r, r_round, atol=tol) or not np.array_equal(np.abs(r_round).sum(axis=0), [1, 1, 1]) or \
+            not np.array_equal(np.abs(r_round).sum(axis=1), [1, 1, 1]):
+        return None
+    perm = [int(np.argmax(np.abs(r_round[:, k]))) for k in range(3)]
+    flips = [r_round[perm[k], k] < 0 for k in range(3)]
+    return perm, flips
+
+
+def _write_header(path, header):
+    # the header block has a fixed size, the extensions and the data are left untouched
+    with open(path, 'r+b') as f:
+        f.write(header.binaryblock)
+
+
+def _pair_image_path(hdr_path):
+    # .img file of a .hdr/.img pair
+    return Path(hdr_path).with_suffix('.img')
+
+
+def _copy_uncompressed(img_path, output_path):
+    if str(img_path).endswith('.gz'):
+        with gzip.open(img_path, 'rb') as src, open(output_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+    else:
+        shutil.copyfile(img_path, output_path)
+
+
+def reset_orient_mat(img_path, output_folder, prefix='reo_'):
+    """
+    Reorient the image to the transverse orientation and reset its origin to the centre of the image
+
+    Parameters
+    ----------
+    img_path : pathlike
+    output_folder : pathlike
+    prefix : str
+    Returns
+    -------
+    output_path : str
+        output_folder/prefix + image name (always uncompressed like with matlab_wrappers.reset_orient_mat)
+
+    Notes
+    -----
+    nm_reorient rounds the bounding box of the image to the millimetre, which can shift the output grid by a
+    fraction of voxel. As the origin is reset afterwards, this shift is not reproduced when the axes only need to be
+    permuted or flipped (the voxel values are kept as they are instead of being interpolated).
+    """
+    img_path = Path(img_path)
+    if not img_path.is_file():
+        raise ValueError('{} does not exist'.format(img_path))
+    if not Path(output_folder).is_dir():
+        raise ValueError('{} does not exist'.format(output_folder))
+    name = img_path.name[:-len('.gz')] if img_path.name.endswith('.gz') else img_path.name
+    output_path = Path(output_folder, prefix + name)
+    img = nib.load(img_path)
+    header = img.header.copy()
+    # the header and the data of .hdr/.img pairs are in separate files
+    single_file = header.get('magic') == b'n+1'
+    pair = header.get('magic') == b'ni1'
+    # nibabel moves the scaling and the data offset of the loaded images from the header to the data proxy
+    header.set_slope_inter(img.dataobj.slope, img.dataobj.inter)
+    header['vox_offset'] = img.dataobj.offset
+    shape = img.shape
+    mat, dim = reoriented_grid(img.affine, shape)
+    # mapping from the 1-based output voxels to the 1-based input voxels
+    r = np.linalg.inv(img.affine.dot(_translation(-1))).dot(mat)
+    vox_size = np.sqrt(np.sum(mat[:3, :3] ** 2, axis=0))
+    perm_flips = _signed_permutation(r[:3, :3])
+    if perm_flips is not None and (single_file or pair) and perm_flips[0] == [0, 1, 2] and not any(perm_flips[1]):
+        # Already in the right orientation: only the header changes
+        new_affine = reset_origin_affine(vox_size, shape[:3])
+        header.set_sform(new_affine, code='aligned')
+        header.set_qform(new_affine, code='aligned')
+        if single_file:
+            _copy_uncompressed(img_path, output_path)
+            _write_header(output_path, header)
+        else:
+            _copy_uncompressed(img.file_map['image'].filename, _pair_image_path(output_path))
+            with open(output_path, 'wb') as f:
+                header.write_to(f)
+    elif perm_flips is not None and (single_file or pair):
+        # The axes only need to be permuted/flipped, the raw values are written with the original scaling
+        perm, flips = perm_flips
+        raw = np.asanyarray(img.dataobj.get_unscaled())
+        data = np.transpose(raw, perm + list(range(3, raw.ndim)))
+        data = data[tuple(slice(None, None, -1) if f else slice(None) for f in flips)]
+        new_affine = reset_origin_affine(vox_size, data.shape[:3])
+        header.set_data_shape(data.shape)
+        header.set_zooms(tuple(vox_size) + tuple(header.get_zooms()[3:]))
+        header.set_sform(new_affine, code='aligned')
+        header.set_qform(new_affine, code='aligned')
+        with open(output_path, 'wb') as f:
+            header.write_to(f)
+            if single_file:
+                array_to_file(data, f, header.get_data_dtype(), offset=header.get_data_offset(), order='F')
+        if pair:
+            with open(_pair_image_path(output_path), 'wb') as f:
+                array_to_file(data, f, header.get_data_dtype(), offset=header.get_data_offset(), order='F')
+    else:
+        # Oblique (or Analyze) image: resliced with trilinear interpolation on the world axes like nm_reorient
+        data = img.get_fdata(caching='unchanged', dtype=np.float32)
+        matrix = r[:3, :3]
+        # 0-based output voxel j maps to 0-based input voxel: r3 (j + 1) + t - 1
+        offset = matrix.dot(np.ones(3)) + r[:3, 3] - 1
+        resliced = ndimage.affine_transform(data, matrix, offset, output_shape=dim, order=1, mode='constant', cval=0)
+        new_affine = reset_origin_affine(vox_size, dim)
+        header.set_data_dtype(np.float32)
+        out = nib.Nifti1Image(resliced, new_affine, header)
+        out.set_sform(new_affine, code='aligned')
+        out.set_qform(new_affine, code='aligned')
+        nib.save(out, output_path)
+    return str(output_path)
+
+
+def reset_orient_mat_batch(img_paths, output_folder, prefix='reo_', nb_threads=1):
+    """
+    reset_orient_mat on a list of images (in parallel threads if nb_threads > 1)
+    Returns
+    -------
+    output_paths : list of str
+        in the same order as img_paths
+    """
+    if nb_threads > 1 and len(img_paths) > 1:
+        with ThreadPoolExecutor(nb_threads) as executor:
+            return list(executor.map(lambda p: reset_orient_mat(p, output_folder, prefix), img_paths))
+    return [reset_orient_mat(p, output_folder, prefix) for p in img_paths]
@@ -3,35 +3,56 @@ from pathlib import Path
 import os
 import time
 import json
-import importlib_resources as rsc
+import threading
 
-import matlab.engine
-from multiprocessing.dummy import Pool as ThreadPool
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import multiprocessing
 import nibabel as nib
-from scipy.stats import gmean
 import numpy as np
-from mri_preprocessing.modules import data_access, matlab_wrappers
+from mri_preprocessing.modules import data_access, matlab_wrappers, engine_pool, step_cache, stage_manifest, \
+    orientation, scheduler, toolbox_config, metadata_index, tracing, resample, lease, sharding, admission
 
 spm_path = ''
 superres_path = ''
 patient_preproc_path = ''
+# Backends of the reslicing and of the deformation field application: 'matlab' (SPM in the engines) or 'native'
+# (resample module, in python threads)
+backends = ['matlab', 'native']
+# Orchestration of the steps of a subject: 'sync' (scheduler.run_dag) or 'asyncio' (scheduler.run_dag_async)
+orchestrations = ['sync', 'asyncio']
 
 
-def check_spm_modules():
-    engine = matlab.engine.start_matlab()
-    which = matlab_wrappers.matlab_check_module_path(engine, 'spm')
-    if which:
-        global spm_path
-        spm_path = which
-    which = matlab_wrappers.matlab_check_module_path(engine, 'spm_superres')
-    if which:
-        global superres_path
-        superres_path = which
-    which = matlab_wrappers.matlab_check_module_path(engine, 'RunPreproc')
-    if which:
-        global patient_preproc_path
-        patient_preproc_path = which
+def check_spm_modules(interactive=None):
+    """
+    Resolve the paths of spm, spm_superres and Patient-Preprocessing and give them to the engine pool.
+    The paths are read from the environment variables or the config file (see toolbox_config) and a matlab engine is
+    only started to look for the missing ones (with `which`), the paths found are then saved in the config file.
+
+    Parameters
+    ----------
+    interactive : bool or None
+        ask the user for the paths not found by matlab (default: only if stdin is a terminal)
+    """
+    global spm_path, superres_path, patient_preproc_path
+    pool = engine_pool.get_engine_pool()
+    paths = toolbox_config.load_toolbox_paths()
+    missing = [t for t in toolbox_config.toolbox_functions if t not in paths]
+    if missing:
+        found = {}
+        with pool.engine() as engine:
+            for toolbox in missing:
+                which = matlab_wrappers.matlab_check_module_path(
+                    engine, toolbox_config.toolbox_functions[toolbox], interactive)
+                if which:
+                    found[toolbox] = which
+        if found:
+            toolbox_config.save_toolbox_paths(found)
+            paths.update(found)
+    spm_path = paths.get('spm', spm_path)
+    superres_path = paths.get('spm_superres', superres_path)
+    patient_preproc_path = paths.get('patient_preproc', patient_preproc_path)
+    # Every engine borrowed from the pool will now have the modules in its path
+    pool.set_toolbox_paths(spm_path, superres_path, patient_preproc_path)
 
 
 def format_filename(filename, bval):
@@ -42,42 +63,89 @@ def format_filename(filename, bval):
 
 
 # TODO IMPORTANT we want to gmean only the images with THE SAME BVAL
-def nii_gmean(nii_array, output_path):
+def nii_gmean(nii_array, output_path, dtype=np.float64, nonpositive='zero', slab_size=None):
     """
-    IMPORTANT: the images affine must be the same as the output affine will be taken only from the first image
+    Voxel-wise geometric mean of images sharing the same affine and shape.
+    The log of the images is accumulated one volume (or one slab of slices) at a time so the peak memory stays
+    around two volumes whatever the number of images.
     Parameters
     ----------
     nii_array : arraylike of nibabel.Nifti1Image or arraylike of image paths
     output_path : str
         path to the output image (will be created / overwritten)
+    dtype : numpy float dtype
+        dtype of the accumulator and of the output image (np.float32 halves the memory used)
+    nonpositive : str
+        what to do with the voxels equal to zero or negative in at least one image:
+        'zero' sets them to 0 in the output, 'nan' sets them to NaN and 'error' raises a ValueError
+    slab_size : int or None
+        if not None, the images are read by slabs of slab_size slices (along the third axis) instead of whole volumes
     Returns
     -------
         output_path : str
             if nii_array contained only one image, this image will simply be copied in output_path
     """
+    if nonpositive not in ['zero', 'nan', 'error']:
+        raise ValueError('nonpositive must be one of "zero", "nan" or "error" (not {})'.format(nonpositive))
     if len(nii_array) == 1:
-        if isinstance(nii_array, nib.Nifti1Image):
+        if isinstance(nii_array[0], nib.Nifti1Image):
             shutil.copyfile(nii_array[0].get_filename(), output_path)
             return str(output_path)
         else:
             shutil.copyfile(Path(nii_array[0]), output_path)
             return str(output_path)
-    for ind, n in enumerate(nii_array):
+    nii_list = []
+    for n in nii_array:
         if not isinstance(n, nib.Nifti1Image):
             p = Path(n)
             if p.is_file():
-                nii_array[ind] = nib.load(p)
+                n = nib.load(p)
             else:
                 raise ValueError('The array must contain either existing file paths or nibabel.Nifti1Image objects')
-    data = np.stack(np.array([nii.get_fdata() for nii in nii_array]), axis=3)
+        nii_list.append(n)
+    ref = nii_list[0]
+    for nii in nii_list[1:]:
+        if nii.shape != ref.shape:
+            raise ValueError('Cannot compute the geometric mean of images with different shapes ({} and {})'.format(
+                ref.shape, nii.shape))
+        if not np.allclose(nii.affine, ref.affine, atol=1e-4):
+            raise ValueError('Cannot compute the geometric mean of images with different affines ({} and {})'.format(
+                ref.get_filename(), nii.get_filename()))
+
+    log_sum = np.zeros(ref.shape, dtype=dtype)
+    nonpositive_mask = np.zeros(ref.shape, dtype=bool)
+    if slab_size is None or len(ref.shape) < 3:
+        slabs = [slice(None)]
+    else:
+        slabs = [slice(z, z + slab_size) for z in range(0, ref.shape[2], slab_size)]
+    for slab in slabs:
+        index = (slice(None), slice(None), slab) if slab != slice(None) else slice(None)
+        for nii in nii_list:
+            # the proxy only reads the requested part of the image and nothing is cached in the nifti object
+            data = np.asarray(nii.dataobj[index])
+            # copy only if the data is read-only (memory map) or a view on an array we must not modify
+            data = data.astype(dtype, copy=not (data.flags.writeable and data.flags.owndata))
+            bad = data <= 0
+            if bad.any():
+                if nonpositive == 'error':
+                    raise ValueError('{} contains zero or negative values'.format(nii.get_filename()))
+                nonpositive_mask[index] |= bad
+                data[bad] = 1
+            np.log(data, out=data)
+            log_sum[index] += data
+            del data, bad
+    log_sum /= len(nii_list)
+    np.exp(log_sum, out=log_sum)
+    log_sum[nonpositive_mask] = 0 if nonpositive == 'zero' else np.nan
 
-    gmeaned = gmean(data, axis=3)
     output_path = Path(output_path).absolute()
-    nib.save(nib.Nifti1Image(gmeaned, nii_array[0].affine), output_path)
+    nib.save(nib.Nifti1Image(log_sum, ref.affine), output_path)
     return str(output_path)
 
 
-def dwi_preproc_dict(engine, split_dict, output_folder, output_vox_size=2):
+def dwi_preproc_dict(engine, split_dict, output_folder, output_vox_size=2, cache_max_bytes=None, pool=None,
+                     tracer=None, reslice_backend='matlab', reslice_order=1, warp_backend='matlab', step_timeout=None,
+                     orchestration='sync', stages=None, toolbox_version=None, stage_check=None):
     """
 
        for a split_dwi dict: (we can create the key{nii:bval} dict and just give the dict
@@ -91,7 +159,38 @@ def dwi_preproc_dict(engine, split_dict, output_folder, output_vox_size=2):
        gmean b1000s gmean affine_b1000s
        non_linear_align b0
        apply transform rigid_b0 and rigid_b1000
+
+       Every step goes through a step_cache.StepCache stored in output_folder/tmp/.step_cache so a step whose
+       inputs, parameters and toolbox version did not change since the last run is not computed again.
+       cache_max_bytes limits the size of the intermediate files kept in output_folder/tmp (None for no limit).
+       The end of each stage (reset_gmean, align, coreg, reslice, nonlinear, apply) is recorded in
+       output_folder/__stages.jsonl with the step cache keys of its steps, so an interrupted subject resumes after its
+       last completed stage unless the toolbox version or one of the inputs of the stage changed.
+       The steps are run by scheduler.run_dag as soon as their inputs are ready: if pool (engine_pool.EnginePool) is
+       given, its idle engines are borrowed to run independent steps (alignment of each b-value, rigid and affine
+       coreg, reslicing, nonlinear registration...) at the same time. The reslicing of all the coregistered images and
+       the apply_transform of all the b-values are each done in a single engine call.
+       If tracer (tracing.Tracer) is given, the wall time, engine wait and input/output sizes of every step are
+       recorded in it.
+       With reslice_backend='native', the reslicing is done by resample.reslice_bb (interpolation order
+       reslice_order) in a python thread instead of an engine, at the same time as the nonlinear registration.
+       With warp_backend='native', the def field is applied by resample.apply_deformation: the field is read once
+       for all the b-values, which are written directly in output_folder.
+       A step running for more than step_timeout seconds raises engine_pool.EngineTimeout (see scheduler.run_dag).
+       With orchestration='asyncio', the steps are run by scheduler.run_dag_async: the python work (gmean, copies,
+       step cache and manifest writes) runs in threads while the engines compute and the engines are given back as
+       soon as their call returns.
+       stages (list of stage names) restricts the preprocessing to the steps of these stages, e.g. ['reset_gmean']
+       to prepare a subject in advance without engine (see prefetch_subject), in which case None is returned.
+       toolbox_version (see matlab_wrappers.toolbox_version) is read from the engine if not given.
+       stage_check is called before each stage starts, an exception raised by it stops the preprocessing (e.g.
+       lease.LeaseManager.check when the subject was taken over by another worker).
        """
+    for backend in [reslice_backend, warp_backend]:
+        if backend not in backends:
+            raise ValueError('{} is not a backend ({})'.format(backend, backends))
+    if orchestration not in orchestrations:
+        raise ValueError('{} is not an orchestration ({})'.format(orchestration, orchestrations))
 
     output_folder = str(output_folder)
     tmp_folder = str(Path(output_folder, 'tmp'))
@@ -109,110 +208,300 @@ def dwi_preproc_dict(engine, split_dict, output_folder, output_vox_size=2):
         print('B0 NOT FOUND IN {} OR ONLY CONTAINS ONE DWI THE FOLDER WILL THEN BE IGNORED')
         shutil.rmtree(output_folder)
         return {}
-    print('######################')
-    print('RESET ORIGIN AND GEOMEAN')
-    print('######################')
-    b_denoised_dict = {}
-    for b in b_dict:
-        b_list = []
-        for img_path in b_dict[b]:
-            # shutil.copyfile(img_path, Path(tmp_folder, Path(img_path).name))
-            # img_path = Path(tmp_folder, Path(img_path).name)
-            # print('resetting orientation now input: {}'.format(Path(img_path).name))
-            output_reset = matlab_wrappers.reset_orient_mat(engine, img_path, Path(tmp_folder))
-            # print('resetting orientation done output: {}'.format(Path(output_reset).name))
-            b_list.append(output_reset)
-            # output_reset = matlab_wrappers.reset_orient_mat(engine, img_path, Path(tmp_folder, Path(img_path).name))
-            # out_denoise_test = Path(tmp_folder, 'denoise_' + Path(img_path).name)
-            # # Disabling the denoising as it takes too much time and might be unnecessary
-            # if False and not out_denoise_test.is_file():
-            #     output_denoise = engine.run_denoise(output_reset, tmp_folder, 'denoise_')['pth']['im'][0]
-            #     b_list.append(output_denoise)
-            # else:
-            #     b_list.append(str(out_denoise_test))
-        if len(b_list) == 1:
-            b_denoised_dict[b] = b_list[0]
-        else:
-            b_denoised_dict[b] = nii_gmean(b_list, str(
-                Path(output_folder, 'geomean_' +
-                     format_filename(Path(b_list[0]).name, int(round(b))))))
-    #     print(f'The file {b_denoised_dict[b]} has been created: {Path(b_denoised_dict[b]).is_file()}')
-    # print(b_denoised_dict)
-    # exit()
-        # print('######################DEBUG######################')
-        # print(f'b_denised_dict[{b}] = {b_denoised_dict[b]}')
-        # print(nib.load(b_denoised_dict[b]).shape)
-        # print('######################')
-        # now b_dict contains the denoised images (maybe not used later)
-        # b_dict[b] = b_list
-
-    print('######################')
-    print('RIGID AND AFFINE ALIGNMENT OF THE GEOMEAN IMAGES')
-    print('######################')
-    rigid_aligned_dict = {}
-    affine_aligned_dict = {}
-    for bval in b_denoised_dict:
-        out_align = engine.my_align(b_denoised_dict[bval], tmp_folder)
-        rigid_aligned_dict[bval] = out_align['rigid']
-        affine_aligned_dict[bval] = out_align['affine']
-
-    print('######################')
-    print('COREG OF THE B1000s TO THE B0')
-    print('######################')
-    bval_list = [0] + [k for k in rigid_aligned_dict if k != 0]
-    denoised_rigid_images_list = [rigid_aligned_dict[k] for k in bval_list]
-    denoised_affine_images_list = [affine_aligned_dict[k] for k in bval_list]
-    co_rigid_aligned_list = engine.run_coreg(denoised_rigid_images_list, tmp_folder, 'co-rigid_')['pth']['im']
-    co_affine_aligned_list = engine.run_coreg(denoised_affine_images_list, tmp_folder, 'co-affine_')['pth']['im']
-    for ind, bval in enumerate(bval_list):
-        rigid_aligned_dict[bval] = co_rigid_aligned_list[ind]
-        affine_aligned_dict[bval] = co_affine_aligned_list[ind]
-    print('######################')
-    print('RESLICING')
-    print('######################')
-    resliced_rigid_dict = {}
-    resliced_affine_dict = {}
-    for bval in rigid_aligned_dict:
-        resliced_rigid_dict[bval] = engine.run_bb_spm(
-            rigid_aligned_dict[bval], output_folder, output_vox_size, 'resliced_')['pth']['im'][0]
-        resliced_affine_dict[bval] = engine.run_bb_spm(
-            affine_aligned_dict[bval], output_folder, output_vox_size, 'resliced_')['pth']['im'][0]
-
-    non_linear_dict = {}
-    def_field_dict = {}
-    inv_def_field_dict = {}
-    # if 0 in rigid_aligned_dict:
-    print('######################')
-    print('NONLINEAR REG B0 (DEFORMATION FIELD CALCULATION)')
-    print('######################')
+    if toolbox_version is None:
+        toolbox_version = matlab_wrappers.toolbox_version(engine)
+    cache = step_cache.StepCache(Path(tmp_folder, '.step_cache'), tmp_folder, toolbox_version, cache_max_bytes)
+    manifest = stage_manifest.StageManifest(Path(output_folder, '__stages.jsonl'))
+    bval_list = [0] + [k for k in b_dict if k != 0]
+    reg_types = ['rigid', 'affine']
+
+    def _coregistered(results, reg_type):
+        return {bval: results['coreg_' + reg_type][ind] for ind, bval in enumerate(bval_list)}
+
+    # The reset is done in python (no engine needed) on every image of every b-value in one batch
+    img_list = [img_path for b in b_dict for img_path in b_dict[b]]
+    steps = [scheduler.Step(
+        'reset', lambda eng, r: dict(zip(img_list, cache.run_batch(
+            'reset_orient_mat', lambda inputs: orientation.reset_orient_mat_batch(
+                [i[0] for i in inputs], tmp_folder, nb_threads=4),
+            [[img_path] for img_path in img_list], {'output': tmp_folder, 'backend': 'python'}))),
+        needs_engine=False, inputs=lambda r: img_list, stage='reset_gmean')]
+    for b in bval_list:
+        gmean_path = str(Path(output_folder, 'geomean_' + format_filename(
+            'reo_' + Path(b_dict[b][0]).name.split('.nii')[0] + '.nii', int(round(b)))))
+        steps.append(scheduler.Step(
+            'gmean_{}'.format(b),
+            lambda eng, r, b=b, gmean_path=gmean_path: nii_gmean([r['reset'][p] for p in b_dict[b]], gmean_path)
+            if len(b_dict[b]) > 1 else r['reset'][b_dict[b][0]],
+            deps=['reset'], needs_engine=False, stage='reset_gmean', cache_name='nii_gmean',
+            inputs=lambda r, b=b: [r['reset'][p] for p in b_dict[b]], params={'output': gmean_path}))
+    for b in bval_list:
+        steps.append(scheduler.Step(
+            'align_{}'.format(b), lambda eng, r, b=b: eng.my_align(r['gmean_{}'.format(b)], tmp_folder,
+                                                                   background=True),
+            deps=['gmean_{}'.format(b)], post=lambda v, r: dict(v), stage='align', cache_name='my_align',
+            inputs=lambda r, b=b: [r['gmean_{}'.format(b)]], params={'output': tmp_folder}))
+    for reg_type in reg_types:
+        prefix = 'co-{}_'.format(reg_type)
+        steps.append(scheduler.Step(
+            'coreg_' + reg_type,
+            lambda eng, r, reg_type=reg_type, prefix=prefix: eng.run_coreg(
+                [r['align_{}'.format(b)][reg_type] for b in bval_list], tmp_folder, prefix, background=True),
+            deps=['align_{}'.format(b) for b in bval_list], post=lambda v, r: list(v['pth']['im']), stage='coreg',
+            cache_name='run_coreg',
+            inputs=lambda r, reg_type=reg_type: [r['align_{}'.format(b)][reg_type] for b in bval_list],
+            params={'output': tmp_folder, 'prefix': prefix}))
+    def to_reslice(results):
+        return [_coregistered(results, reg_type)[b] for reg_type in reg_types for b in bval_list]
+    # All the coregistered images (rigid then affine, in bval_list order) are resliced in a single engine call
+    # The native steps run in python threads, the returned futures let the scheduler run the engine steps meanwhile
+    native_executor = None
+    if 'native' in [reslice_backend, warp_backend]:
+        native_executor = ThreadPoolExecutor(2)
+    if reslice_backend == 'native':
+        steps.append(scheduler.Step(
+            'reslice', lambda eng, r: native_executor.submit(
+                resample.reslice_bb_batch, to_reslice(r), output_folder, output_vox_size, 'resliced_', reslice_order,
+                4),
+            deps=['coreg_' + reg_type for reg_type in reg_types], needs_engine=False, stage='reslice',
+            cache_name='reslice_bb_batch', inputs=to_reslice,
+            params={'output': output_folder, 'voxel_size': output_vox_size, 'prefix': 'resliced_',
+                    'order': reslice_order}))
+    else:
+        steps.append(scheduler.Step(
+            'reslice', lambda eng, r: eng.run_bb_spm_batch(to_reslice(r), output_folder, output_vox_size, 'resliced_',
+                                                           background=True),
+            deps=['coreg_' + reg_type for reg_type in reg_types], post=lambda v, r: list(v), stage='reslice',
+            cache_name='run_bb_spm_batch', inputs=to_reslice,
+            params={'output': output_folder, 'voxel_size': output_vox_size, 'prefix': 'resliced_'}))
     # As we use the b0 to MNI transform to register the other bvalues to the MNI, we just need one def field and inverse
-    def_field = engine.non_linear_reg(rigid_aligned_dict[0])
-    inverse_def_field = str(Path(Path(def_field).parent, 'i' + Path(def_field).name))
-    print('######################')
-    print('APPLY NON-LINEAR + RESLICE')
-    print('######################')
-    for bval in rigid_aligned_dict:
-        def_field_dict[bval] = def_field
-        inv_def_field_dict[bval] = inverse_def_field
-        output_img = engine.apply_transform(rigid_aligned_dict[bval], def_field_dict[0], output_vox_size)
-        output_nonlinear = str(Path(output_folder, Path(output_img).name))
-        shutil.copyfile(output_img, output_nonlinear)
-        non_linear_dict[bval] = output_nonlinear
+    steps.append(scheduler.Step(
+        'nonlinear', lambda eng, r: eng.non_linear_reg(_coregistered(r, 'rigid')[0], background=True),
+        deps=['coreg_rigid'],
+        post=lambda v, r: {'def_field': v, 'inv_def_field': str(Path(Path(v).parent, 'i' + Path(v).name))},
+        stage='nonlinear', cache_name='non_linear_reg', inputs=lambda r: [_coregistered(r, 'rigid')[0]]))
+
+    def _copy_nonlinear(output_imgs, results):
+        output_nonlinear = []
+        for output_img in output_imgs:
+            output_nonlinear.append(str(Path(output_folder, Path(output_img).name)))
+            shutil.copyfile(output_img, output_nonlinear[-1])
+        return output_nonlinear
+
+    def to_warp(results):
+        return [_coregistered(results, 'rigid')[b] for b in bval_list]
+    # The def field is shared by all the b-values so they are written by a single normalise job
+    if warp_backend == 'native':
+        steps.append(scheduler.Step(
+            'apply', lambda eng, r: native_executor.submit(
+                resample.apply_deformation, to_warp(r), r['nonlinear']['def_field'], output_folder, output_vox_size,
+                'non_linear_', 4, 4),
+            deps=['coreg_rigid', 'nonlinear'], needs_engine=False, stage='apply', cache_name='apply_deformation',
+            inputs=lambda r: to_warp(r) + [r['nonlinear']['def_field']],
+            params={'output': output_folder, 'voxel_size': output_vox_size}))
+    else:
+        steps.append(scheduler.Step(
+            'apply', lambda eng, r: eng.apply_transform_batch(
+                to_warp(r), r['nonlinear']['def_field'], output_vox_size, 'non_linear_', background=True),
+            deps=['coreg_rigid', 'nonlinear'], post=_copy_nonlinear, stage='apply',
+            cache_name='apply_transform_batch', inputs=lambda r: to_warp(r) + [r['nonlinear']['def_field']],
+            params={'output': output_folder, 'voxel_size': output_vox_size}))
+
+    stage_titles = {
+        'reset_gmean': 'RESET ORIGIN AND GEOMEAN',
+        'align': 'RIGID AND AFFINE ALIGNMENT OF THE GEOMEAN IMAGES',
+        'coreg': 'COREG OF THE B1000s TO THE B0',
+        'reslice': 'RESLICING',
+        'nonlinear': 'NONLINEAR REG B0 (DEFORMATION FIELD CALCULATION)',
+        'apply': 'APPLY NON-LINEAR + RESLICE',
+    }
+    stage_deps = {'reset_gmean': [], 'align': ['reset_gmean'], 'coreg': ['align'], 'reslice': ['coreg'],
+                  'nonlinear': ['coreg'], 'apply': ['coreg', 'nonlinear']}
+    stage_params = {'reset_gmean': {'inputs': split_dict},
+                    'reslice': {'voxel_size': output_vox_size, 'backend': reslice_backend, 'order': reslice_order},
+                    'apply': {'voxel_size': output_vox_size, 'backend': warp_backend}}
+    stage_steps = {stage: [s.name for s in steps if s.stage == stage] for stage in stage_titles}
+
+    def _stage_params(stage, done):
+        # the step cache keys of the stage carry the toolbox version and the name and content of the input files,
+        # done contains the values of the steps of the stage and of the stages it depends on
+        params = dict(stage_params.get(stage, {}))
+        params['steps'] = {s.name: cache.key(s.cache_name or s.name, s.inputs(done) if s.inputs else [], s.params)
+                           for s in steps if s.stage == stage}
+        return params
+
+    # Stages completed in a previous run are resumed if the stages they depend on are resumed too
+    resumed = {}
+    results = {}
+    for stage in stage_titles:
+        recorded = manifest.state(stage)
+        if recorded is None or not all(d in resumed for d in stage_deps[stage]):
+            continue
+        try:
+            # the steps of a stage can use the values of the previous steps of the same stage
+            state = manifest.completed(stage, _stage_params(stage, dict(results, **recorded)))
+        except (OSError, KeyError, TypeError):
+            # an input file is missing or the recorded state does not match the steps
+            state = None
+        if state is not None and sorted(state) == sorted(stage_steps[stage]):
+            print('Stage {} resumed from {}'.format(stage, manifest.path))
+            resumed[stage] = state
+            results.update(state)
+    started = set()
+    stage_values = {stage: {} for stage in stage_titles}
+    # values of the steps done so far (resumed or run), used for the keys of the stages recorded in the manifest
+    done_values = dict(results)
+
+    def _on_start(step):
+        if step.stage not in started:
+            if stage_check is not None:
+                stage_check()
+            started.add(step.stage)
+            print('######################')
+            print(stage_titles[step.stage])
+            print('######################')
 
+    def _on_done(step, value):
+        stage_values[step.stage][step.name] = value
+        done_values[step.name] = value
+        if len(stage_values[step.stage]) == len(stage_steps[step.stage]):
+            manifest.record(step.stage, stage_values[step.stage], _stage_params(step.stage, done_values))
+    run_steps = [s for s in steps if stages is None or s.stage in stages]
+    python_executor = None
+    try:
+        if orchestration == 'asyncio':
+            python_executor = ThreadPoolExecutor(4)
+            results = scheduler.run_coroutine(scheduler.run_dag_async(
+                run_steps, engine=engine, pool=pool, cache=cache, results=results, on_start=_on_start,
+                on_done=_on_done, tracer=tracer, step_timeout=step_timeout, executor=python_executor))
+        else:
+            results = scheduler.run_dag(run_steps, engine=engine, pool=pool, cache=cache, results=results,
+                                        on_start=_on_start, on_done=_on_done, tracer=tracer, step_timeout=step_timeout)
+    finally:
+        for executor in [native_executor, python_executor]:
+            if executor is not None:
+                executor.shutdown()
+    if stages is not None:
+        return None
+
+    cache.evict()
+    print('Step cache: {hits} hits, {misses} misses, {evictions} evictions'.format(**cache.stats()))
+    non_linear_dict = dict(zip(bval_list, results['apply']))
+    resliced = iter(results['reslice'])
+    resliced_dict = {reg_type: {b: next(resliced) for b in bval_list} for reg_type in reg_types}
     output_dict = {
         # 'denoise': b_denoised_dict,
-        'rigid': resliced_rigid_dict,
-        'affine': resliced_affine_dict,
+        'rigid': resliced_dict['rigid'],
+        'affine': resliced_dict['affine'],
         'nonlinear': non_linear_dict,
-        'def_field': def_field_dict,
-        'inv_def_field': inv_def_field_dict,
+        'def_field': {b: results['nonlinear']['def_field'] for b in bval_list},
+        'inv_def_field': {b: results['nonlinear']['inv_def_field'] for b in bval_list},
     }
     return output_dict
 
 
-def partial_preproc_from_dataset_dict(split_dwi_dict, key, output_root, rerun_strat='resume', output_vox_size=2):
+def prefetch_subject(split_dict, output_folder, toolbox_version, cache_max_bytes=None):
+    """
+    Run the python preparation of a subject (reset and gmean, stage reset_gmean of dwi_preproc_dict) in advance,
+    e.g. while the engine registers the previous subject. Its results are resumed by the preprocessing of the
+    subject from the stage manifest and the step cache of output_folder (toolbox_version must be the one of the
+    engines, see matlab_wrappers.toolbox_version). Errors are only printed, the preprocessing runs the steps again.
+    """
+    try:
+        os.makedirs(output_folder, exist_ok=True)
+        dwi_preproc_dict(None, split_dict, output_folder, cache_max_bytes=cache_max_bytes, orchestration='asyncio',
+                         stages=['reset_gmean'], toolbox_version=toolbox_version)
+    except Exception as e:
+        print('Could not prepare {} in advance: {}'.format(output_folder, e))
+
+
+def _init_worker(toolbox_paths, nb_engines=1, engine_max_subjects=None, engine_max_rss=None):
+    """
+    Initializer of the subject worker processes: each worker owns its own engine pool configured with the
+    toolbox paths given by the parent process (module globals are not shared between processes).
+    With more than one engine, the extra engines are started in the background so the steps of a subject can be
+    dispatched to them (see dwi_preproc_dict).
+    """
+    global spm_path, superres_path, patient_preproc_path
+    spm_path, superres_path, patient_preproc_path = toolbox_paths
+    pool = engine_pool.get_engine_pool(nb_engines)
+    pool.set_toolbox_paths(*toolbox_paths)
+    pool.set_lifecycle(engine_max_subjects, engine_max_rss)
+    if nb_engines > 1:
+        threading.Thread(target=pool.start, daemon=True).start()
+
+
+def partial_preproc_from_dataset_dict(split_dwi_dict, key, output_root, rerun_strat='resume', output_vox_size=2,
+                                      toolbox_paths=None, cache_max_bytes=None, reslice_backend='matlab',
+                                      warp_backend='matlab', lease_ttl=None, step_timeout=None, max_retries=2,
+                                      orchestration='sync'):
+    """
+    Preprocess split_dwi_dict[key] in output_root/key and save the output dictionary in __preproc_dict.json
+
+    Parameters
+    ----------
+    split_dwi_dict : dict
+    key : str
+    output_root : pathlike
+    rerun_strat : str
+        'resume' or 'delete'
+    output_vox_size : float
+    toolbox_paths : tuple of str or None
+        (spm_path, superres_path, patient_preproc_path), if None the paths of the engine pool are used
+    cache_max_bytes : int or None
+        maximum size of the intermediate files kept by the step cache of the subject (see dwi_preproc_dict)
+    reslice_backend : str
+        'matlab' or 'native' (see dwi_preproc_dict)
+    warp_backend : str
+        'matlab' or 'native' (see dwi_preproc_dict)
+    lease_ttl : float or None
+        if not None, the subject is only preprocessed if the lease on it can be taken (see lease.LeaseManager) so
+        several nodes can share output_root, a lease not refreshed for lease_ttl seconds is reclaimed
+    step_timeout : float or None
+        maximum duration of an engine call in seconds (None for no limit)
+    max_retries : int
+        number of times the subject is retried on a fresh engine when its engine dies or hangs (see
+        engine_pool.is_engine_failure), the retries resume from the cached steps
+    orchestration : str
+        'sync' or 'asyncio' (see dwi_preproc_dict)
+    Returns
+    -------
+    save_dict : dict
+        {key: output_dict} or {} if the preprocessing failed or the subject is leased by another worker
+    """
+    if toolbox_paths is not None:
+        engine_pool.get_engine_pool().set_toolbox_paths(*toolbox_paths)
+    leases = None
+    if lease_ttl is not None:
+        leases = lease.get_lease_manager(output_root, lease_ttl)
+        if not leases.acquire(key):
+            print('{} is being preprocessed by another worker, it will then be skipped'.format(key))
+            return {}
+    try:
+        return _preproc_subject(split_dwi_dict, key, output_root, rerun_strat, output_vox_size, cache_max_bytes,
+                                reslice_backend, warp_backend, step_timeout, max_retries, orchestration, leases)
+    finally:
+        if leases is not None:
+            leases.release(key)
+
+
+def _write_json_atomic(obj, path):
+    # written next to the destination and renamed so other nodes never read a partial file
+    path = Path(path)
+    tmp_path = Path(path.parent, '.' + path.name + '.tmp')
+    with open(tmp_path, 'w+') as out_file:
+        json.dump(obj, out_file, indent=4)
+    os.replace(tmp_path, path)
+
+
+def _preproc_subject(split_dwi_dict, key, output_root, rerun_strat, output_vox_size, cache_max_bytes,
+                     reslice_backend, warp_backend, step_timeout=None, max_retries=2, orchestration='sync',
+                     leases=None):
+    output_dir = Path(output_root, key)
+    tracer = tracing.Tracer(key)
+    # stops the preprocessing between two stages if another worker reclaimed the lease of the subject
+    stage_check = (lambda: leases.check(key)) if leases is not None else None
     try:
-        output_dir = Path(output_root, key)
         if output_dir.is_dir():
             if rerun_strat == 'delete':
                 for i in range(5):
@@ -229,54 +518,140 @@ def partial_preproc_from_dataset_dict(split_dwi_dict, key, output_root, rerun_st
                     print('{} has already been preprocessed it will then be skipped'.format(output_dir))
                     return json.load(open(Path(output_dir, '__preproc_dict.json'), 'r'))
                 else:
+                    # The steps already computed are reused from the step cache of the folder
                     print('Integrity check in {} detected an error, '
-                          'the folder is then erased and preprocessed again'.format(output_dir))
-                    for i in range(5):
-                        try:
-                            shutil.rmtree(output_dir)
-                        except OSError as e:
-                            print('Could not delete {}, still trying to preprocess but please verify the output'.format(
-                                output_dir))
-                            print(e)
-                            time.sleep(5)
-        matlab_scripts_folder = rsc.files('mri_preprocessing.matlab')
-
-        engine = matlab.engine.start_matlab()
-        engine.addpath(str(matlab_scripts_folder))
-        # Just in case we add all of them
-        engine.addpath(spm_path)
-        engine.addpath(superres_path)
-        engine.addpath(patient_preproc_path)
-        engine.cd(patient_preproc_path + '/private')
+                          'the preprocessing is resumed from the cached steps'.format(output_dir))
         os.makedirs(output_dir, exist_ok=True)
-        b_dict = dwi_preproc_dict(engine, split_dwi_dict[key], output_dir, output_vox_size)
+        pool = engine_pool.get_engine_pool()
+        # peak memory of the worker and its engines, used by the admission control of the next subjects
+        sampler = admission.MemorySampler(pool.memory_use).start()
+        try:
+            retries = 0
+            while True:
+                # includes the engine startup if no engine is running yet
+                with tracer.span('engine_acquire'):
+                    engine = pool.acquire()
+                try:
+                    b_dict = dwi_preproc_dict(engine, split_dwi_dict[key], output_dir, output_vox_size,
+                                              cache_max_bytes, pool, tracer, reslice_backend,
+                                              warp_backend=warp_backend, step_timeout=step_timeout,
+                                              orchestration=orchestration, stage_check=stage_check)
+                except Exception as e:
+                    if not engine_pool.is_engine_failure(e):
+                        pool.release(engine)
+                        raise
+                    # The failure may come from a borrowed engine, the engine of the subject is kept if it answers
+                    if pool.is_alive(engine):
+                        pool.release(engine)
+                    else:
+                        pool.discard(engine)
+                    if retries >= max_retries:
+                        raise
+                    retries += 1
+                    tracer.record('engine_retry', 0.0)
+                    print('Engine failure while preprocessing {} ({}), retry {}/{} on a fresh engine'.format(
+                        key, e, retries, max_retries))
+                    continue
+                pool.release(engine)
+                break
+        finally:
+            tracer.memory_peak = sampler.stop()
         if not b_dict:
             return {}
+        if stage_check is not None:
+            stage_check()
         save_dict = {key: b_dict}
-        with open(Path(output_dir, '__preproc_dict.json'), 'w+') as out_file:
-            json.dump(save_dict, out_file, indent=4)
-            print(f'Preprocessed folder, dictionary saved at {Path(output_dir, "__preproc_dict.json")}')
+        with tracer.span('write_preproc_dict') as span:
+            _write_json_atomic(save_dict, Path(output_dir, '__preproc_dict.json'))
+            span['outputs'] = str(Path(output_dir, '__preproc_dict.json'))
+        print(f'Preprocessed folder, dictionary saved at {Path(output_dir, "__preproc_dict.json")}')
+        tracer.save(Path(output_dir, tracing.trace_name))
         return save_dict
+    except lease.LeaseLost as e:
+        # the folder belongs to the worker which reclaimed the lease, nothing more is written in it
+        print('{}, its preprocessing is stopped'.format(e))
+        return {}
     except Exception as e:
+        if output_dir.is_dir():
+            tracer.save(Path(output_dir, tracing.trace_name))
         error_dir = Path(output_root, 'errors')
-        if not error_dir.is_dir():
-            error_dir.mkdir()
+        error_dir.mkdir(exist_ok=True)
         output_error_path = Path(error_dir, key + '_error.txt')
         output_error_path.write_text('ERROR WITH KEY [{}]:\n{}'.format(key, e))
         return {}
 
 
+def _wait_for_leased(split_dwi_dict, keys, output_root, rerun_strat, output_vox_size, lease_ttl, run_start,
+                     toolbox_paths, cache_max_bytes, reslice_backend, warp_backend, step_timeout, max_retries,
+                     orchestration):
+    """
+    Follow the subjects skipped because another worker held their lease (or which lost it) until they are preprocessed
+    by that worker, or preprocess them here if the lease is released or expires (crashed worker) first. The subjects
+    which failed during this run (error file more recent than run_start) are not followed.
+
+    Returns
+    -------
+    list_of_output_dict : list of dict
+        {key: output_dict} of the followed subjects
+    """
+    leases = lease.get_lease_manager(output_root, lease_ttl)
+
+    def _failed(k):
+        error_path = Path(output_root, 'errors', k + '_error.txt')
+        return error_path.is_file() and os.path.getmtime(error_path) >= run_start
+    pending = [k for k in keys if not _failed(k)]
+    if pending:
+        print('Waiting for {} subjects leased by other workers'.format(len(pending)))
+    list_of_output_dict = []
+    while pending:
+        for k in list(pending):
+            output_dir = Path(output_root, k)
+            if Path(output_dir, '__preproc_dict.json').is_file() and data_access.check_output_integrity(output_dir):
+                list_of_output_dict.append(json.load(open(Path(output_dir, '__preproc_dict.json'), 'r')))
+                pending.remove(k)
+            elif not leases.is_leased(k):
+                # The worker holding the lease stopped or failed before finishing the subject
+                save_dict = partial_preproc_from_dataset_dict(
+                    split_dwi_dict, k, output_root, rerun_strat, output_vox_size, toolbox_paths, cache_max_bytes,
+                    reslice_backend, warp_backend, lease_ttl, step_timeout, max_retries, orchestration)
+                if save_dict:
+                    list_of_output_dict.append(save_dict)
+                    pending.remove(k)
+                elif _failed(k) or not leases.is_leased(k):
+                    # failed or nothing to preprocess (e.g. no b0), otherwise another worker took the lease first
+                    pending.remove(k)
+        if pending:
+            time.sleep(min(lease_ttl / 4, 60))
+    return list_of_output_dict
+
+
 def preproc_from_dataset_dict(json_path, output_root, rerun_strat='resume', nb_cores=1, output_vox_size=2,
-                              pair_singletons=True):
+                              pair_singletons=True, cache_max_bytes=None, engines_per_subject=1,
+                              reslice_backend='matlab', warp_backend='matlab', lease_ttl=None, keys=None, shard=None,
+                              engine_max_subjects=None, engine_max_rss=None, step_timeout=None, max_retries=2,
+                              memory_budget=None, orchestration='sync'):
+    """
+    Preprocess every subject of the dataset dictionary json_path in output_root (see partial_preproc_from_dataset_dict)
+
+    keys (list of keys of the dataset dictionary) and shard ((index, count)) restrict the preprocessing to a subset
+    of the subjects (see sharding.select_keys), the paired singletons staying together. A shard records its subjects
+    in output_root/__shards and does not aggregate the traces, sharding.merge_shards does it once all the shards are
+    done.
+    The engines are recycled after engine_max_subjects subjects or above engine_max_rss bytes of memory (see
+    engine_pool.EnginePool) and a subject whose engine dies or hangs for more than step_timeout seconds on a step is
+    retried up to max_retries times on a fresh engine.
+    With lease_ttl, the subjects leased by other workers are followed after the other subjects until they are done,
+    and preprocessed here if their lease is released or expires (see _wait_for_leased).
+    With memory_budget (in bytes) and nb_cores != 1, the subjects are only submitted to the workers while their
+    estimated memory fits in the budget (see admission.AdmissionController), the estimates being corrected with the
+    peaks measured on the previous subjects.
+    With orchestration='asyncio' (see dwi_preproc_dict) and nb_cores == 1, the python preparation of the next
+    subject (see prefetch_subject) runs while the current subject is registered, unless the outputs are deleted
+    (rerun_strat='delete') or leased (lease_ttl).
+    """
     split_dwi_dict = data_access.get_split_dict_from_json(json_path)
+    groups = {}
     # both keys having the same preproc output
-    check_spm_modules()
-    if not all([spm_path, superres_path, patient_preproc_path]):
-        print('Missing matlab modules (spm, spm_superres and Patient-Preprocessing (RunPreproc) are required)'
-              '\n https://www.fil.ion.ucl.ac.uk/spm/'
-              '\n https://github.com/brudfors/spm_superres'
-              '\n https://github.com/WTCN-computational-anatomy-group/Patient-Preprocessing')
-        exit()
     if pair_singletons:
         json_path = Path(json_path)
         if not json_path.is_file():
@@ -286,18 +661,15 @@ def preproc_from_dataset_dict(json_path, output_root, rerun_strat='resume', nb_c
         singleton_key_list = [s for s in split_dwi_dict if len(split_dwi_dict[s]) == 1]
         # Separate the correctly formed dwi
         non_singleton_key_list = [s for s in split_dwi_dict if len(split_dwi_dict[s]) > 1]
+        # The StudyInstanceUID of every key is read once (in parallel and cached next to the json)
+        index = metadata_index.build_metadata_index(json_dict, singleton_key_list + non_singleton_key_list,
+                                                    cache_path=metadata_index.default_cache_path(json_path))
         # List the series number of every correctly formed split dwi
-        series_dict = {data_access.get_attr_from_output_dict_key(
-            json_dict, key, 'StudyInstanceUID')['Value'][0]: key for key in non_singleton_key_list}
-        # Filter out the singletons with the same series as a correctly formed split dwi
-        matched_singeltons = {}
-        for key in singleton_key_list:
-            series = data_access.get_attr_from_output_dict_key(json_dict, key, 'StudyInstanceUID')['Value'][0]
-            if series not in series_dict:
-                if series not in matched_singeltons:
-                    matched_singeltons[series] = [key]
-                else:
-                    matched_singeltons[series].append(key)
+        series_dict = {metadata_index.attribute_value(index, key, 'StudyInstanceUID'): key
+                       for key in non_singleton_key_list}
+        # Group the singletons by series, ignoring the ones with the same series as a correctly formed split dwi
+        matched_singeltons = {series: keys for series, keys in metadata_index.group_by(
+            index, singleton_key_list, 'StudyInstanceUID').items() if series not in series_dict}
         # If the singletons cannot be matched with any other dwi we ignore them as we don't know what to do with it.
         matched_split_dwi = {}
         for series in list(matched_singeltons):
@@ -306,6 +678,7 @@ def preproc_from_dataset_dict(json_path, output_root, rerun_strat='resume', nb_c
             else:
                 # We create merged split_dwi dictionaries associated with the common series of the singletons
                 matched_split_dwi[matched_singeltons[series][0]] = {}
+                groups[matched_singeltons[series][0]] = matched_singeltons[series]
                 for key in matched_singeltons[series]:
                     matched_split_dwi[matched_singeltons[series][0]].update(split_dwi_dict[key])
         # Now we create the curated split_dwi_dict
@@ -316,23 +689,108 @@ def preproc_from_dataset_dict(json_path, output_root, rerun_strat='resume', nb_c
         split_dwi_dict = new_split_dwi
     else:
         split_dwi_dict = {k: split_dwi_dict[k] for k in split_dwi_dict if len(split_dwi_dict[k]) >= 1}
+    if keys is not None or shard is not None:
+        selected = sharding.select_keys(split_dwi_dict, groups, keys, shard)
+        print('{} subjects out of {} selected{}'.format(
+            len(selected), len(split_dwi_dict), ' for the shard {}/{}'.format(*shard) if shard is not None else ''))
+        split_dwi_dict = {k: split_dwi_dict[k] for k in selected}
 
-    keys_list = [k for k in split_dwi_dict]
+    list_of_output_dict = []
+    keys_list = []
+    for k in split_dwi_dict:
+        # The subjects already preprocessed are skipped before resolving the toolboxes so a fully resumed dataset
+        # does not start matlab
+        output_dir = Path(output_root, k)
+        if rerun_strat == 'resume' and output_dir.is_dir() and data_access.check_output_integrity(output_dir):
+            print('{} has already been preprocessed it will then be skipped'.format(output_dir))
+            list_of_output_dict.append(json.load(open(Path(output_dir, '__preproc_dict.json'), 'r')))
+        else:
+            keys_list.append(k)
+    if keys_list:
+        check_spm_modules()
+        if not all([spm_path, superres_path, patient_preproc_path]):
+            print('Missing matlab modules (spm, spm_superres and Patient-Preprocessing (RunPreproc) are required)'
+                  '\n https://www.fil.ion.ucl.ac.uk/spm/'
+                  '\n https://github.com/brudfors/spm_superres'
+                  '\n https://github.com/WTCN-computational-anatomy-group/Patient-Preprocessing'
+                  '\nThe paths can be given with the {} environment variables or in {}'.format(
+                      ', '.join(toolbox_config.env_variables.values()), toolbox_config.config_path()))
+            exit()
+    # the subjects failing from now on have an error file more recent than run_start
+    run_start = time.time()
+    if nb_cores == -1:
+        nb_cores = multiprocessing.cpu_count()
+    nb_cores = max(min(nb_cores, len(keys_list)), 1)
+    toolbox_paths = (spm_path, superres_path, patient_preproc_path)
     if nb_cores != 1:
-        if nb_cores == -1:
-            nb_cores = multiprocessing.cpu_count()
-        pool = ThreadPool(nb_cores)
-        list_of_output_dict = pool.map(
-            lambda key: partial_preproc_from_dataset_dict(
-                split_dwi_dict, key, output_root, rerun_strat, output_vox_size), keys_list)
-
-        pool.close()
-        pool.join()
+        # The engine used to check the modules (if any) is not needed in the parent process anymore
+        engine_pool.get_engine_pool().close()
+        # spawn so the workers do not inherit the parent's matlab engine connections
+        with ProcessPoolExecutor(nb_cores, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_worker,
+                                 initargs=(toolbox_paths, engines_per_subject, engine_max_subjects,
+                                           engine_max_rss)) as executor:
+            def submit(k):
+                return executor.submit(partial_preproc_from_dataset_dict, {k: split_dwi_dict[k]}, k, output_root,
+                                       rerun_strat, output_vox_size, toolbox_paths, cache_max_bytes,
+                                       reslice_backend, warp_backend, lease_ttl, step_timeout, max_retries,
+                                       orchestration)
+
+            if memory_budget is None:
+                futures = {submit(k): k for k in keys_list}
+                # Results are collected as soon as a subject is done
+                finished = ((futures[f], f) for f in as_completed(futures))
+            else:
+                controller = admission.AdmissionController(memory_budget, engines_per_subject,
+                                                           state_path=Path(output_root, admission.state_name))
+                voxels = admission.subject_voxels({k: split_dwi_dict[k] for k in keys_list})
+                finished = admission.run_admitted(
+                    keys_list, submit, controller, voxels, nb_cores,
+                    lambda k, since: tracing.read_memory_peak(Path(output_root, k, tracing.trace_name), since))
+            for k, future in finished:
+                try:
+                    list_of_output_dict.append(future.result())
+                except Exception as e:
+                    print('The worker preprocessing {} failed: {}'.format(k, e))
     else:
-        list_of_output_dict = []
-        for k in keys_list:
+        engines = engine_pool.get_engine_pool(engines_per_subject)
+        engines.set_lifecycle(engine_max_subjects, engine_max_rss)
+        if engines_per_subject > 1 and keys_list:
+            threading.Thread(target=engines.start, daemon=True).start()
+        prefetch_executor = None
+        prefetch = None
+        if orchestration == 'asyncio' and len(keys_list) > 1 and rerun_strat == 'resume' and lease_ttl is None:
+            # The prefetched steps must have the cache keys of the engines
+            with engines.engine() as engine:
+                version = matlab_wrappers.toolbox_version(engine)
+            prefetch_executor = ThreadPoolExecutor(1)
+        for ind, k in enumerate(keys_list):
+            if prefetch is not None:
+                # this subject was being prepared during the previous one
+                prefetch.result()
+                prefetch = None
+            if prefetch_executor is not None and ind + 1 < len(keys_list):
+                next_key = keys_list[ind + 1]
+                prefetch = prefetch_executor.submit(prefetch_subject, split_dwi_dict[next_key],
+                                                    Path(output_root, next_key), version, cache_max_bytes)
             list_of_output_dict.append(
-                partial_preproc_from_dataset_dict(split_dwi_dict, k, output_root, rerun_strat, output_vox_size))
+                partial_preproc_from_dataset_dict(split_dwi_dict, k, output_root, rerun_strat, output_vox_size,
+                                                  cache_max_bytes=cache_max_bytes, reslice_backend=reslice_backend,
+                                                  warp_backend=warp_backend, lease_ttl=lease_ttl,
+                                                  step_timeout=step_timeout, max_retries=max_retries,
+                                                  orchestration=orchestration))
+        if prefetch_executor is not None:
+            prefetch_executor.shutdown()
+        stats = engines.stats()
+        print('MATLAB engines: {} started, {} warm and {} cold acquisitions, {} recycled, {} discarded'.format(
+            stats['engines_started'], stats['warm_acquisitions'], stats['cold_acquisitions'],
+            stats['engines_recycled'], stats['engines_discarded']))
+    if lease_ttl is not None and keys_list:
+        done = {k for d in list_of_output_dict for k in d}
+        list_of_output_dict += _wait_for_leased(
+            split_dwi_dict, [k for k in keys_list if k not in done], output_root, rerun_strat, output_vox_size,
+            lease_ttl, run_start, toolbox_paths, cache_max_bytes, reslice_backend, warp_backend, step_timeout,
+            max_retries, orchestration)
     # for key in split_dwi_dict:
     #     # TODO maybe make a rerun strategy mechanism
     #     output_dir = Path(output_root, key)
@@ -340,9 +798,13 @@ def preproc_from_dataset_dict(json_path, output_root, rerun_strat='resume', nb_c
     #     b_dict = dwi_preproc_dict(engine, split_dwi_dict[key], output_dir)
     #     output_dict[key] = b_dict
 
+    if keys_list and shard is None:
+        tracing.print_report(tracing.aggregate_traces(output_root))
     output_dict = {}
     for d in list_of_output_dict:
         output_dict.update(d)
+    if shard is not None:
+        sharding.write_shard_manifest(output_root, shard, list(split_dwi_dict), output_dict)
     if pair_singletons:
         # We duplicate the preproc output for the singletons to match with the keys of the conversion pipeline output
         for key in matched_split_dwi:
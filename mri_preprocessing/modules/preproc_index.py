@@ -0,0 +1,161 @@
+import json
+import os
+import sqlite3
+from contextlib import contextmanager
+from pathlib import Path
+
+index_name = '__preproc_index.sqlite'
+final_dict_name = '__final_preproc_dict.json'
+
+
+class PreprocIndex:
+    """
+    SQLite index of the __preproc_dict.json files of the subject folders of an output root.
+    update() only reads the json files whose size or modification time changed since the last update, so keeping the
+    index up to date costs a stat per subject folder instead of parsing every json.
+
+    Parameters
+    ----------
+    output_root : pathlike
+        root folder containing one folder per subject
+    index_path : pathlike or None
+        default: output_root/__preproc_index.sqlite
+    """
+    def __init__(self, output_root, index_path=None):
+        self.output_root = Path(output_root)
+        if not self.output_root.is_dir():
+            raise ValueError('{} is not an existing directory'.format(self.output_root))
+        self.index_path = Path(index_path) if index_path is not None else Path(self.output_root, index_name)
+        with self._connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS folders (folder TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER)')
+            db.execute('CREATE TABLE IF NOT EXISTS subjects (key TEXT PRIMARY KEY, folder TEXT, preproc_dict TEXT)')
+            db.execute('CREATE INDEX IF NOT EXISTS subjects_folder ON subjects (folder)')
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(str(self.index_path), timeout=60)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def _scan(self):
+        # {folder name: (size, mtime_ns)} of the folders containing a __preproc_dict.json
+        found = {}
+        with os.scandir(self.output_root) as it:
+            for entry in it:
+                if not entry.is_dir():
+                    continue
+                try:
+                    st = os.stat(os.path.join(entry.path, '__preproc_dict.json'))
+                except OSError:
+                    continue
+                found[entry.name] = (st.st_size, st.st_mtime_ns)
+        return found
+
+    def update(self, folders=None):
+        """
+        Re-index the subject folders whose __preproc_dict.json was created, modified or deleted
+
+        Parameters
+        ----------
+        folders : list of str or None
+            names of the folders to check (e.g. the subjects just preprocessed), None to check every folder of the
+            output root
+        Returns
+        -------
+        nb_updated : int
+            number of folders (re-)indexed or removed from the index
+        """
+        if folders is None:
+            found = self._scan()
+        else:
+            folders = [str(f) for f in folders]
+            found = {}
+            for folder in folders:
+                try:
+                    st = os.stat(Path(self.output_root, folder, '__preproc_dict.json'))
+                except OSError:
+                    continue
+                found[folder] = (st.st_size, st.st_mtime_ns)
+        nb_updated = 0
+        with self._connect() as db:
+            known = {f: (s, m) for f, s, m in db.execute('SELECT folder, size, mtime_ns FROM folders')}
+            for folder, stat in found.items():
+                if known.get(folder) == stat:
+                    continue
+                try:
+                    with open(Path(self.output_root, folder, '__preproc_dict.json'), 'r') as f:
+                        preproc_dict = json.load(f)
+                except (OSError, ValueError) as e:
+                    print('Could not index {}: {}'.format(Path(self.output_root, folder), e))
+                    continue
+                db.execute('DELETE FROM subjects WHERE folder = ?', (folder,))
+                db.executemany('INSERT OR REPLACE INTO subjects VALUES (?, ?, ?)',
+                               [(key, folder, json.dumps(value)) for key, value in preproc_dict.items()])
+                db.execute('INSERT OR REPLACE INTO folders VALUES (?, ?, ?)', (folder,) + stat)
+                nb_updated += 1
+            removed = [f for f in known if f not in found and (folders is None or f in folders)]
+            for folder in removed:
+                db.execute('DELETE FROM subjects WHERE folder = ?', (folder,))
+                db.execute('DELETE FROM folders WHERE folder = ?', (folder,))
+            nb_updated += len(removed)
+        return nb_updated
+
+    def get(self, key, default=None):
+        with self._connect() as db:
+            row = db.execute('SELECT preproc_dict FROM subjects WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row is not None else default
+
+    def keys(self):
+        with self._connect() as db:
+            return [row[0] for row in db.execute('SELECT key FROM subjects ORDER BY key')]
+
+    def items(self):
+        with self._connect() as db:
+            rows = db.execute('SELECT key, preproc_dict FROM subjects ORDER BY key').fetchall()
+        for key, value in rows:
+            yield key, json.loads(value)
+
+    def __contains__(self, key):
+        with self._connect() as db:
+            return db.execute('SELECT 1 FROM subjects WHERE key = ?', (key,)).fetchone() is not None
+
+    def __len__(self):
+        with self._connect() as db:
+            return db.execute('SELECT COUNT(*) FROM subjects').fetchone()[0]
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def export_json(self, json_path=None):
+        """
+        Write the legacy __final_preproc_dict.json ({key: preproc_dict} of every indexed subject)
+
+        Parameters
+        ----------
+        json_path : pathlike or None
+            default: output_root/__final_preproc_dict.json
+        Returns
+        -------
+        json_path : str
+        """
+        if json_path is None:
+            json_path = Path(self.output_root, final_dict_name)
+        with open(json_path, 'w+') as out_file:
+            json.dump(self.to_dict(), out_file, indent=4)
+        return str(json_path)
+
+
+def load_final_preproc_dict(output_root):
+    """
+    {key: preproc_dict} of every preprocessed subject of output_root, read from the (updated) index or, for output
+    folders without index, from __final_preproc_dict.json
+    """
+    if Path(output_root, index_name).is_file() or not Path(output_root, final_dict_name).is_file():
+        index = PreprocIndex(output_root)
+        index.update()
+        return index.to_dict()
+    with open(Path(output_root, final_dict_name), 'r') as f:
+        return json.load(f)
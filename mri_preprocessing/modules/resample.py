@@ -0,0 +1,330 @@
+# Native (numpy/scipy) resampling of the images on the SPM bounding box, used instead of the matlab engines when the
+# 'native' backend is selected
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+
+# Bounding box (in mm) of the SPM12 tissue probability maps, also used by apply_transform.m
+spm_bb = np.array([[-90., -126., -72.], [90., 90., 108.]])
+
+
+def bb_grid(voxel_size, bb=spm_bb):
+    """
+    Output grid of SPM (spm_get_matdim) for a bounding box and an isotropic voxel size. Like SPM with the MNI
+    templates (whose x axis is flipped), the x axis of the grid goes from right to left.
+
+    Parameters
+    ----------
+    voxel_size : float
+    bb : 2x3 array
+        [[xmin, ymin, zmin], [xmax, ymax, zmax]] in mm
+    Returns
+    -------
+    affine : 4x4 array
+        nibabel (0-based) affine of the grid, the first voxel is at the (rounded) [xmax, ymin, zmin] corner of the
+        bounding box
+    shape : 3-tuple of int
+    """
+    vx = float(abs(voxel_size))
+    bb = np.round(np.asarray(bb, dtype=float) / vx) * vx
+    shape = tuple(int(d) for d in np.round((bb[1] - bb[0]) / vx + 1))
+    # LAS like the images written by SPM
+    affine = np.diag([-vx, vx, vx, 1.])
+    affine[:3, 3] = [bb[1][0], bb[0][1], bb[0][2]]
+    return affine, shape
+
+
+def reslice_array(data, src_affine, dst_affine, dst_shape, order=1, chunk_voxels=1 << 20, nb_threads=1, cval=0.):
+    """
+    Resample a 3D array on another grid with scipy.ndimage.map_coordinates. The output voxels are processed by slabs
+    of slices (at most chunk_voxels voxels each) so the coordinates never take more than 24 * chunk_voxels bytes per
+    thread.
+
+    Parameters
+    ----------
+    data : 3D array
+    src_affine : 4x4 array
+        affine of data
+    dst_affine : 4x4 array
+    dst_shape : 3-tuple of int
+    order : int
+        spline interpolation order (0: nearest neighbour, 1: trilinear, ... 5)
+    chunk_voxels : int
+    nb_threads : int
+        number of threads resampling the slabs
+    cval : float
+        value of the voxels outside of the input image
+    Returns
+    -------
+    resliced : 3D float32 array
+    """
+    if data.ndim != 3:
+        raise ValueError('Only 3D images can be resliced, the data has the shape {}'.format(data.shape))
+    # output voxel -> input voxel
+    vox2vox = np.linalg.inv(src_affine).dot(dst_affine)
+    if order > 1:
+        # the spline coefficients are computed once for the whole image instead of once per slab, with the boundary
+        # mode of map_coordinates
+        data = ndimage.spline_filter(data, order=order, output=np.float32, mode='constant')
+    else:
+        data = np.asarray(data, dtype=np.float32)
+    output = np.empty(dst_shape, dtype=np.float32)
+    slab = max(int(chunk_voxels // (dst_shape[0] * dst_shape[1])), 1)
+    i, j = np.meshgrid(np.arange(dst_shape[0]), np.arange(dst_shape[1]), indexing='ij')
+
+    def _reslice_slab(z_start):
+        z_stop = min(z_start + slab, dst_shape[2])
+        k = np.arange(z_start, z_stop)
+        ijk = np.stack([np.broadcast_to(i[..., None], i.shape + k.shape),
+                        np.broadcast_to(j[..., None], j.shape + k.shape),
+                        np.broadcast_to(k, i.shape + k.shape)]).reshape(3, -1)
+        coords = vox2vox[:3, :3].dot(ijk) + vox2vox[:3, 3:]
+        output[:, :, z_start:z_stop] = ndimage.map_coordinates(
+            data, coords, order=order, mode='constant', cval=cval, prefilter=False).reshape(
+            dst_shape[0], dst_shape[1], z_stop - z_start)
+
+    starts = range(0, dst_shape[2], slab)
+    if nb_threads > 1 and len(starts) > 1:
+        with ThreadPoolExecutor(nb_threads) as executor:
+            list(executor.map(_reslice_slab, starts))
+    else:
+        for z_start in starts:
+            _reslice_slab(z_start)
+    return output
+
+
+def _load_3d(img_path):
+    img_path = Path(img_path)
+    if not img_path.is_file():
+        raise ValueError('{} does not exist'.format(img_path))
+    img = nib.load(str(img_path))
+    data = np.asanyarray(img.dataobj)
+    if data.ndim > 3:
+        data = data.reshape(data.shape[:3] + (-1,))
+        if data.shape[3] != 1:
+            raise ValueError('{} is not a 3D image'.format(img_path))
+        data = data[..., 0]
+    return img, data
+
+
+def _output_path(img_path, output_folder, prefix):
+    if not Path(output_folder).is_dir():
+        raise ValueError('{} does not exist'.format(output_folder))
+    name = Path(img_path).name
+    name = name[:-len('.gz')] if name.endswith('.gz') else name
+    return str(Path(output_folder, prefix + name))
+
+
+def _save_like(img, data, affine, order, output_path):
+    header = img.header.copy()
+    if order == 0:
+        # nearest neighbour: the values (e.g. mask labels) are kept in the input type
+        data = data.astype(img.get_data_dtype())
+        header.set_data_dtype(img.get_data_dtype())
+    else:
+        header.set_data_dtype(np.float32)
+    header.set_slope_inter(1, 0)
+    out = nib.Nifti1Image(data, affine, header)
+    out.set_sform(affine, code='aligned')
+    out.set_qform(affine, code='aligned')
+    nib.save(out, output_path)
+    return output_path
+
+
+def reslice_bb(img_path, output_folder, voxel_size=2, prefix='resliced_', order=1, nb_threads=1,
+               chunk_voxels=1 << 20, affine=None):
+    """
+    Native equivalent of run_bb_spm.m: reslice an image on the SPM bounding box with an isotropic voxel size
+
+    Parameters
+    ----------
+    img_path : pathlike
+    output_folder : pathlike
+    voxel_size : float
+    prefix : str
+    order : int
+        interpolation order, use 0 (nearest neighbour) for masks and label images
+    nb_threads : int
+    chunk_voxels : int
+    affine : 4x4 array or None
+        affine used instead of the one of the image (e.g. a mask with the affine of its aligned image)
+    Returns
+    -------
+    output_path : str
+        output_folder/prefix + image name (uncompressed)
+    """
+    output_path = _output_path(img_path, output_folder, prefix)
+    img, data = _load_3d(img_path)
+    bb_affine, shape = bb_grid(voxel_size)
+    resliced = reslice_array(data, img.affine if affine is None else affine, bb_affine, shape, order, chunk_voxels,
+                             nb_threads)
+    return _save_like(img, resliced, bb_affine, order, output_path)
+
+
+def reslice_bb_batch(img_paths, output_folder, voxel_size=2, prefix='resliced_', orders=1, nb_threads=1):
+    """
+    reslice_bb on a list of images (native equivalent of run_bb_spm_batch)
+
+    Parameters
+    ----------
+    img_paths : list of pathlike
+    output_folder : pathlike
+    voxel_size : float
+    prefix : str
+    orders : int or list of int
+        interpolation order of every image (or the same for all)
+    nb_threads : int
+        threads used for the slabs of each image
+    Returns
+    -------
+    output_paths : list of str
+        in the same order as img_paths
+    """
+    if isinstance(orders, int):
+        orders = [orders] * len(img_paths)
+    return [reslice_bb(p, output_folder, voxel_size, prefix, o, nb_threads) for p, o in zip(img_paths, orders)]
+
+
+def load_deformation(field_path):
+    """
+    Load an SPM deformation field (y_*.nii or iy_*.nii) as a memory map when the image allows it (uncompressed and
+    unscaled)
+
+    Parameters
+    ----------
+    field_path : pathlike
+    Returns
+    -------
+    field : 4D array
+        (x, y, z, 3) mm coordinates pointed by each voxel of the field
+    affine : 4x4 array
+        affine of the voxel grid of the field
+    """
+    if not Path(field_path).is_file():
+        raise ValueError('{} does not exist'.format(field_path))
+    img = nib.load(str(field_path), mmap=True)
+    field = np.asanyarray(img.dataobj)
+    if field.ndim not in [4, 5] or field.shape[-1] != 3 or int(np.prod(field.shape[3:])) != 3:
+        raise ValueError('{} is not a deformation field, its shape is {}'.format(field_path, field.shape))
+    return field.reshape(field.shape[:3] + (3,)), img.affine
+
+
+def warp_arrays(data_list, affine_list, field, field_affine, dst_affine=None, dst_shape=None, orders=4,
+                chunk_voxels=1 << 20, nb_threads=1, cval=0.):
+    """
+    Pull the images through a deformation field onto a destination grid (what the normalise.write job of SPM does).
+    The field is sampled once per slab of output voxels and the coordinates are shared by all the images, so the
+    field is read (and interpolated) a single time whatever the number of images.
+
+    Parameters
+    ----------
+    data_list : list of 3D arrays
+    affine_list : list of 4x4 arrays
+        affine of each image
+    field : 4D array
+        see load_deformation
+    field_affine : 4x4 array
+    dst_affine : 4x4 array or None
+        if None, the images are written on the grid of the field (e.g. the native grid of an inverse field)
+    dst_shape : 3-tuple of int or None
+    orders : int or list of int
+        interpolation order of each image (4 like the matlab apply_transform, 0 for labels)
+    chunk_voxels : int
+    nb_threads : int
+    cval : float
+    Returns
+    -------
+    warped : list of 3D float32 arrays
+    """
+    if isinstance(orders, int):
+        orders = [orders] * len(data_list)
+    if dst_affine is None:
+        dst_affine, dst_shape = field_affine, field.shape[:3]
+    # output voxel -> field voxel, when the grids are the same the field values are read directly
+    vox2field = np.linalg.inv(field_affine).dot(dst_affine)
+    same_grid = tuple(dst_shape) == tuple(field.shape[:3]) and np.allclose(vox2field, np.eye(4))
+    mm2vox_list = [np.linalg.inv(affine) for affine in affine_list]
+    coefficients = []
+    for data, order in zip(data_list, orders):
+        if data.ndim != 3:
+            raise ValueError('Only 3D images can be warped, the data has the shape {}'.format(data.shape))
+        coefficients.append(ndimage.spline_filter(data, order=order, output=np.float32, mode='constant') if order > 1
+                            else np.asarray(data, dtype=np.float32))
+    outputs = [np.empty(dst_shape, dtype=np.float32) for _ in data_list]
+    slab = max(int(chunk_voxels // (dst_shape[0] * dst_shape[1])), 1)
+    i, j = np.meshgrid(np.arange(dst_shape[0]), np.arange(dst_shape[1]), indexing='ij')
+
+    def _warp_slab(z_start):
+        z_stop = min(z_start + slab, dst_shape[2])
+        if same_grid:
+            mm = np.asarray(field[:, :, z_start:z_stop], dtype=np.float32).reshape(-1, 3).T
+        else:
+            k = np.arange(z_start, z_stop)
+            ijk = np.stack([np.broadcast_to(i[..., None], i.shape + k.shape),
+                            np.broadcast_to(j[..., None], j.shape + k.shape),
+                            np.broadcast_to(k, i.shape + k.shape)]).reshape(3, -1)
+            field_coords = vox2field[:3, :3].dot(ijk) + vox2field[:3, 3:]
+            mm = np.stack([ndimage.map_coordinates(field[..., c], field_coords, order=1, mode='constant',
+                                                   cval=np.nan) for c in range(3)])
+        # outside of the field (or where it is undefined) the coordinates are sent far from the images so the voxels
+        # get cval
+        mm[:, np.isnan(mm).any(axis=0)] = 1e9
+        for data, order, mm2vox, output in zip(coefficients, orders, mm2vox_list, outputs):
+            coords = mm2vox[:3, :3].dot(mm) + mm2vox[:3, 3:]
+            output[:, :, z_start:z_stop] = ndimage.map_coordinates(
+                data, coords, order=order, mode='constant', cval=cval, prefilter=False).reshape(
+                dst_shape[0], dst_shape[1], z_stop - z_start)
+
+    starts = range(0, dst_shape[2], slab)
+    if nb_threads > 1 and len(starts) > 1:
+        with ThreadPoolExecutor(nb_threads) as executor:
+            list(executor.map(_warp_slab, starts))
+    else:
+        for z_start in starts:
+            _warp_slab(z_start)
+    return outputs
+
+
+def apply_deformation(img_paths, field_path, output_folder, voxel_size=2, prefix='non_linear_', orders=4,
+                      nb_threads=1, chunk_voxels=1 << 20):
+    """
+    Native equivalent of apply_transform_batch.m (voxel_size given) and apply_inverse_transform.m (voxel_size=None):
+    warp a list of images with the same deformation field and write them in output_folder
+
+    Parameters
+    ----------
+    img_paths : list of pathlike
+    field_path : pathlike
+        y_*.nii to go from the native space to the MNI or iy_*.nii to bring MNI images (e.g. lesions) to the native
+        space
+    output_folder : pathlike
+    voxel_size : float or None
+        the images are written on the SPM bounding box with this voxel size, or on the grid of the field if None
+    prefix : str
+    orders : int or list of int
+        interpolation order of every image (or the same for all), 0 for masks and label images
+    nb_threads : int
+    chunk_voxels : int
+    Returns
+    -------
+    output_paths : list of str
+        output_folder/prefix + image name, in the same order as img_paths
+    """
+    if not img_paths:
+        return []
+    if isinstance(orders, int):
+        orders = [orders] * len(img_paths)
+    output_paths = [_output_path(p, output_folder, prefix) for p in img_paths]
+    field, field_affine = load_deformation(field_path)
+    imgs, data_list = zip(*[_load_3d(p) for p in img_paths])
+    if voxel_size is None:
+        dst_affine, dst_shape = field_affine, field.shape[:3]
+    else:
+        dst_affine, dst_shape = bb_grid(voxel_size)
+    warped = warp_arrays(data_list, [img.affine for img in imgs], field, field_affine, dst_affine, dst_shape, orders,
+                         chunk_voxels, nb_threads)
+    return [_save_like(img, data, dst_affine, order, output_path)
+            for img, data, order, output_path in zip(imgs, warped, orders, output_paths)]
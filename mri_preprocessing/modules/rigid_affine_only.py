@@ -1,71 +1,96 @@
 import json
 import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-import importlib_resources as rsc
 
-import matlab
 import nibabel as nib
-from bcblib.tools.nifti_utils import load_nifti
-
-from mri_preprocessing.modules.preproc import nii_gmean, check_spm_modules
-
-from mri_preprocessing.modules import matlab_wrappers
-
-
-spm_path = ''
-superres_path = ''
-patient_preproc_path = ''
-
-
-def rigid_affine_only(img_paths_list, output_dir, output_vox_size=2, pat_preproc_path=None):
-    engine = matlab.engine.start_matlab()
-    which = matlab_wrappers.matlab_check_module_path(engine, 'spm')
-    if which:
-        global spm_path
-        spm_path = which
-    which = matlab_wrappers.matlab_check_module_path(engine, 'spm_superres')
-    if which:
-        global superres_path
-        superres_path = which
-    which = matlab_wrappers.matlab_check_module_path(engine, 'RunPreproc')
-    if which:
-        global patient_preproc_path
-        patient_preproc_path = which
-    if patient_preproc_path == '' and pat_preproc_path is None:
-        patient_preproc_path = pat_preproc_path
-    engine = matlab.engine.start_matlab()
-    matlab_scripts_folder = rsc.files('mri_preprocessing.matlab')
-    engine.addpath(str(matlab_scripts_folder))
-    # Just in case we add all of them
-    engine.addpath(spm_path)
-    engine.addpath(superres_path)
-    engine.addpath(patient_preproc_path)
-    engine.cd(patient_preproc_path + '/private')
+
+from mri_preprocessing.modules.preproc import nii_gmean, check_spm_modules, backends
+
+from mri_preprocessing.modules import engine_pool, orientation, matlab_wrappers, tracing, resample
+
+# results of rigid_affine_only_img_mask_batch (one json line per image/mask pair)
+results_name = '__img_mask_results.jsonl'
+
+
+def _reslice(engine, img_paths, output_dir, output_vox_size, reslice_backend, orders):
+    if reslice_backend == 'native':
+        return resample.reslice_bb_batch(img_paths, output_dir, output_vox_size, 'resliced_', orders, nb_threads=4)
+    if reslice_backend != 'matlab':
+        raise ValueError('{} is not a backend ({})'.format(reslice_backend, backends))
+    return matlab_wrappers.run_bb_spm_batch(engine, img_paths, output_dir, output_vox_size, 'resliced_')
+
+
+def rigid_affine_only(img_paths_list, output_dir, output_vox_size=2, pat_preproc_path=None, reslice_backend='matlab'):
+    check_spm_modules()
+    pool = engine_pool.get_engine_pool()
+    if not pool.toolbox_paths['patient_preproc'] and pat_preproc_path is not None:
+        pool.set_toolbox_paths(patient_preproc_path=str(pat_preproc_path))
+    with pool.engine() as engine:
+        return _rigid_affine_only(engine, img_paths_list, output_dir, output_vox_size, reslice_backend)
+
+
+def _rigid_affine_only(engine, img_paths_list, output_dir, output_vox_size=2, reslice_backend='matlab'):
     os.makedirs(output_dir, exist_ok=True)
     tmp_folder = Path(output_dir, 'tmp/')
     os.makedirs(tmp_folder, exist_ok=True)
     output_dict = {}
+    tracer = tracing.Tracer()
     for img_path in img_paths_list:
         output_dict['input_path'] = img_path
-        output_reset = matlab_wrappers.reset_orient_mat(engine, img_path, Path(tmp_folder))
+        with tracer.span('reset_orient_mat', inputs=[img_path]) as span:
+            output_reset = span['outputs'] = orientation.reset_orient_mat(img_path, tmp_folder)
         output_dict['reset_origin'] = output_reset
         print('######################')
         print('RIGID AND AFFINE ALIGNMENT OF THE GEOMEAN IMAGES')
         print('######################')
-        out_align = engine.my_align(output_reset, tmp_folder)
+        with tracer.span('my_align', inputs=[output_reset]) as span:
+            out_align = span['outputs'] = engine.my_align(output_reset, tmp_folder)
         output_dict['rigid'] = out_align['rigid']
         output_dict['affine'] = out_align['affine']
         print('######################')
         print('RESLICING')
         print('######################')
-        output_dict['rigid_resliced'] = engine.run_bb_spm(
-            out_align['rigid'], output_dir, output_vox_size, 'resliced_')['pth']['im'][0]
-        output_dict['affine_resliced'] = engine.run_bb_spm(
-            out_align['affine'], output_dir, output_vox_size, 'resliced_')['pth']['im'][0]
+        with tracer.span('reslice', inputs=[out_align['rigid'], out_align['affine']]) as span:
+            output_dict['rigid_resliced'], output_dict['affine_resliced'] = span['outputs'] = \
+                _reslice(engine, [out_align['rigid'], out_align['affine']], output_dir, output_vox_size,
+                         reslice_backend, 1)
+    tracer.save(Path(output_dir, tracing.trace_name))
     return output_dict
 
 
-def rigid_affine_only_img_mask(img_mask_dict, output_dir, output_vox_size=2, img_key=None, mask_key=None):
+def _img_mask_entries(img_mask_dict, img_key=None, mask_key=None):
+    # [(img_path, mask_path)] of the 3 forms of img_mask_dict (see rigid_affine_only_img_mask)
+    if img_key is not None:
+        return [(img_mask_dict[img_key], img_mask_dict[mask_key])]
+    if mask_key is not None:
+        return [(img_path, img_mask_dict[img_path][mask_key]) for img_path in img_mask_dict]
+    return list(img_mask_dict.items())
+
+
+def _with_affine(img_path, output_path, affine):
+    """
+    Copy of an uncompressed NIfTI with another affine. The file is copied by the OS (shutil.copyfile) and only the
+    header block is rewritten, the data is never read, decoded or rewritten by python. The data bytes are still
+    duplicated on disk: the reset mask is shared by the rigid and the affine masks, so its header cannot be modified
+    in place.
+    """
+    img = nib.load(str(img_path))
+    header = img.header.copy()
+    # nibabel moves the scaling and the data offset of the loaded images from the header to the data proxy
+    header.set_slope_inter(img.dataobj.slope, img.dataobj.inter)
+    header['vox_offset'] = img.dataobj.offset
+    header.set_sform(affine)
+    header.set_qform(affine)
+    shutil.copyfile(img_path, output_path)
+    with open(output_path, 'r+b') as f:
+        f.write(header.binaryblock)
+    return str(output_path)
+
+
+def rigid_affine_only_img_mask(img_mask_dict, output_dir, output_vox_size=2, img_key=None, mask_key=None,
+                               reslice_backend='matlab'):
     """
 
     Parameters
@@ -81,72 +106,172 @@ def rigid_affine_only_img_mask(img_mask_dict, output_dir, output_vox_size=2, img
         if not None, implies that the dictionary is of type 3)
     mask_key: str or None
         if not None, implies that the dictionary is of type 2) or 3)
+    reslice_backend: str
+        'matlab' (run_bb_spm) or 'native' (resample.reslice_bb, the masks are resliced with nearest neighbour)
 
     Returns
     -------
-
+    output_dict: dict
+        outputs of the last image of img_mask_dict (all the images are written in output_dir), see
+        rigid_affine_only_img_mask_batch to get the outputs of every image
     """
     if not isinstance(img_mask_dict, dict):
         img_mask_dict = json.load(open(img_mask_dict, 'r'))
     if img_key is not None and mask_key is None:
         raise ValueError('If img_key is not None, mask_key cannot be None')
     check_spm_modules()
-    engine = matlab.engine.start_matlab()
-    matlab_scripts_folder = rsc.files('mri_preprocessing.matlab')
-    engine.addpath(str(matlab_scripts_folder))
-    # Just in case we add all of them
-    engine.addpath(spm_path)
-    engine.addpath(superres_path)
-    engine.addpath(patient_preproc_path)
-    engine.cd(patient_preproc_path + '/private')
+    with engine_pool.get_engine_pool().engine() as engine:
+        return _rigid_affine_only_img_mask(engine, img_mask_dict, output_dir, output_vox_size, img_key, mask_key,
+                                           reslice_backend)
+
+
+def _rigid_affine_only_img_mask(engine, img_mask_dict, output_dir, output_vox_size=2, img_key=None, mask_key=None,
+                                reslice_backend='matlab'):
+    os.makedirs(output_dir, exist_ok=True)
+    tracer = tracing.Tracer()
+    output_dict = {}
+    for img_path, mask_path in _img_mask_entries(img_mask_dict, img_key, mask_key):
+        output_dict = _register_img_mask(engine, img_path, mask_path, output_dir, output_vox_size, reslice_backend,
+                                         tracer)
+    tracer.save(Path(output_dir, tracing.trace_name))
+    return output_dict
+
+
+def _register_img_mask(engine, img_path, mask_path, output_dir, output_vox_size, reslice_backend, tracer):
     os.makedirs(output_dir, exist_ok=True)
     tmp_folder = Path(output_dir, 'tmp/')
     os.makedirs(tmp_folder, exist_ok=True)
-    output_dict = {}
-    for key in img_mask_dict:
-        if img_key is not None:
-            img_path = img_mask_dict[img_key]
-        else:
-            img_path = key
-        if mask_key is not None:
-            mask_path = img_mask_dict[mask_key]
-        else:
-            mask_path = img_mask_dict[key]
-        output_dict['input_path'] = img_path
-        output_reset = matlab_wrappers.reset_orient_mat(engine, img_path, Path(tmp_folder))
-        output_dict['reset_origin'] = output_reset
-        # same but with mask_path
-        output_dict['mask_path'] = mask_path
-        output_reset_mask = matlab_wrappers.reset_orient_mat(engine, mask_path, Path(tmp_folder))
-        output_dict['reset_origin_mask'] = output_reset_mask
-        print('######################')
-        print('RIGID AND AFFINE ALIGNMENT OF THE GEOMEAN IMAGES')
-        print('######################')
-        out_align = engine.my_align(output_reset, tmp_folder)
-        output_dict['rigid'] = out_align['rigid']
-        output_dict['affine'] = out_align['affine']
-        # load rigid and affine images and reset_origin_mask and create 2 new mask niftiImages with the same affine
-        # as the rigid and affine images
-        nii_rigid = load_nifti(output_dict['rigid'])
-        nii_affine = load_nifti(output_dict['affine'])
-        nii_mask = load_nifti(output_dict['reset_origin_mask'])
-        nii_rigid_mask = nib.Nifti1Image(nii_mask.get_data(), nii_rigid.affine)
-        nii_affine_mask = nib.Nifti1Image(nii_mask.get_data(), nii_affine.affine)
-        nii_rigid_mask_path = Path(tmp_folder, f'rigid_mask{Path(mask_path).name}.nii')
-        nii_affine_mask_path = Path(tmp_folder, f'affine_mask{Path(mask_path).name}.nii')
-        nib.save(nii_rigid_mask, nii_rigid_mask_path)
-        nib.save(nii_affine_mask, nii_affine_mask_path)
-        output_dict['rigid_mask'] = nii_rigid_mask_path
-        output_dict['affine_mask'] = nii_affine_mask_path
-        print('######################')
-        print('RESLICING')
-        print('######################')
-        output_dict['rigid_resliced'] = engine.run_bb_spm(
-            out_align['rigid'], output_dir, output_vox_size, 'resliced_')['pth']['im'][0]
-        output_dict['affine_resliced'] = engine.run_bb_spm(
-            out_align['affine'], output_dir, output_vox_size, 'resliced_')['pth']['im'][0]
-        output_dict['rigid_resliced_mask'] = engine.run_bb_spm(
-            nii_rigid_mask_path, output_dir, output_vox_size, 'resliced_')['pth']['im'][0]
-        output_dict['affine_resliced_mask'] = engine.run_bb_spm(
-            nii_affine_mask_path, output_dir, output_vox_size, 'resliced_')['pth']['im'][0]
+    output_dict = {'input_path': img_path}
+    with tracer.span('reset_orient_mat', inputs=[img_path, mask_path]) as span:
+        output_reset = orientation.reset_orient_mat(img_path, tmp_folder)
+        # same but with mask_path (different prefix in case the image and the mask have the same name)
+        output_reset_mask = orientation.reset_orient_mat(mask_path, tmp_folder, 'reo_mask_')
+        span['outputs'] = [output_reset, output_reset_mask]
+    output_dict['reset_origin'] = output_reset
+    output_dict['mask_path'] = mask_path
+    output_dict['reset_origin_mask'] = output_reset_mask
+    print('######################')
+    print('RIGID AND AFFINE ALIGNMENT OF THE GEOMEAN IMAGES')
+    print('######################')
+    with tracer.span('my_align', inputs=[output_reset]) as span:
+        out_align = span['outputs'] = engine.my_align(output_reset, tmp_folder)
+    output_dict['rigid'] = out_align['rigid']
+    output_dict['affine'] = out_align['affine']
+    # The alignment only changes the affine of the image: the masks are the reset mask with the affines of the
+    # rigid and affine images (only the headers are read)
+    rigid_affine = nib.load(str(out_align['rigid'])).affine
+    affine_affine = nib.load(str(out_align['affine'])).affine
+    print('######################')
+    print('RESLICING')
+    print('######################')
+    resliced_keys = ['rigid_resliced', 'affine_resliced', 'rigid_resliced_mask', 'affine_resliced_mask']
+    mask_name = Path(mask_path).name
+    output_dict['rigid_mask'] = _with_affine(output_reset_mask, Path(tmp_folder, f'rigid_mask{mask_name}.nii'),
+                                             rigid_affine)
+    output_dict['affine_mask'] = _with_affine(output_reset_mask, Path(tmp_folder, f'affine_mask{mask_name}.nii'),
+                                              affine_affine)
+    to_reslice = [out_align['rigid'], out_align['affine'], output_dict['rigid_mask'], output_dict['affine_mask']]
+    with tracer.span('reslice', inputs=to_reslice) as span:
+        # the masks are resliced with nearest neighbour by the native backend
+        span['outputs'] = _reslice(engine, to_reslice, output_dir, output_vox_size, reslice_backend, [1, 1, 0, 0])
+    output_dict.update(zip(resliced_keys, span['outputs']))
     return output_dict
+
+
+def _entry_folders(img_paths, output_dir):
+    # one output folder per image, named after the image (with a suffix if several images have the same name)
+    folders = []
+    counts = {}
+    for img_path in img_paths:
+        name = Path(img_path).name.split('.nii')[0]
+        counts[name] = counts.get(name, 0) + 1
+        folders.append(Path(output_dir, name if counts[name] == 1 else '{}_{}'.format(name, counts[name])))
+    return folders
+
+
+def _register_entry(pool, img_path, mask_path, entry_dir, output_vox_size, reslice_backend):
+    tracer = tracing.Tracer(str(img_path))
+    try:
+        with tracer.span('engine_acquire'):
+            engine = pool.acquire()
+        try:
+            return _register_img_mask(engine, img_path, mask_path, entry_dir, output_vox_size, reslice_backend,
+                                      tracer)
+        finally:
+            pool.release(engine)
+    finally:
+        if entry_dir.is_dir():
+            tracer.save(Path(entry_dir, tracing.trace_name))
+
+
+def rigid_affine_only_img_mask_batch(img_mask_dict, output_dir, output_vox_size=2, img_key=None, mask_key=None,
+                                     nb_workers=1, reslice_backend='matlab', on_result=None):
+    """
+    rigid_affine_only_img_mask on every image/mask pair of img_mask_dict, the pairs being registered by nb_workers
+    threads sharing an engine pool of nb_workers engines. Each pair is written in its own folder of output_dir (named
+    after the image) and its result is appended to output_dir/__img_mask_results.jsonl as soon as it is done: the
+    pairs already in this file are not registered again.
+
+    Parameters
+    ----------
+    img_mask_dict: dict or pathlike
+        see rigid_affine_only_img_mask
+    output_dir: pathlike
+    output_vox_size: float
+    img_key: str or None
+    mask_key: str or None
+    nb_workers: int
+    reslice_backend: str
+        'matlab' or 'native'
+    on_result: callable or None
+        called with (img_path, output_dict) when a pair is done (output_dict is None if it failed)
+
+    Returns
+    -------
+    results: dict
+        {img_path: output_dict} (see rigid_affine_only_img_mask), the errors are written in
+        output_dir/errors/<image folder>_error.txt
+    """
+    if not isinstance(img_mask_dict, dict):
+        img_mask_dict = json.load(open(img_mask_dict, 'r'))
+    if img_key is not None and mask_key is None:
+        raise ValueError('If img_key is not None, mask_key cannot be None')
+    os.makedirs(output_dir, exist_ok=True)
+    entries = _img_mask_entries(img_mask_dict, img_key, mask_key)
+    folders = dict(zip([img_path for img_path, _ in entries], _entry_folders([e[0] for e in entries], output_dir)))
+    results_path = Path(output_dir, results_name)
+    results = {}
+    if results_path.is_file():
+        with open(results_path, 'r') as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    # line truncated by an interruption
+                    continue
+                results[result['input_path']] = result
+    todo = [(img_path, mask_path) for img_path, mask_path in entries if img_path not in results]
+    if todo:
+        check_spm_modules()
+    pool = engine_pool.get_engine_pool(nb_workers)
+    with ThreadPoolExecutor(max(nb_workers, 1)) as executor, open(results_path, 'a') as results_file:
+        futures = {executor.submit(_register_entry, pool, img_path, mask_path, folders[img_path], output_vox_size,
+                                   reslice_backend): img_path for img_path, mask_path in todo}
+        for future in as_completed(futures):
+            img_path = futures[future]
+            try:
+                output_dict = {k: str(v) for k, v in future.result().items()}
+            except Exception as e:
+                error_dir = Path(output_dir, 'errors')
+                error_dir.mkdir(exist_ok=True)
+                Path(error_dir, folders[img_path].name + '_error.txt').write_text(
+                    'ERROR WITH IMAGE [{}]:\n{}'.format(img_path, e))
+                output_dict = None
+            else:
+                results[img_path] = output_dict
+                results_file.write(json.dumps(output_dict) + '\n')
+                results_file.flush()
+            if on_result is not None:
+                on_result(img_path, output_dict)
+    print('{} image/mask pairs out of {} registered'.format(len(results), len(entries)))
+    return {img_path: results[img_path] for img_path, _ in entries if img_path in results}
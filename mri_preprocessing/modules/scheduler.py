@@ -0,0 +1,390 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+
+from mri_preprocessing.modules.engine_pool import EngineTimeout, is_engine_failure
+from mri_preprocessing.modules.tracing import current_rss
+
+
+class Step:
+    """
+    Node of the dependency graph of a subject preprocessing
+
+    Parameters
+    ----------
+    name : str
+    fn : callable
+        fn(engine, results) runs the step, engine is None if the step does not need one and results contains the
+        values of the steps already done. To let the scheduler dispatch other steps while the engine computes, fn
+        can return the matlab.engine.FutureResult of a call made with background=True.
+    deps : sequence of str
+        names of the steps whose values are used by this step
+    needs_engine : bool
+    post : callable or None
+        post(value, results) is applied to the value returned by fn (or its future), e.g. to extract the output path
+        from the structure returned by RunPreproc
+    cache_name : str or None
+        name of the step in the step_cache.StepCache (None to not cache the step)
+    inputs : callable or None
+        inputs(results) returns the input files of the step (part of the cache key)
+    params : dict or None
+        parameters of the step (part of the cache key)
+    stage : str or None
+        stage of the pipeline the step belongs to
+    """
+    def __init__(self, name, fn, deps=(), needs_engine=True, post=None, cache_name=None, inputs=None, params=None,
+                 stage=None):
+        self.name = name
+        self.fn = fn
+        self.deps = list(deps)
+        self.needs_engine = needs_engine
+        self.post = post
+        self.cache_name = cache_name
+        self.inputs = inputs
+        self.params = params
+        self.stage = stage
+
+
+def _is_future(value):
+    return hasattr(value, 'done') and hasattr(value, 'result') and hasattr(value, 'cancel')
+
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def event_loop():
+    """
+    asyncio event loop of the process used by run_dag_async, running in a daemon thread (created on first call)
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, daemon=True).start()
+        return _loop
+
+
+def run_coroutine(coro):
+    """
+    Run a coroutine in the event loop of the process and wait for its result, from any thread but the loop's one.
+    Several threads can run coroutines at the same time, they share the loop.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, event_loop()).result()
+
+
+def run_dag(steps, engine=None, pool=None, cache=None, results=None, on_start=None, on_done=None,
+            poll_interval=0.05, tracer=None, step_timeout=None):
+    """
+    Run the steps of a dependency graph, dispatching every ready step to an available engine so independent steps
+    run concurrently.
+
+    Parameters
+    ----------
+    steps : list of Step
+    engine : matlab engine or None
+        engine owned by the caller, used first
+    pool : engine_pool.EnginePool or None
+        idle engines of the pool are borrowed (without waiting or starting new engines) to run more steps at the same
+        time and are given back before returning. If engine is None, the pool also provides the first engine.
+    cache : step_cache.StepCache or None
+    results : dict or None
+        values of the steps already done (e.g. resumed from a stage manifest), they are not run again
+    on_start : callable or None
+        on_start(step) called when a step is dispatched
+    on_done : callable or None
+        on_done(step, value) called when a step is done
+    poll_interval : float
+        time (in seconds) between two checks of the running futures
+    tracer : tracing.Tracer or None
+        records the wall time of every step, the time it waited for an engine once ready and its input and output
+        files
+    step_timeout : float or None
+        maximum duration (in seconds) of an engine step returning a future, a step running longer raises
+        engine_pool.EngineTimeout (hung engine), the steps without engine are not limited. The borrowed engines which
+        failed (see engine_pool.is_engine_failure) are discarded from the pool instead of being given back.
+    Returns
+    -------
+    results : dict
+        {step name: value}
+    """
+    results = dict(results or {})
+    names = {s.name for s in steps} | set(results)
+    for step in steps:
+        missing = [d for d in step.deps if d not in names]
+        if missing:
+            raise ValueError('Step {} depends on unknown steps {}'.format(step.name, missing))
+    todo = {s.name: s for s in steps if s.name not in results}
+    free_engines = [engine] if engine is not None else []
+    borrowed = []
+    # step name -> (step, future, engine, cache key)
+    running = {}
+    cache_keys = {}
+    # step name -> time when the step was first ready / dispatched
+    ready_times = {}
+    start_times = {}
+    # step name -> resident memory when the step was dispatched (only with a tracer)
+    start_rss = {}
+    # engines (borrowed from the pool) that are dead or hung
+    failed_engines = []
+
+    def _trace(step, value, cached=False):
+        if tracer is None:
+            return
+        now = time.perf_counter()
+        start = start_times.get(step.name, ready_times[step.name])
+        tracer.record(step.name, now - start, step.cache_name or step.name, step.stage,
+                      engine_wait=start - ready_times[step.name] if step.needs_engine else 0.0,
+                      inputs=step.inputs(results) if step.inputs else [], outputs=value, cached=cached,
+                      rss_before=start_rss.get(step.name))
+
+    def _get_engine():
+        if free_engines:
+            return free_engines.pop()
+        if pool is not None:
+            eng = pool.try_acquire()
+            if eng is None and engine is None and not borrowed:
+                eng = pool.acquire()
+            if eng is not None:
+                borrowed.append(eng)
+            return eng
+        return None
+
+    def _finish(step, value, eng, key):
+        if eng is not None:
+            free_engines.append(eng)
+        if step.post is not None:
+            value = step.post(value, results)
+        if key is not None:
+            cache.put(key, value)
+        results[step.name] = value
+        _trace(step, value)
+        if on_done is not None:
+            on_done(step, value)
+
+    try:
+        while todo or running:
+            progressed = False
+            ready = [s for s in todo.values() if all(d in results for d in s.deps)]
+            for step in ready:
+                # the cache is only checked once, the first time the step is ready
+                if step.name not in cache_keys:
+                    ready_times[step.name] = time.perf_counter()
+                    cache_keys[step.name] = None
+                    if cache is not None and step.cache_name is not None:
+                        key = cache.key(step.cache_name, step.inputs(results) if step.inputs else [], step.params)
+                        value = cache.get(key)
+                        if value is not None:
+                            del todo[step.name]
+                            results[step.name] = value
+                            _trace(step, value, cached=True)
+                            if on_done is not None:
+                                on_done(step, value)
+                            progressed = True
+                            continue
+                        cache_keys[step.name] = key
+                key = cache_keys[step.name]
+                eng = None
+                if step.needs_engine:
+                    eng = _get_engine()
+                    if eng is None:
+                        continue
+                del todo[step.name]
+                start_times[step.name] = time.perf_counter()
+                if tracer is not None:
+                    start_rss[step.name] = current_rss()
+                if on_start is not None:
+                    on_start(step)
+                try:
+                    value = step.fn(eng, results)
+                except Exception as e:
+                    if eng is not None and is_engine_failure(e):
+                        failed_engines.append(eng)
+                    raise
+                if _is_future(value):
+                    running[step.name] = (step, value, eng, key)
+                else:
+                    _finish(step, value, eng, key)
+                progressed = True
+            for name in [n for n in running if running[n][1].done()]:
+                step, future, eng, key = running.pop(name)
+                try:
+                    value = future.result()
+                except Exception as e:
+                    if eng is not None and is_engine_failure(e):
+                        failed_engines.append(eng)
+                    raise
+                _finish(step, value, eng, key)
+                progressed = True
+            if step_timeout is not None:
+                for name in list(running):
+                    step, future, eng, key = running[name]
+                    # the python steps (e.g. native reslicing of a large image) are not limited
+                    if eng is not None and time.perf_counter() - start_times[name] > step_timeout:
+                        failed_engines.append(eng)
+                        raise EngineTimeout('The step {} did not finish in {}s'.format(name, step_timeout))
+            if not progressed:
+                if not running:
+                    raise ValueError('The steps {} cannot be run (missing engine or cyclic dependencies)'.format(
+                        list(todo)))
+                time.sleep(poll_interval)
+    finally:
+        for step, future, eng, key in running.values():
+            future.cancel()
+        for eng in borrowed:
+            if any(eng is f for f in failed_engines):
+                pool.discard(eng)
+            else:
+                pool.release(eng)
+    return results
+
+
+async def run_dag_async(steps, engine=None, pool=None, cache=None, results=None, on_start=None, on_done=None,
+                        tracer=None, step_timeout=None, executor=None, poll_interval=0.05):
+    """
+    asyncio version of run_dag (same parameters and results): every step is a task started as soon as its
+    dependencies are done. The engine calls (made with background=True) are awaited without blocking the loop and the
+    python side of the pipeline (python steps, post-processing, step cache hashing and writes, on_done) runs in
+    executor, so it overlaps with the engine computations and an engine is given back as soon as its call returns.
+    run_coroutine(run_dag_async(...)) runs it from synchronous code.
+
+    Parameters
+    ----------
+    executor : concurrent.futures.Executor or None
+        runs the python work, default: the default executor of the loop
+    poll_interval : float
+        time (in seconds) between two checks of the idle engines of the pool when every engine is busy
+    """
+    loop = asyncio.get_running_loop()
+    results = dict(results or {})
+    names = {s.name for s in steps} | set(results)
+    for step in steps:
+        missing = [d for d in step.deps if d not in names]
+        if missing:
+            raise ValueError('Step {} depends on unknown steps {}'.format(step.name, missing))
+    todo = [s for s in steps if s.name not in results]
+    # The tasks wait for each other, cycles and missing engines are detected before starting them
+    ordered = set(results)
+    remaining = list(todo)
+    while remaining:
+        ready = [s for s in remaining if all(d in ordered for d in s.deps)]
+        if not ready:
+            raise ValueError('The steps {} cannot be run (cyclic dependencies)'.format([s.name for s in remaining]))
+        ordered.update(s.name for s in ready)
+        remaining = [s for s in remaining if s.name not in ordered]
+    if engine is None and pool is None and any(s.needs_engine for s in todo):
+        raise ValueError('The steps {} cannot be run (missing engine)'.format([s.name for s in todo if s.needs_engine]))
+    done_events = {s.name: asyncio.Event() for s in todo}
+    free_engines = [engine] if engine is not None else []
+    borrowed = []
+    # engines (borrowed from the pool) that are dead or hung
+    failed_engines = []
+    engine_released = asyncio.Condition()
+    # on_done is not expected to be thread safe
+    on_done_lock = asyncio.Lock()
+
+    def _in_executor(fn, *args):
+        return loop.run_in_executor(executor, fn, *args)
+
+    async def _get_engine():
+        async with engine_released:
+            while True:
+                if free_engines:
+                    return free_engines.pop()
+                if pool is not None:
+                    eng = pool.try_acquire()
+                    if eng is None and engine is None and not borrowed:
+                        eng = await loop.run_in_executor(None, pool.acquire)
+                    if eng is not None:
+                        borrowed.append(eng)
+                        return eng
+                try:
+                    # engines of the pool can become idle without notification
+                    await asyncio.wait_for(engine_released.wait(), poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _give_back(eng):
+        async with engine_released:
+            free_engines.append(eng)
+            engine_released.notify()
+
+    async def _wait(step, future, eng):
+        # only the engine calls can hang, the python steps are not limited
+        timeout = step_timeout if eng is not None else None
+        if isinstance(future, concurrent.futures.Future):
+            waiting = asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        else:
+            # matlab.engine.FutureResult is not awaitable, its result is waited for in a thread
+            waiting = loop.run_in_executor(None, future.result, timeout)
+        try:
+            return await waiting
+        except (asyncio.TimeoutError, concurrent.futures.TimeoutError, TimeoutError):
+            future.cancel()
+            raise EngineTimeout('The step {} did not finish in {}s'.format(step.name, timeout))
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+
+    async def _done(step, value, ready_time, start_time, cached=False, rss_before=None):
+        results[step.name] = value
+        done_events[step.name].set()
+        if tracer is not None:
+            tracer.record(step.name, time.perf_counter() - start_time, step.cache_name or step.name, step.stage,
+                          engine_wait=start_time - ready_time if step.needs_engine and not cached else 0.0,
+                          inputs=step.inputs(results) if step.inputs else [], outputs=value, cached=cached,
+                          rss_before=rss_before)
+        if on_done is not None:
+            async with on_done_lock:
+                await _in_executor(on_done, step, value)
+
+    async def _run(step):
+        for dep in step.deps:
+            if dep in done_events:
+                await done_events[dep].wait()
+        ready_time = time.perf_counter()
+        key = None
+        if cache is not None and step.cache_name is not None:
+            key = await _in_executor(cache.key, step.cache_name, step.inputs(results) if step.inputs else [],
+                                     step.params)
+            value = await _in_executor(cache.get, key)
+            if value is not None:
+                await _done(step, value, ready_time, ready_time, cached=True)
+                return
+        eng = await _get_engine() if step.needs_engine else None
+        start_time = time.perf_counter()
+        rss_before = current_rss() if tracer is not None else None
+        if on_start is not None:
+            on_start(step)
+        try:
+            # the engine calls are made with background=True and return at once
+            value = step.fn(eng, results) if eng is not None else await _in_executor(step.fn, eng, results)
+            if _is_future(value):
+                value = await _wait(step, value, eng)
+        except Exception as e:
+            if eng is not None and is_engine_failure(e):
+                failed_engines.append(eng)
+            raise
+        finally:
+            if eng is not None and not any(eng is f for f in failed_engines):
+                await _give_back(eng)
+        if step.post is not None:
+            value = await _in_executor(step.post, value, results)
+        if key is not None:
+            await _in_executor(cache.put, key, value)
+        await _done(step, value, ready_time, start_time, rss_before=rss_before)
+
+    tasks = [asyncio.ensure_future(_run(step)) for step in todo]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for eng in borrowed:
+            if any(eng is f for f in failed_engines):
+                pool.discard(eng)
+            else:
+                pool.release(eng)
+    return results
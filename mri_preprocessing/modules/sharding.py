@@ -0,0 +1,187 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+
+from mri_preprocessing.modules import preproc_index, tracing
+
+shard_dir_name = '__shards'
+
+
+def parse_shard(shard):
+    """
+    Parameters
+    ----------
+    shard : str
+        'INDEX/COUNT' with 0 <= INDEX < COUNT (e.g. '0/8' for the first of 8 shards)
+    Returns
+    -------
+    (index, count) : tuple of int
+    """
+    try:
+        index, count = [int(s) for s in str(shard).split('/')]
+    except ValueError:
+        raise ValueError('{} is not a shard, the format is INDEX/COUNT (e.g. 0/8)'.format(shard))
+    if count < 1 or not 0 <= index < count:
+        raise ValueError('The shard index must be between 0 and COUNT - 1 (got {})'.format(shard))
+    return index, count
+
+
+def read_keys_file(keys_file):
+    """
+    Keys listed in a text file (one per line, empty lines and lines starting with # are ignored)
+    """
+    if not Path(keys_file).is_file():
+        raise ValueError('{} does not exist'.format(keys_file))
+    with open(keys_file, 'r') as f:
+        return [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
+
+
+def image_cost(img_path):
+    """
+    Number of voxels (times the number of volumes) of an image, read from its header only. An image that cannot be
+    read raises a ValueError: a default cost would depend on the node reading it and the shards would disagree.
+    """
+    try:
+        return int(np.prod(nib.load(str(img_path)).header.get_data_shape()))
+    except Exception as e:
+        raise ValueError('The cost of {} cannot be read from its header: {}'.format(img_path, e))
+
+
+def subject_costs(split_dwi_dict, nb_threads=16):
+    """
+    Estimated preprocessing cost of each subject: the sum of the voxel counts of its images
+
+    Parameters
+    ----------
+    split_dwi_dict : dict
+        {key: {img_path: bval}}
+    nb_threads : int
+        threads reading the headers
+    Returns
+    -------
+    costs : dict
+        {key: cost}
+    """
+    img_paths = sorted({p for key in split_dwi_dict for p in split_dwi_dict[key]})
+    with ThreadPoolExecutor(nb_threads) as executor:
+        img_costs = dict(zip(img_paths, executor.map(image_cost, img_paths)))
+    return {key: sum(img_costs[p] for p in split_dwi_dict[key]) for key in split_dwi_dict}
+
+
+def partition(costs, count):
+    """
+    Deterministic partition of the keys in count shards of similar total cost: the keys are taken from the most to
+    the least expensive (ties broken by key) and each one goes to the shard with the lowest total cost so far
+
+    Parameters
+    ----------
+    costs : dict
+        {key: cost}
+    count : int
+    Returns
+    -------
+    shards : list of list of str
+        keys of each shard
+    """
+    shards = [[] for _ in range(count)]
+    loads = [0] * count
+    for key in sorted(costs, key=lambda k: (-costs[k], str(k))):
+        ind = min(range(count), key=lambda i: (loads[i], i))
+        shards[ind].append(key)
+        loads[ind] += costs[key]
+    return shards
+
+
+def select_keys(split_dwi_dict, groups=None, keys=None, shard=None, nb_threads=16):
+    """
+    Subset of the subjects of the (curated) split_dwi_dict processed by a shard
+
+    Parameters
+    ----------
+    split_dwi_dict : dict
+        {key: {img_path: bval}}
+    groups : dict or None
+        {key: [keys of the input dictionary preprocessed with it]} (paired singletons), default {key: [key]}
+    keys : list of str or None
+        only the subjects with one of these keys (or a paired singleton with one of these keys) are kept
+    shard : (index, count) or None
+        only the subjects of this shard of the cost weighted partition are kept
+    nb_threads : int
+    Returns
+    -------
+    selected : list of str
+        keys of split_dwi_dict, in split_dwi_dict order
+    """
+    selected = list(split_dwi_dict)
+    if keys is not None:
+        keys = set(keys)
+        groups = groups if groups is not None else {}
+        selected = [k for k in selected if keys.intersection(groups.get(k, [k]))]
+    if shard is not None:
+        index, count = shard
+        # computed on every selected subject (finished or not) so all the shards agree on the partition
+        costs = subject_costs({k: split_dwi_dict[k] for k in selected}, nb_threads)
+        shard_keys = set(partition(costs, count)[index])
+        selected = [k for k in selected if k in shard_keys]
+    return selected
+
+
+def shard_manifest_path(output_root, shard):
+    return Path(output_root, shard_dir_name, '{}_of_{}.json'.format(*shard))
+
+
+def write_shard_manifest(output_root, shard, keys, output_dict):
+    """
+    Record the subjects of a shard and the ones it preprocessed in output_root/__shards/INDEX_of_COUNT.json
+    """
+    path = shard_manifest_path(output_root, shard)
+    os.makedirs(path.parent, exist_ok=True)
+    tmp_path = Path(path.parent, '.' + path.name + '.tmp')
+    with open(tmp_path, 'w+') as f:
+        json.dump({'shard': list(shard), 'keys': list(keys), 'done': [k for k in keys if k in output_dict]}, f,
+                  indent=4)
+    os.replace(tmp_path, path)
+    return str(path)
+
+
+def merge_shards(output_root, export_json=False):
+    """
+    Final step after all the shards: check the shard manifests, update the preprocessing index (and export it as
+    __final_preproc_dict.json if export_json) and aggregate the traces of every subject
+
+    Parameters
+    ----------
+    output_root : pathlike
+    export_json : bool
+    Returns
+    -------
+    missing : dict
+        {'shards': [indices of the shards without manifest], 'keys': [keys of a shard that were not preprocessed]}
+    """
+    shard_dir = Path(output_root, shard_dir_name)
+    manifests = []
+    if shard_dir.is_dir():
+        for path in sorted(shard_dir.glob('*_of_*.json')):
+            with open(path, 'r') as f:
+                manifests.append(json.load(f))
+    missing = {'shards': [], 'keys': []}
+    counts = {m['shard'][1] for m in manifests}
+    if len(counts) > 1:
+        print('Manifests of different shard counts were found in {}: {}'.format(shard_dir, sorted(counts)))
+    for count in counts:
+        found = {m['shard'][0] for m in manifests if m['shard'][1] == count}
+        missing['shards'] += [i for i in range(count) if i not in found]
+    for m in manifests:
+        missing['keys'] += [k for k in m['keys'] if k not in m['done']]
+    index = preproc_index.PreprocIndex(output_root)
+    index.update()
+    if export_json:
+        index.export_json()
+    tracing.print_report(tracing.aggregate_traces(output_root))
+    print('{} subjects preprocessed, {} shards missing, {} subjects of the finished shards not preprocessed'.format(
+        len(index), len(missing['shards']), len(missing['keys'])))
+    return missing
@@ -0,0 +1,93 @@
+import json
+import os
+import time
+from pathlib import Path
+
+from mri_preprocessing.modules.step_cache import output_files
+
+
+def _encode(obj):
+    # json only has string keys, dictionaries with other keys (e.g. float b-values) are stored as pairs
+    if isinstance(obj, dict):
+        if all(isinstance(k, str) for k in obj):
+            return {k: _encode(v) for k, v in obj.items()}
+        return {'__pairs__': [[k, _encode(v)] for k, v in obj.items()]}
+    if isinstance(obj, (list, tuple)):
+        return [_encode(v) for v in obj]
+    return obj
+
+
+def _decode(obj):
+    if isinstance(obj, dict):
+        if list(obj) == ['__pairs__']:
+            return {k: _decode(v) for k, v in obj['__pairs__']}
+        return {k: _decode(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_decode(v) for v in obj]
+    return obj
+
+
+class StageManifest:
+    """
+    Append-only manifest of the completed stages of a subject preprocessing (one json record per line).
+    Each record is written with a single append so an interrupted run leaves at worst a truncated last line, which
+    is ignored when the manifest is read.
+
+    Parameters
+    ----------
+    path : pathlike
+        path to the manifest (e.g. output_folder/__stages.jsonl)
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.records = self.load()
+
+    def load(self):
+        records = {}
+        if not self.path.is_file():
+            return records
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                records[record['stage']] = record
+        return records
+
+    def record(self, stage, state, params=None):
+        record = {
+            'stage': stage,
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'params': _encode(params),
+            'state': _encode(state),
+            'files': {p: os.path.getsize(p) for p in output_files(state)},
+        }
+        line = (json.dumps(record) + '\n').encode()
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self.records[stage] = json.loads(line)
+
+    def state(self, stage):
+        """
+        Return the state recorded at the end of the stage (None if it was not recorded), without checking it
+        """
+        record = self.records.get(stage)
+        return _decode(record['state']) if record is not None else None
+
+    def completed(self, stage, params=None):
+        """
+        Return the state recorded at the end of the stage if it was completed with the same parameters and its
+        files are still there, None otherwise
+        """
+        record = self.records.get(stage)
+        if record is None or record['params'] != _encode(params):
+            return None
+        for p, size in record['files'].items():
+            if not Path(p).is_file() or os.path.getsize(p) != size:
+                return None
+        return _decode(record['state'])
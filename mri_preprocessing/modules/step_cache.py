@@ -0,0 +1,217 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+def file_hash(path, memo=None, chunk_size=1 << 20):
+    """
+    sha1 of the content of a file
+
+    Parameters
+    ----------
+    path : pathlike
+    memo : dict or None
+        {(absolute path, size, mtime_ns): hash} of the files already hashed, updated with this one so an unchanged
+        file is only hashed once
+    chunk_size : int
+    """
+    path = os.path.abspath(str(path))
+    st = os.stat(path)
+    memo_key = (path, st.st_size, st.st_mtime_ns)
+    if memo is not None and memo_key in memo:
+        return memo[memo_key]
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    if memo is not None:
+        memo[memo_key] = h.hexdigest()
+    return h.hexdigest()
+
+
+def output_files(result):
+    """
+    List the existing files referenced in a step result (str, list or dict of those)
+    """
+    if isinstance(result, (str, Path)):
+        return [str(result)] if Path(result).is_file() else []
+    if isinstance(result, dict):
+        result = list(result.values())
+    if isinstance(result, (list, tuple)):
+        return [f for r in result for f in output_files(r)]
+    return []
+
+
+def _file_stat(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+class StepCache:
+    """
+    Content-addressed cache of the steps of a subject preprocessing.
+    A step is identified by its name, its parameters, the toolbox version and the name and content of its input
+    files.
+    The result of a step is reused if all the files it references still exist and have not been modified since.
+
+    Parameters
+    ----------
+    cache_dir : pathlike
+        folder where the cache entries (small json files) are written
+    artifacts_dir : pathlike or None
+        folder containing the intermediate files (e.g. output_folder/tmp) that can be deleted when the cache is
+        larger than max_bytes
+    toolbox_version : str
+    max_bytes : int or None
+        maximum size of the intermediate files referenced by the cache (None for no limit)
+    """
+    def __init__(self, cache_dir, artifacts_dir=None, toolbox_version='', max_bytes=None):
+        self.cache_dir = Path(cache_dir)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.artifacts_dir = Path(artifacts_dir).absolute() if artifacts_dir is not None else None
+        self.toolbox_version = toolbox_version
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # entries used during this session are never evicted
+        self._used = set()
+        # hashes of the input files, kept for the lifetime of the cache (a subject) only
+        self._hashes = {}
+
+    def key(self, step_name, inputs, params=None):
+        h = hashlib.sha1()
+        h.update(json.dumps({'step': step_name, 'params': params, 'toolbox_version': self.toolbox_version},
+                            sort_keys=True, default=str).encode())
+        for p in inputs:
+            # the output names of the steps are derived from the input names
+            h.update(Path(p).name.encode())
+            h.update(file_hash(p, self._hashes).encode())
+        return '{}_{}'.format(step_name, h.hexdigest())
+
+    def _entry_path(self, key):
+        return Path(self.cache_dir, key + '.json')
+
+    def get(self, key):
+        """
+        Return the cached result of the step or None if the entry does not exist or is not valid anymore
+        """
+        entry_path = self._entry_path(key)
+        try:
+            with open(entry_path, 'r') as f:
+                entry = json.load(f)
+            valid = all(_file_stat(p) == s for p, s in entry['outputs'].items())
+        except (OSError, ValueError, KeyError):
+            valid = False
+        if not valid:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._used.add(key)
+        # the modification time of the entry is used to evict the least recently used entries first
+        os.utime(entry_path)
+        return entry['result']
+
+    def put(self, key, result):
+        entry = {'result': result, 'outputs': {p: _file_stat(p) for p in output_files(result)}}
+        entry_path = self._entry_path(key)
+        tmp_path = Path(self.cache_dir, '.' + key + '.json.tmp')
+        with open(tmp_path, 'w+') as f:
+            json.dump(entry, f, indent=4)
+        os.replace(tmp_path, entry_path)
+        self._used.add(key)
+        return result
+
+    def run(self, step_name, fn, inputs, params=None):
+        """
+        Return the cached result of the step if possible, run fn() and cache its result otherwise
+        Parameters
+        ----------
+        step_name : str
+        fn : callable
+            function without argument running the step. Its result must be json serialisable.
+        inputs : list of paths
+            input files of the step (their content is part of the key)
+        params : dict or None
+            parameters of the step (voxel size, prefix, ...)
+        """
+        key = self.key(step_name, inputs, params)
+        result = self.get(key)
+        if result is None:
+            result = self.put(key, fn())
+        return result
+
+    def run_batch(self, step_name, fn, inputs_list, params=None):
+        """
+        Same as run for a step applied to a list of inputs in one call: fn is only called on the inputs without a
+        valid cached result
+        Parameters
+        ----------
+        step_name : str
+        fn : callable
+            function taking a list of inputs (elements of inputs_list) and returning the list of their results
+        inputs_list : list of lists of paths
+        params : dict or None
+        Returns
+        -------
+        results : list
+            in the same order as inputs_list
+        """
+        keys = [self.key(step_name, inputs, params) for inputs in inputs_list]
+        results = [self.get(key) for key in keys]
+        missing = [ind for ind, r in enumerate(results) if r is None]
+        if missing:
+            for ind, result in zip(missing, fn([inputs_list[ind] for ind in missing])):
+                results[ind] = self.put(keys[ind], result)
+        return results
+
+    def _is_artifact(self, path):
+        if self.artifacts_dir is None:
+            return False
+        return str(Path(path).absolute()).startswith(str(self.artifacts_dir) + os.sep)
+
+    def evict(self):
+        """
+        Delete the least recently used entries (and their intermediate files) not used during this session until
+        the intermediate files referenced by the cache fit in max_bytes
+        """
+        if self.max_bytes is None:
+            return 0
+        entries = []
+        protected = set()
+        total = 0
+        for entry_path in self.cache_dir.glob('*.json'):
+            try:
+                with open(entry_path, 'r') as f:
+                    outputs = json.load(f)['outputs']
+            except (OSError, ValueError, KeyError):
+                continue
+            # Only the files still matching the entry belong to it (the others have been overwritten since)
+            artifacts = []
+            for p, s in outputs.items():
+                try:
+                    if self._is_artifact(p) and _file_stat(p) == s:
+                        artifacts.append(p)
+                except OSError:
+                    pass
+            size = sum(os.path.getsize(p) for p in artifacts)
+            total += size
+            if entry_path.stem in self._used:
+                protected.update(artifacts)
+            else:
+                entries.append((entry_path.stat().st_mtime_ns, entry_path, artifacts, size))
+        nb_evicted = 0
+        for _, entry_path, artifacts, size in sorted(entries, key=lambda e: e[0]):
+            if total <= self.max_bytes:
+                break
+            for p in artifacts:
+                if p not in protected:
+                    os.remove(p)
+            os.remove(entry_path)
+            total -= size
+            nb_evicted += 1
+        self.evictions += nb_evicted
+        return nb_evicted
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
@@ -0,0 +1,72 @@
+import json
+import os
+from pathlib import Path
+
+# Environment variables overriding the paths stored in the config file
+env_variables = {
+    'spm': 'MRI_PREPROC_SPM_PATH',
+    'spm_superres': 'MRI_PREPROC_SUPERRES_PATH',
+    'patient_preproc': 'MRI_PREPROC_PATIENT_PREPROC_PATH',
+}
+# Matlab function used to find each toolbox with `which`
+toolbox_functions = {
+    'spm': 'spm',
+    'spm_superres': 'spm_superres',
+    'patient_preproc': 'RunPreproc',
+}
+
+
+def config_path():
+    """
+    Path to the toolbox paths config file: $MRI_PREPROC_CONFIG or ~/.config/mri_preprocessing/toolbox_paths.json
+    """
+    if os.environ.get('MRI_PREPROC_CONFIG'):
+        return Path(os.environ['MRI_PREPROC_CONFIG'])
+    return Path(Path.home(), '.config', 'mri_preprocessing', 'toolbox_paths.json')
+
+
+def load_toolbox_paths():
+    """
+    Toolbox paths from the environment variables or the config file. Only the paths of existing directories are
+    returned.
+
+    Returns
+    -------
+    paths : dict
+        {toolbox: path} with toolbox in 'spm', 'spm_superres' and 'patient_preproc'
+    """
+    paths = {}
+    path = config_path()
+    if path.is_file():
+        try:
+            with open(path, 'r') as f:
+                paths.update(json.load(f))
+        except (OSError, ValueError) as e:
+            print('Could not read the toolbox paths from {}: {}'.format(path, e))
+    for toolbox, variable in env_variables.items():
+        if os.environ.get(variable):
+            paths[toolbox] = os.environ[variable]
+    return {t: str(p) for t, p in paths.items() if t in env_variables and p and Path(p).is_dir()}
+
+
+def save_toolbox_paths(paths):
+    """
+    Store the toolbox paths in the config file (the paths already stored for the other toolboxes are kept)
+    """
+    path = config_path()
+    stored = {}
+    if path.is_file():
+        try:
+            with open(path, 'r') as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            stored = {}
+    stored.update({t: str(p) for t, p in paths.items() if p})
+    try:
+        os.makedirs(path.parent, exist_ok=True)
+        tmp_path = Path(path.parent, '.' + path.name + '.tmp')
+        with open(tmp_path, 'w+') as f:
+            json.dump(stored, f, indent=4)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print('Could not save the toolbox paths in {}: {}'.format(path, e))
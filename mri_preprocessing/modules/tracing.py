@@ -0,0 +1,224 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from mri_preprocessing.modules import dataset_scanner, engine_pool
+from mri_preprocessing.modules.step_cache import output_files
+
+trace_name = '__trace.json'
+report_name = '__trace_report.json'
+
+
+def current_rss():
+    """
+    Current resident memory of the python process in bytes (None if it cannot be measured). The memory of the matlab
+    engines (separate processes) is not included. Unlike the ru_maxrss high-water mark, it does not keep the peak of
+    the previous subjects of a long-lived worker.
+    """
+    return engine_pool.process_rss(os.getpid())
+
+
+def files_size(paths):
+    size = 0
+    for p in paths:
+        try:
+            size += os.path.getsize(p)
+        except OSError:
+            pass
+    return size
+
+
+class Tracer:
+    """
+    Timing and resource trace of the preprocessing of a subject: one event per step (engine call or python stage).
+    The bytes read and written are the sizes of the input and output files of the step, as most of the I/O is done
+    by the matlab engines.
+
+    memory_peak is the peak memory of the subject measured by the caller (python process and its matlab engines,
+    see admission.MemorySampler). The events record the resident memory of the python process when the step
+    started (if known) and when it ended.
+
+    Parameters
+    ----------
+    subject : str or None
+    """
+    def __init__(self, subject=None):
+        self.subject = subject
+        self.memory_peak = None
+        self.start_time = time.time()
+        self.events = []
+        self._lock = threading.Lock()
+
+    def record(self, name, wall, kind=None, stage=None, engine_wait=0.0, inputs=(), outputs=None, cached=False,
+               rss_before=None):
+        """
+        Add an event to the trace
+
+        Parameters
+        ----------
+        name : str
+            name of the step (e.g. align_1000.0)
+        wall : float
+            wall time in seconds
+        kind : str or None
+            type of step used to aggregate the events (e.g. my_align), default: name
+        stage : str or None
+        engine_wait : float
+            time spent waiting for an engine before the step could start
+        inputs : list of paths
+        outputs : step result or None
+            the files referenced in it (see step_cache.output_files) are counted as written
+        cached : bool
+            the result came from the step cache
+        rss_before : int or None
+            current_rss() when the step started
+        """
+        event = {
+            'name': name,
+            'kind': kind or name,
+            'stage': stage,
+            'wall': wall,
+            'engine_wait': engine_wait,
+            'bytes_read': files_size(inputs),
+            'bytes_written': files_size(output_files(outputs)) if outputs is not None and not cached else 0,
+            'rss_before': rss_before,
+            'rss_after': current_rss(),
+            'cached': cached,
+        }
+        with self._lock:
+            self.events.append(event)
+        return event
+
+    @contextmanager
+    def span(self, name, kind=None, stage=None, inputs=()):
+        """
+        Trace the code run in the with block, the files it writes can be given with span.outputs = ...
+        """
+        info = {'outputs': None}
+        rss_before = current_rss()
+        start = time.perf_counter()
+        try:
+            yield info
+        finally:
+            self.record(name, time.perf_counter() - start, kind, stage, inputs=inputs, outputs=info['outputs'],
+                        rss_before=rss_before)
+
+    def to_dict(self):
+        with self._lock:
+            events = list(self.events)
+        return {
+            'subject': self.subject,
+            'start_time': self.start_time,
+            'wall': time.time() - self.start_time,
+            'rss': current_rss(),
+            'memory_peak': self.memory_peak,
+            'events': events,
+        }
+
+    def save(self, path):
+        path = Path(path)
+        tmp_path = Path(path.parent, '.' + path.name + '.tmp')
+        with open(tmp_path, 'w+') as f:
+            json.dump(self.to_dict(), f, indent=4)
+        os.replace(tmp_path, path)
+        return str(path)
+
+
+def read_memory_peak(path, since=None):
+    """
+    memory_peak of a saved trace (None if the trace does not exist or was saved before the since timestamp)
+    """
+    try:
+        if since is not None and os.path.getmtime(path) < since:
+            return None
+        with open(path, 'r') as f:
+            return json.load(f).get('memory_peak')
+    except (OSError, ValueError):
+        return None
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(q * len(sorted_values)), len(sorted_values) - 1)]
+
+
+def aggregate_traces(output_root, output_path=None, nb_slowest=10):
+    """
+    Aggregate the __trace.json of every subject folder of output_root
+
+    Parameters
+    ----------
+    output_root : pathlike
+    output_path : pathlike or None
+        default: output_root/__trace_report.json
+    nb_slowest : int
+        number of slowest subjects listed in the report
+    Returns
+    -------
+    report : dict
+        'steps': {kind: count, cached, total/mean/p50/p95/max wall time, total engine wait, bytes read and written,
+        largest resident memory at the end of a step (max_rss) and largest growth during a step (max_rss_growth)},
+        sorted by total wall time, 'slowest_subjects': [[subject, wall time]] and 'retries': number of
+        subjects retried after an engine failure (engine_retry events)
+    """
+    root_record = dataset_scanner.scan_directory(output_root)
+    walls = {}
+    steps = {}
+    for d in root_record.subdirs:
+        trace_path = Path(root_record.path, d, trace_name)
+        if not trace_path.is_file():
+            continue
+        try:
+            with open(trace_path, 'r') as f:
+                trace = json.load(f)
+        except ValueError:
+            print('Could not read {}'.format(trace_path))
+            continue
+        walls[trace['subject'] or d] = trace['wall']
+        for event in trace['events']:
+            step = steps.setdefault(event['kind'], {'walls': [], 'cached': 0, 'engine_wait': 0.0,
+                                                    'bytes_read': 0, 'bytes_written': 0, 'max_rss': 0,
+                                                    'max_rss_growth': 0})
+            step['walls'].append(event['wall'])
+            step['cached'] += int(event['cached'])
+            step['engine_wait'] += event['engine_wait']
+            step['bytes_read'] += event['bytes_read']
+            step['bytes_written'] += event['bytes_written']
+            # the traces saved before rss_before/rss_after only have the process high-water mark, it is ignored
+            if event.get('rss_after') is not None:
+                step['max_rss'] = max(step['max_rss'], event['rss_after'])
+                if event.get('rss_before') is not None:
+                    step['max_rss_growth'] = max(step['max_rss_growth'], event['rss_after'] - event['rss_before'])
+    steps_report = {}
+    for kind, step in steps.items():
+        w = sorted(step.pop('walls'))
+        steps_report[kind] = dict(count=len(w), total_wall=sum(w), mean_wall=sum(w) / len(w),
+                                  p50_wall=_percentile(w, 0.5), p95_wall=_percentile(w, 0.95), max_wall=w[-1],
+                                  **step)
+    report = {
+        'nb_subjects': len(walls),
+        'total_wall': sum(walls.values()),
+        'steps': dict(sorted(steps_report.items(), key=lambda kv: -kv[1]['total_wall'])),
+        'slowest_subjects': sorted(walls.items(), key=lambda kv: -kv[1])[:nb_slowest],
+        'retries': steps_report.get('engine_retry', {}).get('count', 0),
+    }
+    if output_path is None:
+        output_path = Path(output_root, report_name)
+    with open(output_path, 'w+') as f:
+        json.dump(report, f, indent=4)
+    return report
+
+
+def print_report(report):
+    print('######## TRACE REPORT ({} subjects, {:.1f}s, {} engine retries) #######'.format(
+        report['nb_subjects'], report['total_wall'], report.get('retries', 0)))
+    print('{:25} {:>6} {:>7} {:>10} {:>8} {:>8} {:>10} {:>10} {:>10}'.format(
+        'step', 'count', 'cached', 'total(s)', 'p50(s)', 'p95(s)', 'wait(s)', 'read(MB)', 'write(MB)'))
+    for kind, step in report['steps'].items():
+        print('{:25} {:>6} {:>7} {:>10.1f} {:>8.2f} {:>8.2f} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+            kind, step['count'], step['cached'], step['total_wall'], step['p50_wall'], step['p95_wall'],
+            step['engine_wait'], step['bytes_read'] / 1e6, step['bytes_written'] / 1e6))
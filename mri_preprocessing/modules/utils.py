@@ -1,26 +1,20 @@
 from pathlib import Path
 import json
 import shutil
-import importlib_resources as rsc
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from tqdm import tqdm
-import matlab.engine
-from mri_preprocessing.modules import matlab_wrappers
+from mri_preprocessing.modules import matlab_wrappers, engine_pool, toolbox_config, preproc_index, resample
 
 
 def generate_final_preproc_dict(output_dir, final_dict_path=''):
-    final_preproc_dict = {}
-    if final_dict_path == '':
-        final_preproc_dict_path = Path(output_dir, '__final_preproc_dict.json')
-    else:
-        final_preproc_dict_path = final_dict_path
-    for d in tqdm(Path(output_dir).iterdir()):
-        preproc_json = Path(d, '__preproc_dict.json')
-        if preproc_json.is_file():
-            final_preproc_dict.update(json.load(open(preproc_json, 'r')))
-    with open(final_preproc_dict_path, 'w+') as out_file:
-        json.dump(final_preproc_dict, out_file, indent=4)
-    return final_preproc_dict
+    """
+    Update the preproc index of output_dir (see preproc_index.PreprocIndex) and export it as the legacy
+    __final_preproc_dict.json (or final_dict_path)
+    """
+    index = preproc_index.PreprocIndex(output_dir)
+    index.update()
+    index.export_json(final_dict_path if final_dict_path != '' else None)
+    return index.to_dict()
 
 
 """
@@ -32,20 +26,125 @@ GOAL: get the lesions into the original space
 """
 
 
+def _configure_spm(pool, engine):
+    # apply_inverse_transform and non_linear_reg need spm in the matlab path, which is not resolved when the pool is
+    # created (only the engine pool of the preprocessing is configured by preproc.check_spm_modules)
+    if not pool.toolbox_paths['spm']:
+        which = toolbox_config.load_toolbox_paths().get('spm') or \
+                matlab_wrappers.matlab_check_module_path(engine, 'spm')
+        if which:
+            pool.set_toolbox_paths(spm_path=which)
+            engine.addpath(which, nargout=0)
+
+
+def _inverse_field(pool, b0_path):
+    # The inverse field written by a previous non_linear_reg of the b0 is reused
+    inverse_def_field = Path(Path(b0_path).parent, 'iy_' + Path(b0_path).name)
+    if inverse_def_field.is_file():
+        return str(inverse_def_field)
+    with pool.engine() as engine:
+        _configure_spm(pool, engine)
+        def_field = engine.non_linear_reg(str(b0_path))
+    return str(Path(Path(def_field).parent, 'i' + Path(def_field).name))
+
+
 def get_lesion_to_native_space(lesion_path, b0_path, output_folder):
-    engine = matlab.engine.start_matlab()
-    which = matlab_wrappers.matlab_check_module_path(engine, 'spm')
-    spm_path = None
-    if which:
-        spm_path = which
-    matlab_scripts_folder = rsc.files('mri_preprocessing.matlab')
-
-    engine = matlab.engine.start_matlab()
-    engine.addpath(str(matlab_scripts_folder))
-    # Just in case we add all of them
-    engine.addpath(spm_path)
-    def_field = engine.non_linear_reg(b0_path)
-    inverse_def_field = str(Path(Path(def_field).parent, 'i' + Path(def_field).name))
-    output_img = engine.apply_inverse_transform(lesion_path, inverse_def_field, 'native_space_')
+    pool = engine_pool.get_engine_pool()
+    inverse_def_field = _inverse_field(pool, b0_path)
+    with pool.engine() as engine:
+        _configure_spm(pool, engine)
+        output_img = engine.apply_inverse_transform(lesion_path, inverse_def_field, 'native_space_')
     output_nonlinear = str(Path(output_folder, Path(output_img).name))
     shutil.copyfile(output_img, output_nonlinear)
+    return output_nonlinear
+
+
+def _subject_inverse_field(pool, subject, index, b0_dict):
+    if index is not None:
+        preproc_dict = index.get(subject)
+        if preproc_dict is not None:
+            # the same inverse field is stored for every b-value
+            for inverse_def_field in preproc_dict.get('inv_def_field', {}).values():
+                if Path(inverse_def_field).is_file():
+                    return inverse_def_field
+    if subject not in b0_dict:
+        raise ValueError('No inverse deformation field found for {} and no b0 to compute it'.format(subject))
+    return _inverse_field(pool, b0_dict[subject])
+
+
+def _subject_lesions_to_native_space(pool, subject, lesion_paths, output_folder, index, b0_dict, backend):
+    inverse_def_field = _subject_inverse_field(pool, subject, index, b0_dict)
+    subject_folder = Path(output_folder, subject)
+    subject_folder.mkdir(parents=True, exist_ok=True)
+    if backend == 'native':
+        # The field is read once for all the lesions of the subject, nearest neighbour keeps the labels
+        return resample.apply_deformation(lesion_paths, inverse_def_field, subject_folder, None, 'native_space_', 0)
+    output_paths = []
+    with pool.engine() as engine:
+        _configure_spm(pool, engine)
+        for lesion_path in lesion_paths:
+            output_img = engine.apply_inverse_transform(str(lesion_path), inverse_def_field, 'native_space_')
+            output_paths.append(str(Path(subject_folder, Path(output_img).name)))
+            shutil.copyfile(output_img, output_paths[-1])
+    return output_paths
+
+
+def lesions_to_native_space(lesion_dict, output_folder, preproc_root=None, b0_dict=None, nb_workers=1,
+                            backend='native'):
+    """
+    Bring MNI space lesions to the native space of their subject with the inverse deformation field (iy_) of the
+    subject. The fields of the preprocessing (inv_def_field of the preproc dictionaries of preproc_root) are reused
+    and the missing ones are computed with non_linear_reg on the b0 of the subject (b0_dict). All the lesions of a
+    subject are warped together and the subjects are processed by nb_workers threads sharing an engine pool of
+    nb_workers engines (only started if a field has to be computed or with the matlab backend).
+
+    Parameters
+    ----------
+    lesion_dict : dict or pathlike
+        {lesion_path: subject key} or the path to a json containing it
+    output_folder : pathlike
+        the lesions are written in output_folder/subject/native_space_<lesion name>
+    preproc_root : pathlike or None
+        output root of the preprocessing (see preproc_index.PreprocIndex)
+    b0_dict : dict or None
+        {subject key: b0_path} used for the subjects without inverse field
+    nb_workers : int
+    backend : str
+        'native' (resample.apply_deformation) or 'matlab' (apply_inverse_transform)
+    Returns
+    -------
+    output_dict : dict
+        {lesion_path: native space lesion path}, the errors are written in output_folder/errors/subject_error.txt
+    """
+    if not isinstance(lesion_dict, dict):
+        with open(lesion_dict, 'r') as f:
+            lesion_dict = json.load(f)
+    if backend not in ['matlab', 'native']:
+        raise ValueError('{} is not a backend ([\'matlab\', \'native\'])'.format(backend))
+    output_folder = Path(output_folder)
+    output_folder.mkdir(parents=True, exist_ok=True)
+    b0_dict = b0_dict if b0_dict is not None else {}
+    index = None
+    if preproc_root is not None:
+        index = preproc_index.PreprocIndex(preproc_root)
+        index.update()
+    subject_lesions = {}
+    for lesion_path, subject in lesion_dict.items():
+        subject_lesions.setdefault(subject, []).append(lesion_path)
+    pool = engine_pool.get_engine_pool(nb_workers)
+    output_dict = {}
+    with ThreadPoolExecutor(max(nb_workers, 1)) as executor:
+        futures = {executor.submit(_subject_lesions_to_native_space, pool, subject, lesion_paths, output_folder,
+                                   index, b0_dict, backend): subject
+                   for subject, lesion_paths in subject_lesions.items()}
+        for future in as_completed(futures):
+            subject = futures[future]
+            try:
+                output_dict.update(zip(subject_lesions[subject], future.result()))
+            except Exception as e:
+                error_dir = Path(output_folder, 'errors')
+                error_dir.mkdir(exist_ok=True)
+                Path(error_dir, subject + '_error.txt').write_text('ERROR WITH KEY [{}]:\n{}'.format(subject, e))
+    print('{} lesions out of {} brought to the native space ({} subjects)'.format(
+        len(output_dict), len(lesion_dict), len(subject_lesions)))
+    return output_dict
@@ -4,7 +4,7 @@ import importlib_resources as rsc
 import argparse
 import json
 
-from mri_preprocessing.modules import preproc, data_access, utils
+from mri_preprocessing.modules import preproc, data_access, preproc_index, sharding, admission
 
 
 def my_join(folder, file):
@@ -19,11 +19,68 @@ def main():
     #                                                                 ' containing DWI images')
     paths_group.add_argument('-d', '--input_dict', type=str, help='File path to a __dict_save json or '
                                                                   '__final_image_dict.json type file')
+    paths_group.add_argument('-m', '--merge', action='store_true',
+                             help='final step of a sharded run (see --shard): check that every shard is done, index '
+                                  'the outputs and aggregate the traces')
     parser.add_argument('-o', '--output', type=str, help='output folder')
     parser.add_argument('-is', '--ignore_singletons', action='store_true', help='Turn off the research for matching '
                                                                                 'images in case of singletons')
     parser.add_argument('-vs', '--voxel_size', type=float, default=2, help='output voxel size (default 2 for 2*2*2)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of subjects preprocessed in parallel, each '
+                                                                  'worker process running its own matlab engine '
+                                                                  '(-1 to use all the cores, default 1)')
+    parser.add_argument('-eps', '--engines_per_subject', type=int, default=1,
+                        help='number of matlab engines each worker can use to run the independent steps of a subject '
+                             'at the same time (default 1)')
+    parser.add_argument('-rb', '--reslice_backend', type=str, default='matlab', choices=preproc.backends,
+                        help='reslice the images with run_bb_spm in matlab or with scipy in python (native), which '
+                             'frees the matlab engines for the other steps (default matlab)')
+    parser.add_argument('-wb', '--warp_backend', type=str, default='matlab', choices=preproc.backends,
+                        help='apply the deformation field with SPM in matlab or with scipy in python (native), which '
+                             'reads the field once for all the b-values (default matlab)')
+    parser.add_argument('-lt', '--lease_ttl', type=float,
+                        help='share the output folder between several nodes: each subject is leased by the worker '
+                             'preprocessing it and a lease not refreshed for LEASE_TTL seconds (crashed node) is '
+                             'reclaimed (e.g. 600, default: no leases)')
+    parser.add_argument('--engine_max_subjects', type=int,
+                        help='restart a matlab engine after it preprocessed ENGINE_MAX_SUBJECTS subjects '
+                             '(default: never)')
+    parser.add_argument('--engine_max_rss', type=float,
+                        help='restart a matlab engine when its memory use goes above ENGINE_MAX_RSS GB '
+                             '(default: never)')
+    parser.add_argument('--step_timeout', type=float,
+                        help='consider an engine hung when a preprocessing step takes more than STEP_TIMEOUT seconds '
+                             '(default: no timeout)')
+    parser.add_argument('--retries', type=int, default=2,
+                        help='number of times a subject is retried on a fresh engine after its engine died or hung '
+                             '(default 2)')
+    parser.add_argument('-or', '--orchestration', type=str, default='sync', choices=preproc.orchestrations,
+                        help='asyncio runs the python work of a subject (gmean, copies, cache) in threads while the '
+                             'engines compute and, with --jobs 1, prepares the next subject during the registration '
+                             'of the current one (default sync)')
+    parser.add_argument('-mb', '--memory_budget', type=str,
+                        help='with --jobs, only start a subject while the estimated memory of the running subjects '
+                             '(matlab engines included) fits in MEMORY_BUDGET GB, or auto for 90%% of the available '
+                             'memory. The estimates are corrected with the measured peaks (default: no budget)')
+    parser.add_argument('--shard', type=str,
+                        help='INDEX/COUNT: only preprocess the INDEX-th (from 0) of COUNT shards of similar cost '
+                             '(e.g. --shard $SLURM_ARRAY_TASK_ID/$SLURM_ARRAY_TASK_COUNT), run --merge at the end')
+    parser.add_argument('-kf', '--keys-file', dest='keys_file', type=str,
+                        help='text file with the keys of the subjects to preprocess (one per line)')
+    parser.add_argument('-ej', '--export_json', action='store_true',
+                        help='also export the preprocessing index as the legacy __final_preproc_dict.json')
     args = parser.parse_args()
+    if args.output is None:
+        parser.error('--merge requires -o/--output' if args.merge else 'the preprocessing requires -o/--output')
+    if args.merge:
+        if not Path(args.output).is_dir():
+            raise ValueError('{} is not an existing output directory'.format(args.output))
+        sharding.merge_shards(args.output, args.export_json)
+        return
+    shard = sharding.parse_shard(args.shard) if args.shard is not None else None
+    memory_budget = admission.parse_budget(args.memory_budget) if args.memory_budget is not None else None
+    engine_max_rss = int(args.engine_max_rss * 1024 ** 3) if args.engine_max_rss is not None else None
+    keys = sharding.read_keys_file(args.keys_file) if args.keys_file is not None else None
     if args.input_path is not None:
         if not Path(args.input_path).is_dir():
             raise ValueError('{} is not an existing input directory'.format(args.input_path))
@@ -47,9 +104,26 @@ def main():
     else:
         pair_singletons = True
     output_preproc_dict = preproc.preproc_from_dataset_dict(json_dict, output_root,
-                                                            rerun_strat='resume', output_vox_size=args.voxel_size,
+                                                            rerun_strat='resume', nb_cores=args.jobs,
+                                                            engines_per_subject=args.engines_per_subject,
+                                                            reslice_backend=args.reslice_backend,
+                                                            warp_backend=args.warp_backend,
+                                                            lease_ttl=args.lease_ttl, keys=keys, shard=shard,
+                                                            engine_max_subjects=args.engine_max_subjects,
+                                                            engine_max_rss=engine_max_rss,
+                                                            step_timeout=args.step_timeout, max_retries=args.retries,
+                                                            memory_budget=memory_budget,
+                                                            orchestration=args.orchestration,
+                                                            output_vox_size=args.voxel_size,
                                                             pair_singletons=pair_singletons)
-    utils.generate_final_preproc_dict(output_root)
+    if shard is not None:
+        # The shards run at the same time, the index is updated once by --merge
+        return
+    # Only the subject folders modified since the last run are read again
+    index = preproc_index.PreprocIndex(output_root)
+    index.update()
+    if args.export_json:
+        index.export_json()
     # output_json_file_path = Path(output_root, '__final_preproc_dict.json')
     # with open(output_json_file_path, 'w+') as out_file:
     #     json.dump(output_preproc_dict, out_file, indent=4)
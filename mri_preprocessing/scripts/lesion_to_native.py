@@ -0,0 +1,35 @@
+from pathlib import Path
+import argparse
+import json
+
+from mri_preprocessing.modules import utils
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bring MNI space lesions to the native space of their subject')
+    parser.add_argument('-l', '--lesion_dict', type=str, required=True,
+                        help='json file {lesion_path: subject key}')
+    parser.add_argument('-o', '--output', type=str, required=True,
+                        help='output folder (one folder per subject)')
+    parser.add_argument('-p', '--preproc_root', type=str,
+                        help='output folder of dwi_preproc where the inverse deformation fields are looked up')
+    parser.add_argument('-b0', '--b0_dict', type=str,
+                        help='json file {subject key: b0_path} used to compute the missing inverse deformation fields')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of subjects processed in parallel (and of matlab engines) (default 1)')
+    parser.add_argument('-b', '--backend', type=str, default='native', choices=['matlab', 'native'],
+                        help='apply the inverse fields with scipy in python (native) or with SPM in matlab '
+                             '(default native)')
+    args = parser.parse_args()
+    if not Path(args.lesion_dict).is_file():
+        raise ValueError('{} is not an existing json'.format(args.lesion_dict))
+    b0_dict = None
+    if args.b0_dict is not None:
+        if not Path(args.b0_dict).is_file():
+            raise ValueError('{} is not an existing json'.format(args.b0_dict))
+        b0_dict = json.load(open(args.b0_dict, 'r'))
+    output_dict = utils.lesions_to_native_space(args.lesion_dict, args.output, args.preproc_root, b0_dict,
+                                                args.workers, args.backend)
+    with open(Path(args.output, '__native_space_dict.json'), 'w+') as out_file:
+        json.dump(output_dict, out_file, indent=4)
+    return
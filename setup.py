@@ -39,7 +39,8 @@ setup(
     # https://reinout.vanrees.org/weblog/2010/01/06/zest-releaser-entry-points.html
     # entry_points could be used to automagically download dcm2niix depending on the OS of the user
     entry_points={
-        'console_scripts': ['dwi_preproc = mri_preprocessing.scripts.dwi_preproc:main']
+        'console_scripts': ['dwi_preproc = mri_preprocessing.scripts.dwi_preproc:main',
+                            'lesion_to_native = mri_preprocessing.scripts.lesion_to_native:main']
         # 'console_scripts': ['dicom_conversion = data_identification.scripts.dicom_conversion:convert']
     },
 
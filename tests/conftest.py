@@ -0,0 +1,30 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+root = Path(__file__).absolute().parent.parent
+# The fake matlab.engine of the benchmarks replaces matlab in the tests
+sys.path.insert(0, str(Path(root, 'benchmarks', 'fake_matlab')))
+sys.path.insert(1, str(root))
+# synthetic cohorts
+sys.path.insert(2, str(Path(root, 'benchmarks')))
+
+
+@pytest.fixture(autouse=True)
+def fake_engine_environment(monkeypatch, tmp_path):
+    monkeypatch.setenv('MRI_PREPROC_FAKE_ENGINE_LATENCY', '0')
+    monkeypatch.delenv('MRI_PREPROC_FAKE_ENGINE_CRASH_AFTER', raising=False)
+    # the toolbox paths of the user are neither used nor modified
+    monkeypatch.setenv('MRI_PREPROC_CONFIG', str(Path(tmp_path, 'toolbox_paths.json')))
+    for variable in ['MRI_PREPROC_SPM_PATH', 'MRI_PREPROC_SUPERRES_PATH', 'MRI_PREPROC_PATIENT_PREPROC_PATH']:
+        path = Path(tmp_path, 'toolboxes', variable)
+        os.makedirs(path, exist_ok=True)
+        monkeypatch.setenv(variable, str(path))
+    yield
+    # every test starts with a new engine pool
+    from mri_preprocessing.modules import engine_pool
+    if engine_pool._default_pool is not None:
+        engine_pool._default_pool.close()
+        engine_pool._default_pool = None
@@ -0,0 +1,83 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import nibabel as nib
+import numpy as np
+
+from mri_preprocessing.modules import admission
+
+
+def _controller(budget, **kwargs):
+    # no engine: the estimate is bytes_per_voxel * voxels
+    return admission.AdmissionController(budget * admission.bytes_per_voxel, engines=0, **kwargs)
+
+
+def test_admission_within_the_budget():
+    controller = _controller(10)
+    assert controller.try_admit('a', 6)
+    assert not controller.try_admit('b', 6)
+    assert controller.try_admit('c', 4)
+    assert controller.in_use() == 10 * admission.bytes_per_voxel
+    controller.release('a')
+    assert controller.try_admit('b', 6)
+
+
+def test_subject_above_the_budget_runs_alone():
+    controller = _controller(10)
+    assert controller.try_admit('a', 20)
+    assert not controller.try_admit('b', 1)
+
+
+def test_estimates_follow_the_measured_peaks(tmp_path):
+    state_path = tmp_path / admission.state_name
+    controller = _controller(100, state_path=state_path)
+    controller.try_admit('a', 10)
+    controller.release('a', 3 * 10 * admission.bytes_per_voxel)
+    assert controller.estimate(10) == 3 * 10 * admission.bytes_per_voxel
+    assert json.loads(state_path.read_text()) == {'ratios': [3.]}
+    # the next runs start from the saved correction
+    assert _controller(100, state_path=state_path).correction() == 3.
+
+
+def _run(keys, voxels, budget, max_running, **kwargs):
+    controller = _controller(budget)
+    submitted = []
+    reserved = []
+    with ThreadPoolExecutor(max_running) as executor:
+        def submit(key):
+            submitted.append(key)
+            reserved.append(controller.in_use())
+            return executor.submit(time.sleep, 0.05)
+
+        finished = [k for k, _ in admission.run_admitted(keys, submit, controller, voxels, max_running, **kwargs)]
+    return controller, submitted, reserved, finished
+
+
+def test_run_admitted_accounting():
+    voxels = {'k{}'.format(i): 2 + i % 3 for i in range(8)}
+    controller, submitted, reserved, finished = _run(list(voxels), voxels, 6, 4)
+    assert sorted(finished) == sorted(submitted) == sorted(voxels)
+    assert max(reserved) <= 6 * admission.bytes_per_voxel
+    assert controller.reserved == {}
+
+
+def test_large_subject_is_not_starved():
+    keys = ['small0', 'large'] + ['small{}'.format(i) for i in range(1, 10)]
+    voxels = {k: 5 if k == 'large' else 2 for k in keys}
+    _, submitted, _, _ = _run(keys, voxels, 6, 3, max_bypass=2)
+    # only two small subjects go ahead of the large one
+    assert submitted[:4] == ['small0', 'small1', 'small2', 'large']
+
+
+def test_unreadable_subject_gets_the_prior(tmp_path, capsys):
+    nib.save(nib.Nifti1Image(np.zeros((2, 3, 4), dtype=np.uint8), np.eye(4)), str(tmp_path / 'a.nii'))
+    (tmp_path / 'b.nii').write_bytes(b'not an image')
+    split_dwi_dict = {'a': {str(tmp_path / 'a.nii'): 0},
+                      'b': {str(tmp_path / 'a.nii'): 0, str(tmp_path / 'b.nii'): 1000},
+                      'c': {str(tmp_path / 'missing.nii'): 0}}
+    voxels = admission.subject_voxels(split_dwi_dict)
+    assert voxels == {'a': 24, 'b': 0, 'c': 0}
+    assert 'b.nii' in capsys.readouterr().out
+    controller = admission.AdmissionController(10 * admission.engine_bytes)
+    assert controller.estimate(voxels['b']) == admission.engine_bytes
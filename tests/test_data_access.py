@@ -0,0 +1,34 @@
+import nibabel as nib
+import numpy as np
+import pytest
+
+from mri_preprocessing.modules import data_access
+
+
+def _save(path, data, affine):
+    nib.save(nib.Nifti1Image(data, affine), str(path))
+    return str(path)
+
+
+def test_running_stats_match_numpy():
+    images = np.random.RandomState(0).rand(5, 3, 4, 2)
+    stats = data_access.RunningStats(images.shape[1:], np.eye(4))
+    for data in images:
+        stats.add(data, np.eye(4))
+    np.testing.assert_allclose(stats.mean, images.mean(axis=0))
+    np.testing.assert_allclose(stats.std(ddof=0), images.std(axis=0))
+
+
+def test_running_stats_reject_other_affines():
+    stats = data_access.RunningStats((3, 4, 2), np.eye(4))
+    stats.add(np.zeros((3, 4, 2)), np.eye(4))
+    with pytest.raises(ValueError):
+        stats.add(np.zeros((3, 4, 2)), np.diag([2., 2., 2., 1.]))
+    assert stats.count == 1
+
+
+def test_average_of_images_with_different_affines(tmp_path):
+    paths = [_save(tmp_path / 'a.nii', np.ones((3, 4, 2)), np.eye(4)),
+             _save(tmp_path / 'b.nii', np.ones((3, 4, 2)), np.diag([-1., 1., 1., 1.]))]
+    with pytest.raises(ValueError):
+        data_access.average_image_list(paths, tmp_path / 'mean.nii', 'mean')
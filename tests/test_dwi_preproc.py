@@ -0,0 +1,23 @@
+import sys
+
+import pytest
+
+from mri_preprocessing.scripts import dwi_preproc
+
+
+@pytest.mark.parametrize('argv, message', [
+    (['-m'], '--merge requires -o/--output'),
+    (['-d', 'dataset.json'], 'the preprocessing requires -o/--output'),
+])
+def test_output_is_required(argv, message, monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', ['dwi_preproc'] + argv)
+    with pytest.raises(SystemExit) as error:
+        dwi_preproc.main()
+    assert error.value.code == 2
+    assert message in capsys.readouterr().err
+
+
+def test_merge_of_an_empty_output(monkeypatch, tmp_path, capsys):
+    monkeypatch.setattr(sys, 'argv', ['dwi_preproc', '-m', '-o', str(tmp_path)])
+    dwi_preproc.main()
+    assert '0 subjects preprocessed' in capsys.readouterr().out
@@ -0,0 +1,85 @@
+import time
+from concurrent.futures import Future
+
+import matlab.engine
+import pytest
+
+from mri_preprocessing.modules import engine_pool
+
+
+def _wait_until(condition, timeout=2.):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_warm_acquisitions_reuse_the_engine():
+    pool = engine_pool.EnginePool(1)
+    engine = pool.acquire()
+    pool.release(engine)
+    assert pool.acquire() is engine
+    assert pool.stats()['cold_acquisitions'] == 1
+    assert pool.stats()['warm_acquisitions'] == 1
+
+
+def test_try_acquire_counts_the_uses():
+    pool = engine_pool.EnginePool(1, max_uses=2)
+    engine = pool.acquire()
+    pool.release(engine)
+    assert pool.try_acquire() is engine
+    pool.release(engine)
+    # recycled after its second use
+    assert pool.stats()['engines_recycled'] == 1
+    assert pool.try_acquire() is None
+
+
+def test_try_acquire_discards_dead_engines():
+    pool = engine_pool.EnginePool(2)
+    engine = pool.acquire()
+    pool.release(engine)
+    engine.dead = True
+    assert pool.try_acquire() is None
+    assert pool.stats()['engines_discarded'] == 1
+    assert pool.acquire() is not engine
+
+
+def test_acquire_replaces_dead_engines():
+    pool = engine_pool.EnginePool(1)
+    engine = pool.acquire()
+    pool.release(engine)
+    engine.dead = True
+    new_engine = pool.acquire()
+    assert new_engine is not engine
+    assert pool.stats()['engines_discarded'] == 1
+
+
+def test_release_recycles_engines_above_max_rss():
+    pool = engine_pool.EnginePool(1, max_rss=1)
+    engine = pool.acquire()
+    pool.release(engine)
+    assert pool.stats()['engines_recycled'] == 1
+
+
+def test_start_quits_the_started_engines_if_one_fails(monkeypatch):
+    quit_engines = []
+    monkeypatch.setattr(matlab.engine.FakeEngine, 'quit', lambda self: quit_engines.append(self))
+    started = matlab.engine.FakeEngine()
+    futures = [Future(), Future()]
+    futures[0].set_result(started)
+    futures[1].set_exception(matlab.engine.EngineError('MATLAB could not start'))
+    monkeypatch.setattr(engine_pool, '_start_matlab', lambda background=False: futures.pop(0))
+    pool = engine_pool.EnginePool(2)
+    with pytest.raises(matlab.engine.EngineError):
+        pool.start()
+    assert _wait_until(lambda: quit_engines == [started])
+    stats = pool.stats()
+    assert stats['engines_started'] == 0
+    # the reserved slots are given back
+    assert pool._in_use == 0 and not pool._idle
+
+
+def test_is_engine_failure():
+    assert engine_pool.is_engine_failure(engine_pool.EngineTimeout())
+    assert engine_pool.is_engine_failure(matlab.engine.EngineError())
+    assert not engine_pool.is_engine_failure(ValueError())
@@ -0,0 +1,29 @@
+import json
+
+import nibabel as nib
+import numpy as np
+
+from mri_preprocessing.modules import extra_utils, preproc_index
+
+
+def _save(path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    nib.save(nib.Nifti1Image(np.zeros((2, 2, 2), dtype=np.float32), np.eye(4)), str(path))
+
+
+def test_apply_transform_dataset_only_fills_the_subject_folders(tmp_path):
+    tmp_path = tmp_path / 'output'
+    subject = tmp_path / 'sub1'
+    _save(subject / 'resliced_co-rigid_rigid_geomean_denoise_sub1__bval1000.nii')
+    _save(subject / 'tmp' / 'co-rigid_rigid_geomean_denoise_sub1__bval1000.nii')
+    _save(subject / 'tmp' / 'y_co-rigid_rigid_geomean_denoise_sub1__bval1000.nii')
+    for bookkeeping in ['__leases', '__shards', 'errors', '.hidden', 'tmp', 'sub1/tmp/.step_cache']:
+        (tmp_path / bookkeeping).mkdir(parents=True, exist_ok=True)
+    output_dict = extra_utils.apply_transform_dataset(tmp_path)
+    assert list(output_dict) == ['sub1']
+    assert output_dict['sub1']['nonlinear']['1000.0'].endswith(
+        'non_linear_co-rigid_rigid_geomean_denoise_sub1__bval1000.nii')
+    assert sorted(p.relative_to(tmp_path).as_posix() for p in tmp_path.rglob('__preproc_dict.json')) == \
+        ['sub1/__preproc_dict.json']
+    assert json.loads((subject / '__preproc_dict.json').read_text()) == output_dict
+    assert list(preproc_index.PreprocIndex(tmp_path).keys()) == ['sub1']
@@ -0,0 +1,92 @@
+import json
+import os
+import time
+from pathlib import Path
+
+import pytest
+
+import synthetic
+from mri_preprocessing.modules import lease, preproc
+
+
+def _write_lease(output_root, key, owner, age=0.):
+    path = Path(output_root, lease.lease_dir_name, '{}.lease'.format(key))
+    os.makedirs(path.parent, exist_ok=True)
+    path.write_text(json.dumps({'owner': owner, 'acquired': time.time()}))
+    os.utime(str(path), (time.time() - age, time.time() - age))
+    return path
+
+
+def test_acquire_is_exclusive(tmp_path):
+    first = lease.LeaseManager(tmp_path, ttl=60, owner='first')
+    second = lease.LeaseManager(tmp_path, ttl=60, owner='second')
+    assert first.acquire('sub')
+    assert first.acquire('sub')
+    assert not second.acquire('sub')
+    first.release('sub')
+    assert second.acquire('sub')
+    first.close()
+    second.close()
+
+
+def test_expired_lease_is_reclaimed(tmp_path):
+    _write_lease(tmp_path, 'sub', 'crashed', age=120)
+    manager = lease.LeaseManager(tmp_path, ttl=60, owner='new')
+    assert manager.is_expired('sub')
+    assert manager.acquire('sub')
+    assert json.loads(Path(tmp_path, lease.lease_dir_name, 'sub.lease').read_text())['owner'] == 'new'
+    # no tombstone is left behind
+    assert sorted(p.name for p in Path(tmp_path, lease.lease_dir_name).iterdir()) == ['sub.lease']
+    manager.close()
+
+
+def test_valid_lease_is_not_reclaimed(tmp_path):
+    _write_lease(tmp_path, 'sub', 'alive', age=10)
+    manager = lease.LeaseManager(tmp_path, ttl=60, owner='new')
+    assert manager.is_leased('sub')
+    assert not manager.acquire('sub')
+    manager.close()
+
+
+def test_heartbeat_refreshes_and_detects_lost_leases(tmp_path):
+    manager = lease.LeaseManager(tmp_path, ttl=1, heartbeat_interval=0.05, owner='worker')
+    assert manager.acquire('sub')
+    time.sleep(1.2)
+    assert not manager.is_expired('sub')
+    manager.check('sub')
+    # another worker reclaimed the lease
+    _write_lease(tmp_path, 'sub', 'other')
+    time.sleep(0.3)
+    assert manager.is_lost('sub')
+    with pytest.raises(lease.LeaseLost):
+        manager.check('sub')
+    manager.close()
+
+
+def test_subject_of_a_crashed_node_is_taken_over(tmp_path):
+    json_path = synthetic.make_cohort(tmp_path / 'input', 3, 2, shape=(16, 16, 8))
+    output_root = tmp_path / 'output'
+    os.makedirs(output_root)
+    # lease of a node which crashed just now: valid for one more second, never refreshed
+    _write_lease(output_root, 'sub00001', 'crashed')
+    output_dict = preproc.preproc_from_dataset_dict(json_path, output_root, lease_ttl=1, pair_singletons=False)
+    assert sorted(output_dict) == ['sub00000', 'sub00001', 'sub00002']
+
+
+def test_subject_stops_when_its_lease_is_lost(tmp_path, monkeypatch):
+    json_path = synthetic.make_cohort(tmp_path / 'input', 1, 2, shape=(16, 16, 8))
+    split_dwi_dict = preproc.data_access.get_split_dict_from_json(json_path)
+    output_root = tmp_path / 'output'
+    os.makedirs(output_root)
+    checks = []
+
+    def check(self, key):
+        checks.append(key)
+        # lost after the first stage
+        if len(checks) > 1:
+            raise lease.LeaseLost('The lease of {} was reclaimed by another worker'.format(key))
+    monkeypatch.setattr(lease.LeaseManager, 'check', check)
+    assert preproc.partial_preproc_from_dataset_dict(split_dwi_dict, 'sub00000', output_root, lease_ttl=60) == {}
+    assert len(checks) == 2
+    assert not Path(output_root, 'errors').exists()
+    assert not Path(output_root, 'sub00000', '__preproc_dict.json').exists()
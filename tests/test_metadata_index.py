@@ -0,0 +1,37 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from mri_preprocessing.modules import metadata_index
+
+
+def _dataset(tmp_path, nb_subjects=20):
+    json_dict = {}
+    for i in range(nb_subjects):
+        metadata_path = tmp_path / 'sub{}.json'.format(i)
+        metadata_path.write_text(json.dumps(
+            {metadata_index.metadata_tag('StudyInstanceUID'): {'vr': 'UI', 'Value': ['1.2.{}'.format(i % 3)]}}))
+        json_dict['sub{}'.format(i)] = {'metadata': str(metadata_path)}
+    return json_dict
+
+
+def test_index_is_cached(tmp_path, monkeypatch):
+    json_dict = _dataset(tmp_path)
+    cache_path = tmp_path / metadata_index.cache_name
+    index = metadata_index.build_metadata_index(json_dict, cache_path=cache_path)
+    assert metadata_index.attribute_value(index, 'sub4', 'StudyInstanceUID') == '1.2.1'
+    assert cache_path.is_file()
+    # read from the cache, the files are not opened again
+    monkeypatch.setattr(metadata_index, '_read_attributes', None)
+    assert metadata_index.build_metadata_index(json_dict, cache_path=cache_path) == index
+
+
+def test_concurrent_builds_write_their_own_temporary_file(tmp_path, capsys):
+    json_dict = _dataset(tmp_path)
+    cache_path = tmp_path / metadata_index.cache_name
+    with ThreadPoolExecutor(8) as executor:
+        indexes = list(executor.map(lambda _: metadata_index.build_metadata_index(json_dict, cache_path=cache_path,
+                                                                                  nb_threads=1), range(16)))
+    assert all(index == indexes[0] for index in indexes)
+    assert 'Could not save' not in capsys.readouterr().out
+    assert json.loads(cache_path.read_text())
+    assert not list(tmp_path.glob('.*.tmp'))
@@ -0,0 +1,145 @@
+import json
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from mri_preprocessing.modules import orientation
+
+with open(Path(Path(__file__).parent, 'data', 'nm_reorient_reference.json'), 'r') as f:
+    nm_reorient_cases = {case['name']: case for case in json.load(f)['cases']}
+
+
+def _save(path, data, affine, slope=1., inter=0.):
+    img = nib.Nifti1Image(data, affine)
+    img.header.set_slope_inter(slope, inter)
+    nib.save(img, str(path))
+    return path
+
+
+def _reference(monkeypatch, img_path, output_folder):
+    # reslicing on the world axes like nm_reorient, whatever the orientation of the image
+    with monkeypatch.context() as m:
+        m.setattr(orientation, '_signed_permutation', lambda r: None)
+        return nib.load(orientation.reset_orient_mat(img_path, output_folder, prefix='ref_'))
+
+
+def _ramp(shape):
+    return np.arange(np.prod(shape), dtype=np.int16).reshape(shape)
+
+
+def _axes_affine(columns, origin):
+    affine = np.eye(4)
+    affine[:3, :3] = np.array(columns, dtype=float).T
+    affine[:3, 3] = origin
+    return affine
+
+
+@pytest.mark.parametrize('columns', [
+    [[1, 0, 0], [0, 1, 0], [0, 0, 1]],
+    [[-1, 0, 0], [0, 1, 0], [0, 0, 1]],
+    [[0, 1, 0], [0, 0, -1], [-1, 0, 0]],
+    [[0, 0, 1], [1, 0, 0], [0, -1, 0]],
+])
+def test_permuted_axes_give_the_resliced_values(columns, monkeypatch, tmp_path):
+    img_path = _save(tmp_path / 'img.nii', _ramp((4, 5, 6)), _axes_affine(columns, [-10, 7, 3]), slope=2., inter=1.)
+    out = nib.load(orientation.reset_orient_mat(img_path, tmp_path))
+    ref = _reference(monkeypatch, img_path, tmp_path)
+    assert out.shape == ref.shape
+    np.testing.assert_allclose(out.affine, ref.affine)
+    np.testing.assert_allclose(out.get_fdata(), ref.get_fdata(), atol=1e-4)
+    # the raw values are not interpolated, the scaling is kept
+    assert out.get_data_dtype() == np.int16
+    assert out.dataobj.slope == 2. and out.dataobj.inter == 1.
+
+
+def test_oriented_image_keeps_its_data(tmp_path):
+    data = _ramp((4, 5, 6))
+    img_path = _save(tmp_path / 'img.nii.gz', data, _axes_affine(np.eye(3), [-10, 7, 3]), slope=2., inter=1.)
+    out_path = orientation.reset_orient_mat(img_path, tmp_path)
+    assert out_path.endswith('reo_img.nii')
+    out = nib.load(out_path)
+    np.testing.assert_array_equal(out.get_fdata(), data * 2. + 1.)
+    np.testing.assert_allclose(out.affine, orientation.reset_origin_affine([1, 1, 1], data.shape))
+
+
+def _save_pair(path, data, affine, slope=1., inter=0.):
+    img = nib.Nifti1Pair(data, affine)
+    img.header.set_slope_inter(slope, inter)
+    nib.save(img, str(path))
+    return path
+
+
+def test_oriented_pair_keeps_its_data(tmp_path):
+    data = _ramp((4, 5, 6))
+    img_path = _save_pair(tmp_path / 'img.hdr', data, _axes_affine(np.eye(3), [-10, 7, 3]), slope=2., inter=1.)
+    out_path = orientation.reset_orient_mat(img_path, tmp_path)
+    assert (tmp_path / 'reo_img.img').is_file()
+    out = nib.load(out_path)
+    assert isinstance(out, nib.Nifti1Pair) and out.get_data_dtype() == np.int16
+    assert out.dataobj.slope == 2. and out.dataobj.inter == 1.
+    np.testing.assert_array_equal(out.get_fdata(), data * 2. + 1.)
+    np.testing.assert_allclose(out.affine, orientation.reset_origin_affine([1, 1, 1], data.shape))
+
+
+def test_permuted_pair_is_written_like_the_single_file(tmp_path):
+    data = _ramp((4, 5, 6))
+    affine = _axes_affine([[0, 1, 0], [0, 0, -1], [-1, 0, 0]], [-10, 7, 3])
+    pair = nib.load(orientation.reset_orient_mat(_save_pair(tmp_path / 'img.hdr', data, affine, 2., 1.), tmp_path))
+    single = nib.load(orientation.reset_orient_mat(_save(tmp_path / 'img.nii', data, affine, 2., 1.), tmp_path))
+    assert isinstance(pair, nib.Nifti1Pair) and pair.get_data_dtype() == np.int16
+    assert pair.dataobj.slope == 2. and pair.dataobj.inter == 1.
+    np.testing.assert_array_equal(pair.get_fdata(), single.get_fdata())
+    np.testing.assert_allclose(pair.affine, single.affine)
+
+
+@pytest.mark.parametrize('name', sorted(nm_reorient_cases))
+def test_grid_matches_nm_reorient(name):
+    case = nm_reorient_cases[name]
+    mat, dim = orientation.reoriented_grid(np.array(case['affine']), case['shape'])
+    np.testing.assert_allclose(mat, case['mat'], atol=1e-6)
+    assert dim == tuple(case['dim'])
+
+
+@pytest.mark.parametrize('name', ['oblique', 'anisotropic_permuted'])
+def test_resliced_values_match_nm_reorient(name, tmp_path):
+    case = nm_reorient_cases[name]
+    affine = np.array(case['affine'])
+    # linear in the world coordinates
+    ijk = np.indices(case['shape']).reshape(3, -1)
+    world = affine[:3, :3].dot(ijk) + affine[:3, 3:]
+    data = (np.array(case['coefficients'][:3]).dot(world) + case['coefficients'][3]).reshape(case['shape'])
+    img_path = _save(tmp_path / 'img.nii', data.astype(np.float32), affine)
+    out = nib.load(orientation.reset_orient_mat(img_path, tmp_path))
+    assert out.shape == tuple(case['dim'])
+    vox_size = np.sqrt(np.sum(np.array(case['mat'])[:3, :3] ** 2, axis=0))
+    np.testing.assert_allclose(out.affine, orientation.reset_origin_affine(vox_size, case['dim']), atol=1e-5)
+    out_data = out.get_fdata()
+    for voxel, value in case['samples']:
+        assert out_data[tuple(voxel)] == pytest.approx(value, abs=1e-3)
+
+
+def test_oblique_image_is_resliced_on_the_world_axes(tmp_path):
+    angle = np.pi / 8
+    rotation = np.array([[np.cos(angle), -np.sin(angle), 0], [np.sin(angle), np.cos(angle), 0], [0, 0, 1]])
+    affine = _axes_affine(rotation.T, [-5, -5, -4])
+    shape = (12, 12, 9)
+    # linear in the world coordinates, reproduced exactly by the trilinear interpolation
+    ijk = np.indices(shape).reshape(3, -1)
+    world = affine[:3, :3].dot(ijk) + affine[:3, 3:]
+    data = (world[0] + 2 * world[1] + 3 * world[2]).reshape(shape).astype(np.float32)
+    img_path = _save(tmp_path / 'img.nii', data, affine)
+    out = nib.load(orientation.reset_orient_mat(img_path, tmp_path))
+    # the affine stored in the header is rounded to float32
+    affine = nib.load(img_path).affine
+    mat, dim = orientation.reoriented_grid(affine, shape)
+    assert out.shape == dim
+    np.testing.assert_allclose(out.affine[:3, :3], np.diag(np.abs(np.diag(mat[:3, :3]))), atol=1e-6)
+    # value expected at each output voxel: the world position of the voxel in the original grid
+    out_ijk = np.indices(dim).reshape(3, -1)
+    out_world = mat.dot(np.vstack([out_ijk + 1, np.ones(out_ijk.shape[1])]))[:3]
+    in_ijk = np.linalg.inv(affine).dot(np.vstack([out_world, np.ones(out_world.shape[1])]))[:3]
+    inside = np.all((in_ijk >= 0) & (in_ijk <= np.array(shape)[:, None] - 1), axis=0)
+    expected = out_world[0] + 2 * out_world[1] + 3 * out_world[2]
+    np.testing.assert_allclose(out.get_fdata().reshape(-1)[inside], expected[inside], atol=1e-3)
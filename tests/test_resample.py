@@ -0,0 +1,50 @@
+import nibabel as nib
+import numpy as np
+
+from mri_preprocessing.modules import resample
+
+
+def test_bb_grid_is_las():
+    affine, shape = resample.bb_grid(2)
+    assert nib.aff2axcodes(affine) == ('L', 'A', 'S')
+    assert shape == (91, 109, 91)
+    np.testing.assert_allclose(affine.dot([0, 0, 0, 1])[:3], [90, -126, -72])
+    np.testing.assert_allclose(affine.dot(list(np.array(shape) - 1) + [1])[:3], [-90, 90, 108])
+
+
+def _marked_image(path, world):
+    # RAS image with a single voxel set at the world coordinates
+    affine = np.diag([2., 2., 2., 1.])
+    affine[:3, 3] = [-100, -130, -80]
+    data = np.zeros((101, 121, 101), dtype=np.int16)
+    data[tuple(np.round(np.linalg.inv(affine).dot(list(world) + [1])[:3]).astype(int))] = 1
+    nib.save(nib.Nifti1Image(data, affine), str(path))
+    return path
+
+
+def test_reslice_bb_keeps_the_sides(tmp_path):
+    img_path = _marked_image(tmp_path / 'img.nii', [30, 0, 10])
+    out = nib.load(resample.reslice_bb(img_path, tmp_path, 2, order=0))
+    voxel = np.argwhere(np.asanyarray(out.dataobj) == 1)
+    assert len(voxel) == 1
+    np.testing.assert_allclose(out.affine.dot(list(voxel[0]) + [1])[:3], [30, 0, 10])
+
+
+def test_spline_reslice_on_the_same_grid_keeps_the_values():
+    data = np.random.RandomState(0).rand(8, 9, 10).astype(np.float32)
+    affine = np.diag([-2., 2., 2., 1.])
+    for order in [1, 3, 4]:
+        resliced = resample.reslice_array(data, affine, affine, data.shape, order=order)
+        np.testing.assert_allclose(resliced, data, atol=1e-5)
+
+
+def test_identity_field_gives_the_resliced_image(tmp_path):
+    img_path = _marked_image(tmp_path / 'img.nii', [-40, 20, 0])
+    affine, shape = resample.bb_grid(2)
+    ijk = np.indices(shape).reshape(3, -1)
+    field = (affine[:3, :3].dot(ijk) + affine[:3, 3:]).T.reshape(shape + (1, 3)).astype(np.float32)
+    nib.save(nib.Nifti1Image(field, affine), str(tmp_path / 'y_img.nii'))
+    warped, = resample.apply_deformation([img_path], tmp_path / 'y_img.nii', tmp_path, 2, orders=0)
+    resliced = resample.reslice_bb(img_path, tmp_path, 2, order=0)
+    np.testing.assert_array_equal(nib.load(warped).get_fdata(), nib.load(resliced).get_fdata())
+    np.testing.assert_allclose(nib.load(warped).affine, nib.load(resliced).affine)
@@ -0,0 +1,61 @@
+import numpy as np
+import nibabel as nib
+from nibabel.volumeutils import array_to_file
+
+from mri_preprocessing.modules import rigid_affine_only
+
+
+def _write_scaled(path, raw, slope, inter):
+    header = nib.Nifti1Header()
+    header.set_data_dtype(raw.dtype)
+    header.set_data_shape(raw.shape)
+    header.set_slope_inter(slope, inter)
+    header.set_sform(np.eye(4), code='aligned')
+    header.set_qform(np.eye(4), code='aligned')
+    with open(path, 'wb') as f:
+        header.write_to(f)
+        array_to_file(raw, f, raw.dtype, offset=header.get_data_offset(), order='F')
+
+
+def test_with_affine_keeps_the_scaling(tmp_path):
+    mask_path = tmp_path / 'mask.nii'
+    _write_scaled(mask_path, np.arange(5, dtype=np.int16).reshape(5, 1, 1), 2, 1)
+    assert np.array_equal(nib.load(str(mask_path)).get_fdata().ravel(), [1, 3, 5, 7, 9])
+    affine = np.diag([2., 3., 4., 1.])
+    affine[:3, 3] = [10, 20, 30]
+    output = rigid_affine_only._with_affine(mask_path, tmp_path / 'moved.nii', affine)
+    out = nib.load(output)
+    assert np.array_equal(out.get_fdata().ravel(), [1, 3, 5, 7, 9])
+    assert np.allclose(out.affine, affine)
+    assert out.header.get_data_dtype() == np.int16
+
+
+def test_with_affine_keeps_the_data_offset(tmp_path):
+    img = nib.Nifti1Image(np.arange(24, dtype=np.float32).reshape(2, 3, 4), np.eye(4))
+    # an extension moves the data further in the file
+    img.header.extensions.append(nib.nifti1.Nifti1Extension('comment', b'x' * 100))
+    nib.save(img, str(tmp_path / 'img.nii'))
+    output = rigid_affine_only._with_affine(tmp_path / 'img.nii', tmp_path / 'moved.nii', np.diag([2., 2., 2., 1.]))
+    assert np.array_equal(nib.load(output).get_fdata(), np.arange(24).reshape(2, 3, 4))
+
+
+def test_img_mask_batch_outputs_are_the_same_with_both_backends(tmp_path):
+    affine = np.diag([2., 2., 2., 1.])
+    affine[:3, 3] = [-20, -20, -10]
+    nib.save(nib.Nifti1Image(np.random.default_rng(0).random((20, 20, 10), dtype=np.float32), affine),
+             str(tmp_path / 'img.nii'))
+    nib.save(nib.Nifti1Image((np.arange(4000) % 3).reshape(20, 20, 10).astype(np.uint8), affine),
+             str(tmp_path / 'mask.nii'))
+    outputs = {}
+    for backend in ['matlab', 'native']:
+        results = rigid_affine_only.rigid_affine_only_img_mask_batch(
+            {str(tmp_path / 'img.nii'): str(tmp_path / 'mask.nii')}, tmp_path / backend, reslice_backend=backend)
+        outputs[backend] = results[str(tmp_path / 'img.nii')]
+    assert sorted(outputs['matlab']) == sorted(outputs['native'])
+    for backend in outputs:
+        # the rigid and affine masks are copies of the reset mask with the affines of the aligned images
+        assert 'rigid_mask' in outputs[backend]['rigid_mask']
+        rigid_mask = nib.load(outputs[backend]['rigid_mask'])
+        assert np.allclose(rigid_mask.affine, nib.load(outputs[backend]['rigid']).affine)
+    resliced_mask = nib.load(outputs['native']['rigid_resliced_mask'])
+    assert set(np.unique(np.asanyarray(resliced_mask.dataobj))) <= {0, 1, 2}
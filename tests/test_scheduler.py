@@ -0,0 +1,96 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from mri_preprocessing.modules import engine_pool, scheduler
+
+
+def _run_dag(orchestration, *args, **kwargs):
+    if orchestration == 'asyncio':
+        return scheduler.run_coroutine(scheduler.run_dag_async(*args, **kwargs))
+    return scheduler.run_dag(*args, **kwargs)
+
+
+orchestrations = ['sync', 'asyncio']
+
+
+def _diamond(calls):
+    def step(name, deps=(), post=None):
+        def fn(eng, results):
+            calls.append(name)
+            return ''.join(results[d] for d in deps) + name
+        return scheduler.Step(name, fn, deps, needs_engine=False, post=post)
+
+    return [step('d', ['b', 'c']), step('b', ['a']), step('c', ['a'], lambda value, results: value.upper()),
+            step('a')]
+
+
+@pytest.mark.parametrize('orchestration', orchestrations)
+def test_steps_run_after_their_dependencies(orchestration):
+    calls = []
+    done = []
+    results = _run_dag(orchestration, _diamond(calls), on_done=lambda step, value: done.append(step.name))
+    assert calls[0] == 'a' and calls[-1] == 'd' and sorted(calls) == ['a', 'b', 'c', 'd']
+    assert sorted(done) == ['a', 'b', 'c', 'd']
+    assert results['c'] == 'AC'
+    assert results['d'] == 'abACd'
+
+
+@pytest.mark.parametrize('orchestration', orchestrations)
+def test_given_results_are_not_run_again(orchestration):
+    calls = []
+    results = _run_dag(orchestration, _diamond(calls), results={'a': 'x', 'b': 'y'})
+    assert sorted(calls) == ['c', 'd']
+    assert results['d'] == 'yXCd'
+
+
+@pytest.mark.parametrize('orchestration', orchestrations)
+def test_unknown_and_cyclic_dependencies(orchestration):
+    with pytest.raises(ValueError):
+        _run_dag(orchestration, [scheduler.Step('a', lambda eng, r: 1, deps=['z'], needs_engine=False)])
+    cycle = [scheduler.Step('a', lambda eng, r: 1, deps=['b'], needs_engine=False),
+             scheduler.Step('b', lambda eng, r: 1, deps=['a'], needs_engine=False)]
+    with pytest.raises(ValueError):
+        _run_dag(orchestration, cycle)
+
+
+@pytest.mark.parametrize('orchestration', orchestrations)
+def test_independent_engine_steps_borrow_the_idle_engines(orchestration, monkeypatch, tmp_path):
+    monkeypatch.setenv('MRI_PREPROC_FAKE_ENGINE_LATENCY', '0.2')
+    img = tmp_path / 'img.nii'
+    img.write_bytes(b'')
+    pool = engine_pool.EnginePool(2)
+    pool.start()
+    used = []
+
+    def align(eng, results):
+        used.append(eng)
+        return eng.my_align(str(img), str(tmp_path), background=True)
+
+    steps = [scheduler.Step(name, align) for name in ['align1', 'align2']]
+    _run_dag(orchestration, steps, pool=pool)
+    assert len({id(eng) for eng in used}) == 2
+    # the engines are given back
+    assert pool.try_acquire() is not None and pool.try_acquire() is not None
+
+
+@pytest.mark.parametrize('orchestration', orchestrations)
+def test_hung_engine_step_raises_engine_timeout(orchestration, monkeypatch, tmp_path):
+    monkeypatch.setenv('MRI_PREPROC_FAKE_ENGINE_LATENCY', '1')
+    img = tmp_path / 'img.nii'
+    img.write_bytes(b'')
+    pool = engine_pool.EnginePool(1)
+    engine = pool.acquire()
+    steps = [scheduler.Step('align', lambda eng, r: eng.my_align(str(img), str(tmp_path), background=True))]
+    with pytest.raises(engine_pool.EngineTimeout) as error:
+        _run_dag(orchestration, steps, engine, pool, step_timeout=0.1)
+    assert engine_pool.is_engine_failure(error.value)
+
+
+@pytest.mark.parametrize('orchestration', orchestrations)
+def test_python_steps_are_not_limited_by_the_step_timeout(orchestration):
+    with ThreadPoolExecutor(1) as executor:
+        steps = [scheduler.Step('native', lambda eng, r: executor.submit(lambda: time.sleep(0.3) or 'done'),
+                                needs_engine=False)]
+        assert _run_dag(orchestration, steps, step_timeout=0.05)['native'] == 'done'
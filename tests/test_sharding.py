@@ -0,0 +1,39 @@
+import random
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from mri_preprocessing.modules import sharding
+
+
+def _dataset(tmp_path, nb_subjects=7):
+    split_dwi_dict = {}
+    for i in range(nb_subjects):
+        img_path = tmp_path / 'sub{}.nii'.format(i)
+        nib.save(nib.Nifti1Image(np.zeros((2 + i % 3, 3, 4), dtype=np.uint8), np.eye(4)), str(img_path))
+        split_dwi_dict['sub{}'.format(i)] = {str(img_path): 1000}
+    return split_dwi_dict
+
+
+def test_partition_does_not_depend_on_the_key_order():
+    costs = {'k{}'.format(i): i % 4 for i in range(20)}
+    items = list(costs.items())
+    random.Random(0).shuffle(items)
+    assert sharding.partition(dict(items), 3) == sharding.partition(costs, 3)
+
+
+def test_shards_cover_every_subject_once(tmp_path):
+    split_dwi_dict = _dataset(tmp_path)
+    shards = [sharding.select_keys(split_dwi_dict, shard=(i, 3)) for i in range(3)]
+    assert sorted(k for keys in shards for k in keys) == sorted(split_dwi_dict)
+    # the same on another node reading the dataset in another order
+    reversed_dict = dict(reversed(list(split_dwi_dict.items())))
+    assert [set(sharding.select_keys(reversed_dict, shard=(i, 3))) for i in range(3)] == [set(s) for s in shards]
+
+
+def test_unreadable_image_has_no_cost(tmp_path):
+    split_dwi_dict = _dataset(tmp_path)
+    (tmp_path / 'sub0.nii').write_bytes(b'not an image')
+    with pytest.raises(ValueError):
+        sharding.select_keys(split_dwi_dict, shard=(0, 2))
@@ -0,0 +1,81 @@
+import os
+import re
+
+import nibabel as nib
+import numpy as np
+
+import synthetic
+from mri_preprocessing.modules import data_access, engine_pool, preproc, stage_manifest
+
+
+def test_completed_stage_is_resumed(tmp_path):
+    out = tmp_path / 'out.nii'
+    out.write_bytes(b'image')
+    manifest = stage_manifest.StageManifest(tmp_path / '__stages.jsonl')
+    manifest.record('align', {'align_0': {0.0: str(out)}}, {'steps': {'align_0': 'key'}})
+    manifest = stage_manifest.StageManifest(tmp_path / '__stages.jsonl')
+    assert manifest.completed('align', {'steps': {'align_0': 'key'}}) == {'align_0': {0.0: str(out)}}
+    assert manifest.state('align') == {'align_0': {0.0: str(out)}}
+
+
+def test_stage_is_invalidated(tmp_path):
+    out = tmp_path / 'out.nii'
+    out.write_bytes(b'image')
+    manifest = stage_manifest.StageManifest(tmp_path / '__stages.jsonl')
+    manifest.record('align', {'align_0': str(out)}, {'steps': {'align_0': 'key'}})
+    assert manifest.completed('align', {'steps': {'align_0': 'other key'}}) is None
+    assert manifest.completed('coreg') is None
+    out.write_bytes(b'larger image')
+    assert manifest.completed('align', {'steps': {'align_0': 'key'}}) is None
+
+
+def test_truncated_record_is_ignored(tmp_path):
+    manifest = stage_manifest.StageManifest(tmp_path / '__stages.jsonl')
+    manifest.record('align', {'align_0': 'value'})
+    with open(tmp_path / '__stages.jsonl', 'a') as f:
+        f.write('{"stage": "coreg", "sta')
+    manifest = stage_manifest.StageManifest(tmp_path / '__stages.jsonl')
+    assert manifest.completed('align') == {'align_0': 'value'}
+    assert manifest.completed('coreg') is None
+
+
+def _preprocess(split_dict, output_folder, capsys, toolbox_version='spm12 7771'):
+    pool = engine_pool.get_engine_pool()
+    with pool.engine() as engine:
+        output_dict = preproc.dwi_preproc_dict(engine, split_dict, output_folder, toolbox_version=toolbox_version)
+    resumed = re.findall(r'Stage (\w+) resumed', capsys.readouterr().out)
+    return output_dict, resumed
+
+
+def _subject(tmp_path):
+    json_path = synthetic.make_cohort(tmp_path / 'input', 1, 2, shape=(16, 16, 8))
+    split_dict = data_access.get_split_dict_from_json(json_path)['sub00000']
+    output_folder = tmp_path / 'output'
+    os.makedirs(output_folder)
+    return split_dict, output_folder
+
+
+all_stages = ['reset_gmean', 'align', 'coreg', 'reslice', 'nonlinear', 'apply']
+
+
+def test_subject_resumes_its_stages(tmp_path, capsys):
+    split_dict, output_folder = _subject(tmp_path)
+    output_dict, resumed = _preprocess(split_dict, output_folder, capsys)
+    assert resumed == []
+    assert _preprocess(split_dict, output_folder, capsys) == (output_dict, all_stages)
+
+
+def test_toolbox_upgrade_invalidates_the_stages(tmp_path, capsys):
+    split_dict, output_folder = _subject(tmp_path)
+    _preprocess(split_dict, output_folder, capsys)
+    assert _preprocess(split_dict, output_folder, capsys, 'spm12 7219')[1] == []
+
+
+def test_replaced_input_invalidates_the_stages(tmp_path, capsys):
+    split_dict, output_folder = _subject(tmp_path)
+    _preprocess(split_dict, output_folder, capsys)
+    img_path = next(p for p, bval in split_dict.items() if bval == 1000)
+    img = nib.load(img_path)
+    # same path and size, other content
+    nib.save(nib.Nifti1Image(np.asanyarray(img.dataobj)[::-1].copy(), img.affine), img_path)
+    assert _preprocess(split_dict, output_folder, capsys)[1] == []
@@ -0,0 +1,64 @@
+import os
+import shutil
+
+from mri_preprocessing.modules import step_cache
+
+
+def _write(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(content)
+    return str(path)
+
+
+def test_key_changes_with_the_inputs_params_and_toolbox(tmp_path):
+    img = _write(tmp_path / 'a.nii', b'image')
+    cache = step_cache.StepCache(tmp_path / 'cache', toolbox_version='spm12 7771')
+    key = cache.key('align', [img], {'vox': 2})
+    assert cache.key('align', [img], {'vox': 2}) == key
+    renamed = shutil.copyfile(img, tmp_path / 'b.nii')
+    assert cache.key('align', [renamed], {'vox': 2}) != key
+    assert cache.key('align', [img], {'vox': 1}) != key
+    assert cache.key('reslice', [img], {'vox': 2}) != key
+    other_toolbox = step_cache.StepCache(tmp_path / 'cache', toolbox_version='spm12 7219')
+    assert other_toolbox.key('align', [img], {'vox': 2}) != key
+    _write(tmp_path / 'a.nii', b'other')
+    assert cache.key('align', [img], {'vox': 2}) != key
+
+
+def test_changed_output_is_a_miss(tmp_path):
+    img = _write(tmp_path / 'a.nii', b'image')
+    cache = step_cache.StepCache(tmp_path / 'cache')
+    calls = []
+
+    def align():
+        calls.append(1)
+        return {'rigid': _write(tmp_path / 'rigid_a.nii', b'rigid' * len(calls))}
+
+    result = cache.run('align', align, [img])
+    assert cache.run('align', align, [img]) == result and len(calls) == 1
+    _write(tmp_path / 'rigid_a.nii', b'modified')
+    cache.run('align', align, [img])
+    assert len(calls) == 2
+    assert cache.stats() == {'hits': 1, 'misses': 2, 'evictions': 0}
+
+
+def test_hashes_are_not_shared_between_caches(tmp_path):
+    img = _write(tmp_path / 'a.nii', b'image')
+    cache = step_cache.StepCache(tmp_path / 'cache')
+    cache.key('align', [img])
+    assert not hasattr(step_cache, '_file_hash_memo')
+    assert step_cache.file_hash(img) == step_cache.file_hash(img, {})
+
+
+def test_evict_keeps_the_entries_of_the_session(tmp_path):
+    artifacts = tmp_path / 'tmp'
+    old_session = step_cache.StepCache(tmp_path / 'cache', artifacts)
+    old = old_session.run('old', lambda: _write(artifacts / 'old.nii', b'x' * 10), [])
+    old_entry = step_cache.StepCache(tmp_path / 'cache').key('old', [])
+    os.utime(tmp_path / 'cache' / (old_entry + '.json'), (0, 0))
+    cache = step_cache.StepCache(tmp_path / 'cache', artifacts, max_bytes=0)
+    new = cache.run('new', lambda: _write(artifacts / 'new.nii', b'x' * 10), [])
+    assert cache.evict() == 1
+    assert not os.path.exists(old)
+    assert os.path.exists(new)
+    assert cache.run('new', lambda: None, []) == new
@@ -0,0 +1,53 @@
+import json
+
+import numpy as np
+import pytest
+
+from mri_preprocessing.modules import scheduler, tracing
+
+mb = 1024 ** 2
+
+
+def test_steps_do_not_report_the_peak_of_earlier_steps(tmp_path):
+    if tracing.current_rss() is None:
+        pytest.skip('the resident memory cannot be measured on this system')
+    tracer = tracing.Tracer('sub1')
+    with tracer.span('large'):
+        data = np.ones(200 * mb // 8)
+        del data
+    with tracer.span('small'):
+        data = np.ones(mb // 8)
+    large, small = tracer.events
+    assert large['rss_after'] is not None and small['rss_before'] is not None
+    assert small['rss_after'] - small['rss_before'] < 50 * mb
+    # the memory of the large step was given back
+    assert small['rss_after'] < large['rss_before'] + 100 * mb
+
+
+def test_aggregated_memory(tmp_path):
+    events = [{'name': 'a', 'kind': 'align', 'stage': None, 'wall': 2., 'engine_wait': 0., 'bytes_read': 0,
+               'bytes_written': 0, 'rss_before': 100 * mb, 'rss_after': 300 * mb, 'cached': False},
+              {'name': 'b', 'kind': 'align', 'stage': None, 'wall': 1., 'engine_wait': 0., 'bytes_read': 0,
+               'bytes_written': 0, 'rss_before': 400 * mb, 'rss_after': 450 * mb, 'cached': False},
+              # saved by a previous version
+              {'name': 'c', 'kind': 'align', 'stage': None, 'wall': 1., 'engine_wait': 0., 'bytes_read': 0,
+               'bytes_written': 0, 'peak_rss': 900 * mb, 'cached': False}]
+    (tmp_path / 'sub1').mkdir()
+    (tmp_path / 'sub1' / tracing.trace_name).write_text(json.dumps({'subject': 'sub1', 'wall': 4., 'events': events}))
+    step = tracing.aggregate_traces(tmp_path)['steps']['align']
+    assert step['max_rss'] == 450 * mb
+    assert step['max_rss_growth'] == 200 * mb
+
+
+@pytest.mark.parametrize('orchestration', ['sync', 'asyncio'])
+def test_scheduler_records_the_memory_of_the_steps(orchestration):
+    tracer = tracing.Tracer()
+    steps = [scheduler.Step('a', lambda eng, r: 1, needs_engine=False),
+             scheduler.Step('b', lambda eng, r: 2, deps=['a'], needs_engine=False)]
+    if orchestration == 'asyncio':
+        scheduler.run_coroutine(scheduler.run_dag_async(steps, tracer=tracer))
+    else:
+        scheduler.run_dag(steps, tracer=tracer)
+    assert [e['name'] for e in tracer.events] == ['a', 'b']
+    if tracing.current_rss() is not None:
+        assert all(e['rss_before'] is not None and e['rss_after'] is not None for e in tracer.events)
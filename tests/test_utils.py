@@ -0,0 +1,40 @@
+import os
+
+import numpy as np
+import nibabel as nib
+import matlab.engine
+import pytest
+
+from mri_preprocessing.modules import utils
+
+
+@pytest.fixture
+def added_paths(monkeypatch):
+    added = []
+    monkeypatch.setattr(matlab.engine.FakeEngine, 'addpath', lambda self, *args, nargout=1: added.extend(args))
+    return added
+
+
+@pytest.fixture
+def subject(tmp_path):
+    # b0 with its inverse field already computed: no non_linear_reg
+    paths = [tmp_path / 'b0.nii', tmp_path / 'lesion.nii', tmp_path / 'iy_b0.nii']
+    for path in paths:
+        nib.save(nib.Nifti1Image(np.zeros((4, 4, 4), dtype=np.float32), np.eye(4)), str(path))
+    return [str(p) for p in paths[:2]]
+
+
+def test_spm_is_added_before_apply_inverse_transform(tmp_path, added_paths, subject):
+    b0_path, lesion_path = subject
+    os.makedirs(tmp_path / 'output')
+    output = utils.get_lesion_to_native_space(lesion_path, b0_path, tmp_path / 'output')
+    assert os.path.isfile(output)
+    assert os.environ['MRI_PREPROC_SPM_PATH'] in added_paths
+
+
+def test_spm_is_added_with_the_matlab_backend(tmp_path, added_paths, subject):
+    b0_path, lesion_path = subject
+    utils.lesions_to_native_space({lesion_path: 'sub'}, tmp_path / 'lesions', b0_dict={'sub': b0_path},
+                                  backend='matlab')
+    assert os.path.isfile(tmp_path / 'lesions' / 'sub' / 'native_space_lesion.nii')
+    assert os.environ['MRI_PREPROC_SPM_PATH'] in added_paths